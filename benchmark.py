@@ -0,0 +1,463 @@
+"""
+benchmark.py
+
+Офлайн-бенчмарки горячих путей предсказателя и слияния истории чатов.
+
+Генерирует синтетические логи рулетки в точном формате бота ("— N (🔴 Красное)", newest-first)
+размером от 5 до 1M бросков, замеряет каждый этап по моделям и k, пиковую память (tracemalloc)
+и пишет результаты в JSON. Режим compare сравнивает два прогона и помечает регрессии.
+
+Запуск:
+  python benchmark.py run --out bench_results.json
+  python benchmark.py run --sizes 5,100,1000 --stages parse,features,train
+  python benchmark.py compare old.json new.json --threshold 0.15
+  python benchmark.py stress --chats 20 --requests 200
+  python benchmark.py stress --chats 200 --requests 20 --max-resident 16
+
+Этапы (--stages):
+  parse     — ocp.parse_numbers_from_text (tokenize_spin_log по логу бота)
+  features  — ocp.build_feature_matrix / ocp.build_dataset (по k)
+  train     — ocp.train_and_get_predictor без кэша (по моделям и k)
+  predict   — вызов готового predictor на одной строке (по моделям и k)
+  text      — ocp.predict_from_text целиком (по моделям, k выбирается автоматически)
+  evaluate  — ocp.evaluate_models (последовательно, n_jobs=1)
+  many      — ocp.predict_many по MANY_CHATS историям × моделям × k (общий FeatureBlock) против тех же
+              предсказаний по одному через ocp.predict_next; результаты сверяются, расхождение — ошибка
+  merge     — chm.update_chat_history (продолжение истории на 1 новый бросок, числа уже распарсены,
+              включая запись в хранилище --storage binary|json|sqlite)
+  merge_window — то же для сообщения из MESSAGE_WINDOW бросков (один новый) при сохранённой истории
+              из n бросков — как бот работает в чате с глубокой историей
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import only_color_predictor as ocp
+
+DEFAULT_SIZES = [5, 30, 100, 1000, 10_000, 100_000, 1_000_000]
+ALL_STAGES = ['parse', 'features', 'train', 'predict', 'text', 'evaluate', 'many', 'merge', 'merge_window']
+MODELS = ['Markov', 'Logistic', 'RF']
+
+# Этапы с обучением моделей на миллионе бросков идут минутами — ограничиваем размер отдельно
+DEFAULT_MAX_TRAIN = 10_000
+DEFAULT_MAX_EVAL = 2_000
+DEFAULT_MAX_MERGE = 100_000
+
+MESSAGE_WINDOW = 30  # Столько бросков показывает сообщение бота рулетки
+MANY_CHATS = 3  # Сколько историй (чатов) в одном вызове predict_many
+
+# Сколько времени (с) тратить на повторы одного замера и максимум повторов
+MIN_BENCH_TIME = 0.2
+MAX_REPEATS = 50
+
+COLOR_LABELS = {
+    'красное': '🔴 Красное',
+    'чёрное': '⚫️ Чёрное',
+    'зелёное': '🟢 Зеленое'
+}
+
+
+def make_numbers(n: int, seed: int = 42) -> list:
+    """Случайные броски 0..36 (newest-first)"""
+    rng = random.Random(seed)
+    return [rng.randint(0, 36) for _ in range(n)]
+
+
+def format_line(number: int) -> str:
+    return f"— {number} ({COLOR_LABELS[ocp.color_of(number)]})"
+
+
+def make_log(numbers) -> str:
+    """Лог в формате сообщения бота рулетки"""
+    return "\n".join(format_line(x) for x in numbers)
+
+
+def measure(func, *args, **kwargs) -> dict:
+    """Замеряет func: повторяет до MIN_BENCH_TIME/MAX_REPEATS, затем отдельный прогон под tracemalloc"""
+    timings = []
+    total = 0.0
+    while len(timings) < MAX_REPEATS and (total < MIN_BENCH_TIME or len(timings) < 3):
+        started = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        timings.append(elapsed)
+        total += elapsed
+        if elapsed > 5 * MIN_BENCH_TIME:
+            break  # долгий этап — одного-двух замеров достаточно
+
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+        'repeats': len(timings),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+
+class IsolatedHistoryManager:
+    """chat_history_manager, у которого хранилище перенаправлено во временную папку"""
+
+    def __init__(self, directory: str, max_history_length: int, backend: str = 'binary'):
+        import chat_history_manager as chm
+        self.chm = chm
+        self._saved_storage = chm.storage
+        self._saved_max_history_length = chm.MAX_HISTORY_LENGTH
+        chm.storage = chm.create_storage(backend, directory)
+        chm.MAX_HISTORY_LENGTH = max_history_length
+        chm.load_data()
+
+    def close(self):
+        self.chm.storage.close()
+        self.chm.storage = self._saved_storage
+        self.chm.MAX_HISTORY_LENGTH = self._saved_max_history_length
+        self.chm.load_data()
+
+
+def bench_size(size: int, stages, args) -> list:
+    """Все выбранные этапы для одного размера лога"""
+    numbers = make_numbers(size, seed=size)
+    text = make_log(numbers)
+    results = []
+
+    def bench(stage, model, k, func, *func_args, **func_kwargs):
+        label = stage + (f"/{model}" if model else "") + (f"/k={k}" if k else "")
+        try:
+            metrics = measure(func, *func_args, **func_kwargs)
+        except Exception as e:
+            # на маленьких логах часть моделей не обучается (например, один класс) — это не ошибка бенчмарка
+            print(f"  {label:<24} n={size:<8} пропущено: {e}")
+            return
+        results.append({'stage': stage, 'model': model, 'k': k, 'size': size, **metrics})
+        print(f"  {label:<24} n={size:<8} median={metrics['median_s'] * 1000:10.3f} мс  "
+              f"peak={metrics['peak_kb']:10.1f} КБ  ({metrics['repeats']}x)")
+
+    if 'parse' in stages:
+        bench('parse', None, None, ocp.parse_numbers_from_text, text)
+
+    if 'features' in stages:
+        for k in range(1, ocp.MAX_K + 1):
+            if size > k:
+                bench('features', None, k, ocp.build_feature_matrix, numbers, k)
+                if size <= args.max_train:
+                    bench('dataset', None, k, ocp.build_dataset, numbers, k)
+
+    if size <= args.max_train:
+        for model in MODELS:
+            for k in range(1, ocp.MAX_K + 1):
+                if size <= k:
+                    continue
+                if 'train' in stages:
+                    bench('train', model, k, ocp.train_and_get_predictor, numbers, k, model, use_cache=False)
+                if 'predict' in stages:
+                    try:
+                        pred_fn, _ = ocp.train_and_get_predictor(numbers, k, model, use_cache=False)
+                    except Exception:
+                        continue
+                    bench('predict', model, k, pred_fn, numbers[:k])
+            if 'text' in stages:
+                k = ocp.choose_k_for_model(size, model)
+                if size > k:
+                    bench('text', model, k, _predict_from_text_uncached, text, k, model)
+
+    if 'evaluate' in stages and size <= args.max_eval:
+        bench('evaluate', None, None, ocp.evaluate_models, numbers, n_jobs=1)
+
+    if 'many' in stages and size <= args.max_eval:
+        histories = {f"chat{i}": make_numbers(size, seed=size + i) for i in range(MANY_CHATS)}
+        ks = list(range(1, ocp.MAX_K + 1))
+        _check_predict_many(histories, ks)
+        bench('many', None, None, _predict_many_uncached, histories, ks)
+        bench('many_single', None, None, _predict_each_uncached, histories, ks)
+
+    if 'merge' in stages and size <= args.max_merge:
+        with tempfile.TemporaryDirectory() as directory:
+            manager = IsolatedHistoryManager(directory, max_history_length=size + 1, backend=args.storage)
+            try:
+                bench('merge', None, None, _merge_continuation, manager.chm, numbers)
+            finally:
+                manager.close()
+
+    if 'merge_window' in stages and size <= args.max_merge:
+        with tempfile.TemporaryDirectory() as directory:
+            manager = IsolatedHistoryManager(directory, max_history_length=size, backend=args.storage)
+            try:
+                bench('merge_window', None, None, _merge_window_feed(manager.chm, size))
+            finally:
+                manager.close()
+
+    return results
+
+
+def _predict_from_text_uncached(text, k, model):
+    ocp.predictor_cache.clear()
+    return ocp.predict_from_text(text, k, model)
+
+
+def _predict_many_uncached(histories, ks):
+    ocp.predictor_cache.clear()
+    return ocp.predict_many(histories, models=MODELS, ks=ks)
+
+
+def _predict_each_uncached(histories, ks):
+    """Те же предсказания, что у predict_many, но по одному вызову predict_next на (чат, модель, k)"""
+    ocp.predictor_cache.clear()
+    results = {}
+    for chat_id, numbers in histories.items():
+        for model in MODELS:
+            for k in ks:
+                try:
+                    results[(chat_id, model, k)] = ocp.predict_next(numbers, k, model)
+                except Exception as e:
+                    results[(chat_id, model, k)] = e
+    return results
+
+
+def _check_predict_many(histories, ks):
+    """Сверяет predict_many с predict_next: тот же цвет, те же вероятности, ошибки в тех же местах"""
+    batched = _predict_many_uncached(histories, ks)
+    single = _predict_each_uncached(histories, ks)
+    mismatches = []
+    for key, expected in single.items():
+        got = batched[key]
+        if isinstance(expected, Exception):
+            if got['error'] is None:
+                mismatches.append(f"{key}: predict_next — ошибка '{expected}', predict_many — {got['prediction']}")
+            continue
+        prediction, info = expected
+        same_info = info.keys() == got['info'].keys() and all(
+            abs(info[color] - got['info'][color]) <= 1e-9 for color in info)
+        if got['error'] is not None or got['prediction'] != prediction or not same_info:
+            mismatches.append(f"{key}: predict_next — {prediction} {info}, "
+                              f"predict_many — {got['prediction']} {got['info']} {got['error'] or ''}")
+    if mismatches:
+        raise SystemExit("predict_many расходится с predict_next:\n  " + "\n  ".join(mismatches))
+    print(f"  predict_many совпадает с predict_next: {len(single)} предсказаний")
+
+
+def _merge_continuation(chm, numbers):
+    """Сохранённая история numbers[1:], затем приходит лог с одним новым броском"""
+    chm.chat_histories.clear()
+    chm.chat_markov.clear()
+    chm.update_chat_history(numbers[1:], 'bench')
+    chm.update_chat_history(numbers, 'bench')
+
+
+def _merge_window_feed(chm, size):
+    """Сохраняет историю из size бросков и возвращает функцию: каждый вызов — следующее сообщение бота
+    (последние MESSAGE_WINDOW бросков, из них один новый)"""
+    # Хронологический порядок (oldest-first); запас на все повторы measure()
+    spins = make_numbers(size + MAX_REPEATS + 2, seed=size)
+    chm.chat_histories.clear()
+    chm.chat_markov.clear()
+    chm.update_chat_history(spins[:size][::-1], 'bench')
+    position = [size]
+
+    def step():
+        position[0] += 1
+        end = position[0]
+        chm.update_chat_history(spins[max(end - MESSAGE_WINDOW, 0):end][::-1], 'bench')
+    return step
+
+
+def run(args):
+    stages = args.stages.split(',') if args.stages else ALL_STAGES
+    unknown = set(stages) - set(ALL_STAGES)
+    if unknown:
+        raise SystemExit(f"Неизвестные этапы: {', '.join(sorted(unknown))}")
+    sizes = [int(x) for x in args.sizes.split(',')] if args.sizes else DEFAULT_SIZES
+
+    results = []
+    for size in sizes:
+        print(f"n = {size}")
+        results.extend(bench_size(size, stages, args))
+
+    import numpy
+    payload = {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': numpy.__version__,
+            'cpu_count': os.cpu_count(),
+            'sizes': sizes,
+            'stages': stages
+        },
+        'results': results
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.out}")
+
+
+def _result_key(row):
+    return row['stage'], row.get('model'), row.get('k'), row['size']
+
+
+def compare(args):
+    """Сравнивает два прогона; код возврата 1, если есть регрессии"""
+    with open(args.base, encoding='utf-8') as f:
+        base = {_result_key(row): row for row in json.load(f)['results']}
+    with open(args.new, encoding='utf-8') as f:
+        new = {_result_key(row): row for row in json.load(f)['results']}
+
+    regressions = 0
+    print(f"{'этап':<24} {'n':>8} {'было, мс':>12} {'стало, мс':>12} {'x':>7}")
+    for key in sorted(base.keys() & new.keys(), key=lambda item: tuple(str(part) for part in item)):
+        stage, model, k, size = key
+        old_s = base[key]['median_s']
+        new_s = new[key]['median_s']
+        ratio = new_s / old_s if old_s > 0 else float('inf')
+        # Совсем короткие замеры шумят — регрессией считаем только заметное абсолютное замедление
+        flag = ''
+        if ratio > 1 + args.threshold and new_s - old_s > args.min_delta_ms / 1000:
+            flag = '  РЕГРЕССИЯ'
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = '  быстрее'
+        label = stage + (f"/{model}" if model else "") + (f"/k={k}" if k else "")
+        print(f"{label:<24} {size:>8} {old_s * 1000:12.3f} {new_s * 1000:12.3f} {ratio:7.2f}{flag}")
+
+    for key in sorted(base.keys() - new.keys(), key=str):
+        print(f"нет в новом прогоне: {key}")
+    print(f"Регрессий: {regressions}")
+    return 1 if regressions else 0
+
+
+async def _stress_request(chm, chat_id, message_id, window, use_locks):
+    """Как ludobot_command: слияние истории, await (модели, отправка ответа), сохранение предсказания"""
+    async def body():
+        chm.update_chat_history(window, chat_id)
+        await asyncio.sleep(0)
+        chm.get_current_stats()
+        await asyncio.sleep(0)
+        saved = chm.get_prediction_data(chat_id)
+        if not saved or message_id > saved['message_id']:
+            chm.save_prediction(chat_id, message_id, 'красное')
+
+    if use_locks:
+        async with chm.get_chat_lock(chat_id):
+            await body()
+    else:
+        await body()
+
+
+async def _stress_run(chm, chats, requests, use_locks):
+    """Все запросы всех чатов запускаются одновременно; запросы одного чата — в порядке сообщений"""
+    rng = random.Random(7)
+    spins = {f"stress-{c}": make_numbers(requests + MESSAGE_WINDOW, seed=c) for c in range(chats)}
+    # Случайно перемежаем чаты, сохраняя порядок сообщений внутри чата
+    sent = {chat_id: 0 for chat_id in spins}
+    tasks = []
+    while sent:
+        chat_id = rng.choice(list(sent))
+        i = sent[chat_id]
+        end = MESSAGE_WINDOW + i + 1
+        window = spins[chat_id][end - MESSAGE_WINDOW:end][::-1]
+        tasks.append(_stress_request(chm, chat_id, i + 1, window, use_locks))
+        sent[chat_id] = i + 1
+        if sent[chat_id] == requests:
+            del sent[chat_id]
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    return spins, time.perf_counter() - started
+
+
+def stress(args):
+    """Параллельные запросы из многих чатов: проверяет, что ни одно обновление не потеряно"""
+    with tempfile.TemporaryDirectory() as directory:
+        manager = IsolatedHistoryManager(directory, max_history_length=args.requests + MESSAGE_WINDOW,
+                                         backend=args.storage)
+        chm = manager.chm
+        saved_max_resident = chm.MAX_RESIDENT_CHATS
+        if args.max_resident:
+            chm.MAX_RESIDENT_CHATS = args.max_resident
+        try:
+            spins, elapsed = asyncio.run(_stress_run(chm, args.chats, args.requests, not args.no_locks))
+            errors = 0
+            for chat_id, chat_spins in spins.items():
+                expected = chat_spins[:0:-1]  # Первое сообщение — броски 1..MESSAGE_WINDOW
+                if list(chm.get_history(chat_id)) != expected:
+                    errors += 1
+                    print(f"{chat_id}: история расходится с ожидаемой")
+                prediction = chm.get_prediction_data(chat_id)
+                if not prediction or prediction['message_id'] != args.requests:
+                    errors += 1
+                    print(f"{chat_id}: последнее предсказание {prediction}, ожидалось сообщение {args.requests}")
+            # Каждый запрос, кроме первого в чате, проверяет предсказание предыдущего
+            expected_checks = args.chats * (args.requests - 1)
+            _, checks = chm.get_current_stats()
+            if checks != expected_checks:
+                errors += 1
+                print(f"Проверено предсказаний: {checks}, ожидалось {expected_checks}")
+            residency = chm.cache_stats()
+        finally:
+            chm.MAX_RESIDENT_CHATS = saved_max_resident
+            manager.close()
+
+    total = args.chats * args.requests
+    print(f"{total} запросов из {args.chats} чатов за {elapsed * 1000:.0f} мс, ошибок: {errors}")
+    print(f"Чатов в памяти: {residency['chats']}, попаданий: {residency['hits']}, "
+          f"промахов: {residency['misses']}, выгружено: {residency['evictions']}")
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки предсказателя и истории чатов")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help="запустить бенчмарки")
+    run_parser.add_argument('--sizes', help="размеры логов через запятую (по умолчанию 5..1M)")
+    run_parser.add_argument('--stages', help=f"этапы через запятую: {','.join(ALL_STAGES)}")
+    run_parser.add_argument('--out', default='bench_results.json', help="файл с результатами (JSON)")
+    run_parser.add_argument('--max-train', type=int, default=DEFAULT_MAX_TRAIN,
+                            help="максимальный размер для train/predict/text")
+    run_parser.add_argument('--max-eval', type=int, default=DEFAULT_MAX_EVAL,
+                            help="максимальный размер для evaluate")
+    run_parser.add_argument('--max-merge', type=int, default=DEFAULT_MAX_MERGE,
+                            help="максимальный размер для merge")
+    run_parser.add_argument('--storage', choices=['binary', 'json', 'sqlite'], default='binary',
+                            help="хранилище для merge (chm.create_storage)")
+
+    compare_parser = sub.add_parser('compare', help="сравнить два прогона")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.15,
+                                help="допустимое относительное замедление (0.15 = 15%%)")
+    compare_parser.add_argument('--min-delta-ms', type=float, default=0.05,
+                                help="минимальное абсолютное замедление, считающееся регрессией")
+
+    stress_parser = sub.add_parser('stress', help="параллельные запросы из многих чатов (потерянные обновления)")
+    stress_parser.add_argument('--chats', type=int, default=20)
+    stress_parser.add_argument('--requests', type=int, default=200, help="запросов на чат")
+    stress_parser.add_argument('--no-locks', action='store_true', help="без блокировок чатов (для сравнения)")
+    stress_parser.add_argument('--storage', choices=['binary', 'json', 'sqlite'], default='binary')
+    stress_parser.add_argument('--max-resident', type=int, default=0,
+                               help="сколько чатов держать в памяти (chm.MAX_RESIDENT_CHATS; 0 — как настроено)")
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+        return 0
+    if args.command == 'stress':
+        return stress(args)
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,145 +1,500 @@
+import asyncio
 import os
-import json
-import re
-from datetime import datetime, time, timedelta, timezone
-from typing import Dict, List, Tuple, Optional
+import threading
+from collections import OrderedDict
+from functools import wraps
+from datetime import time
+from typing import Dict, Mapping, Tuple, Optional, Sequence
 import logging
+from array import array
+
+import metrics
+from only_color_predictor import COLOR_NAMES, MarkovState, color_of, tokenize_spin_log
+from prediction_stats import CONSENSUS, DailyStats
+from spin_ring import SpinRing
+from storage import BinaryStorage, ChatRecord, JsonStorage, SqliteStorage, StorageBackend
 
 logger = logging.getLogger(__name__)
 
 # Конфигурируемые параметры
-MAX_HISTORY_LENGTH = 30  # Максимальная длина сохраненной истории
-MIN_MATCHES = max(5, min(MAX_HISTORY_LENGTH // 3, 10))  # Минимальное количество совпадений. # Минимальное количество совпадающих логов, чтобы понимать что полученная история - это продолжение сохранённой
+MESSAGE_WINDOW = 30  # Сколько бросков показывает сообщение бота рулетки
+MAX_HISTORY_LENGTH = int(os.getenv("HISTORY_DEPTH", "2000"))  # Глубина сохраненной истории чата (ёмкость SpinRing)
+MIN_MATCHES = max(5, min(MESSAGE_WINDOW // 3, 10))  # Минимальное количество совпадений. # Минимальное количество совпадающих логов, чтобы понимать что полученная история - это продолжение сохранённой
 RESET_TIME_UTC = time(21, 0)  # 21:00 UTC
 
 # Глобальные переменные
-chat_histories: Dict[str, str] = {}  # История каждого чата
-chat_predictions: Dict[str, dict] = {}  # Последнее предсказание для каждого чата: {'prediction': str, 'message_id': int}
-stats_total = 0  # Общее количество предсказаний
-stats_correct = 0  # Количество правильных предсказаний
-stats_reset_date = ""  # Дата последнего сброса статистики (YYYY-MM-DD)
+chat_histories: Dict[str, SpinRing] = {}  # История каждого чата: кольцевой буфер чисел, newest-first (цвет выводится из числа)
+chat_predictions: Dict[str, dict] = {}  # Последнее предсказание для каждого чата: {'prediction': str, 'message_id': int, 'models': {...}}
+chat_markov: Dict[str, MarkovState] = {}  # Инкрементальная марковская модель для каждого чата (по его истории)
+daily_stats = DailyStats(RESET_TIME_UTC)  # Точность предсказаний за текущие сутки (по чатам, моделям и k) и архив
+
+# Хранилище: "binary" (бинарный снимок с ленивой загрузкой чатов + журнал), "json" (JSON-снимок + журнал)
+# или "sqlite" (WAL, строка на чат)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "binary")
+DATA_DIR = os.getenv("DATA_DIR", ".")
+SQLITE_FILE = "chat_state.sqlite3"
+
+# Отложенная запись: изменения копятся в памяти и сбрасываются в хранилище фоновым потоком
+FLUSH_INTERVAL = 2.0  # Секунды между сбросами
+FLUSH_MAX_CHANGES = 50  # Столько изменений — сбрасываем сразу, не дожидаясь таймера
+
+# Блокировка состояния: её держат функции, меняющие состояние, и поток записи, пока снимает копию
+_state_lock = threading.RLock()
+_dirty_chats = set()  # Чаты, изменившиеся после последнего сброса
+_stats_dirty = False
+_clear_predictions_pending = False  # Все предсказания очищены (сброс статистики)
+_pending_changes = 0
+_writer_thread: Optional[threading.Thread] = None
+_writer_wakeup = threading.Event()
+_writer_stop = threading.Event()
 
-# Файлы для сохранения данных
-HISTORY_FILE = "chat_histories.json"
-PREDICTIONS_FILE = "chat_predictions.json"
-STATS_FILE = "stats.json"
+# Рабочий набор: в памяти держатся недавно использованные чаты, остальные выгружаются в хранилище
+# и перечитываются из него при следующем обращении (_ensure_chat)
+MAX_RESIDENT_CHATS = int(os.getenv("MAX_RESIDENT_CHATS", "1000"))
+MAX_RESIDENT_BYTES = int(os.getenv("MAX_RESIDENT_BYTES", str(64 * 1024 * 1024)))
+MARKOV_KEY_BYTES = 600  # Оценка памяти на ключ марковской модели (кортеж, словарь счётчиков)
+PREDICTION_BYTES = 1024  # Оценка памяти на сохранённое предсказание (с прогнозами моделей)
 
+_stored_chats: Mapping = {}  # Чаты из хранилища ({chat_id: ChatRecord}, декодируются при обращении; отражает запись)
+_unloaded_chats = set()  # Чаты из хранилища, ещё не загруженные в память (или выгруженные)
+_resident: OrderedDict = OrderedDict()  # Чаты в памяти -> оценка их размера в байтах, от давно не использованных
+_resident_bytes = 0
+_resident_counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+_flushing_chats = set()  # Чаты, которые сейчас пишет flush(): выгружать их до конца записи нельзя
+_stored_predictions_cleared = False  # Предсказания сброшены после загрузки — у незагруженных чатов тоже
+
+_chat_locks: Dict[str, asyncio.Lock] = {}  # Блокировки обработчиков по чатам (get_chat_lock)
+
+# Метрики (metrics.render): запись в хранилище идёт из потока записи, её время — в своём шарде потока
+SAVE_SECONDS = metrics.Histogram('ludobot_save_seconds', 'Время записи состояния в хранилище', ['mode'])
+SAVE_ERRORS = metrics.Counter('ludobot_save_errors_total', 'Ошибки отложенной записи в хранилище')
+
+def get_chat_lock(chat_id: str) -> asyncio.Lock:
+    """
+    Возвращает asyncio.Lock чата: обработчики одного чата выполняются по очереди, разных чатов — параллельно.
+    
+    Args:
+        chat_id: ID чата
+        
+    Returns:
+        asyncio.Lock: блокировка чата
+    """
+    chat_id_str = str(chat_id)
+    lock = _chat_locks.get(chat_id_str)
+    if lock is None:
+        lock = _chat_locks[chat_id_str] = asyncio.Lock()
+    return lock
+
+def with_state_lock(func):
+    """Выполняет функцию под блокировкой состояния (против чтения из потока записи)"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _state_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+def create_storage(kind: str = STORAGE_BACKEND, directory: str = DATA_DIR) -> StorageBackend:
+    """
+    Создаёт хранилище состояния чатов.
+    
+    Args:
+        kind: "binary", "json" или "sqlite"
+        directory: Папка с файлами данных
+        
+    Returns:
+        StorageBackend: хранилище
+    """
+    if kind == "binary":
+        return BinaryStorage(directory, snapshot_source=snapshot_state)
+    if kind == "json":
+        return JsonStorage(directory, snapshot_source=snapshot_state)
+    if kind == "sqlite":
+        return SqliteStorage(os.path.join(directory, SQLITE_FILE))
+    raise ValueError(f"Неизвестное хранилище: {kind}")
+
+@with_state_lock
 def load_data():
-    """Загружает все данные из файлов"""
-    global chat_histories, chat_predictions, stats_total, stats_correct, stats_reset_date
+    """Загружает данные из хранилища: статистику и индекс чатов"""
+    global daily_stats, _stored_chats, _unloaded_chats, _stored_predictions_cleared, _resident_bytes
     
-    # Загружаем истории чатов
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                if os.path.getsize(HISTORY_FILE) > 0:
-                    chat_histories = json.load(f)
+        chats, stats_data = storage.load()
     except Exception as e:
-        logger.error(f"Ошибка при загрузке историй: {e}")
-        chat_histories = {}
+        logger.error(f"Ошибка при загрузке данных: {e}")
+        chats, stats_data = {}, None
     
-    # Загружаем предсказания
-    try:
-        if os.path.exists(PREDICTIONS_FILE):
-            with open(PREDICTIONS_FILE, 'r', encoding='utf-8') as f:
-                if os.path.getsize(PREDICTIONS_FILE) > 0:
-                    chat_predictions = json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке предсказаний: {e}")
-        chat_predictions = {}
+    # Состояние чатов не декодируется здесь: чат загружается в память при первом обращении (_ensure_chat)
+    chat_histories.clear()
+    chat_predictions.clear()
+    chat_markov.clear()
+    _resident.clear()
+    _resident_bytes = 0
+    _stored_chats = chats
+    _unloaded_chats = set(chats)
+    _stored_predictions_cleared = False
     
-    # Загружаем статистику
     try:
-        if os.path.exists(STATS_FILE):
-            with open(STATS_FILE, 'r', encoding='utf-8') as f:
-                if os.path.getsize(STATS_FILE) > 0:
-                    stats_data = json.load(f)
-                    stats_total = stats_data.get("total", 0)
-                    stats_correct = stats_data.get("correct", 0)
-                    stats_reset_date = stats_data.get("reset_date", "")
-                    
-                    # Проверяем, нужно ли сбросить статистику
-                    check_and_reset_stats()
+        daily_stats = DailyStats.from_dict(stats_data, RESET_TIME_UTC) if stats_data else DailyStats(RESET_TIME_UTC)
     except Exception as e:
         logger.error(f"Ошибка при загрузке статистики: {e}")
-        stats_total = 0
-        stats_correct = 0
-        stats_reset_date = get_today_key()
+        daily_stats = DailyStats(RESET_TIME_UTC)
+    
+    # Проверяем, нужно ли сбросить статистику
+    check_and_reset_stats()
+
+def _ensure_chat(chat_id_str: str):
+    """Загружает состояние чата из хранилища при первом обращении к нему (или после выгрузки)"""
+    if chat_id_str in _resident:
+        _resident.move_to_end(chat_id_str)
+        _resident_counters['hits'] += 1
+        return
+    if chat_id_str in _unloaded_chats:
+        _resident_counters['misses'] += 1
+        _unloaded_chats.discard(chat_id_str)
+        try:
+            record = _stored_chats[chat_id_str]
+            if record.history:
+                chat_histories[chat_id_str] = history_from_json(record.history)
+            if record.prediction and not _stored_predictions_cleared:
+                chat_predictions[chat_id_str] = record.prediction
+            if record.markov:
+                chat_markov[chat_id_str] = MarkovState.from_dict(record.markov)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке данных чата {chat_id_str}: {e}")
+    _resident[chat_id_str] = 0
+    _update_resident_size(chat_id_str)
+    _evict_idle(keep=chat_id_str)
+
+def _chat_bytes(chat_id_str: str) -> int:
+    """Оценка памяти, занимаемой состоянием чата (для MAX_RESIDENT_BYTES)"""
+    size = 0
+    history = chat_histories.get(chat_id_str)
+    if history is not None:
+        size += history.capacity
+    if chat_id_str in chat_predictions:
+        size += PREDICTION_BYTES
+    state = chat_markov.get(chat_id_str)
+    if state is not None:
+        size += MARKOV_KEY_BYTES * sum(len(table) for table in state.freq.values())
+    return size
+
+def _update_resident_size(chat_id_str: str):
+    global _resident_bytes
+    if chat_id_str in _resident:
+        size = _chat_bytes(chat_id_str)
+        _resident_bytes += size - _resident[chat_id_str]
+        _resident[chat_id_str] = size
+
+def _evict_idle(keep: Optional[str] = None):
+    """
+    Выгружает давно не использовавшиеся чаты, пока рабочий набор не уложится в лимиты.
+    Несохранённые чаты пропускаются — их выгрузит следующий сброс (flush).
+    
+    Args:
+        keep: Чат, который сейчас используется (не выгружается)
+    """
+    global _resident_bytes
+    
+    excess_chats = len(_resident) - MAX_RESIDENT_CHATS
+    excess_bytes = _resident_bytes - MAX_RESIDENT_BYTES
+    if excess_chats <= 0 and excess_bytes <= 0:
+        return
+    
+    victims = []
+    for chat_id_str, size in _resident.items():
+        if excess_chats <= 0 and excess_bytes <= 0:
+            break
+        if chat_id_str == keep or chat_id_str in _dirty_chats or chat_id_str in _flushing_chats:
+            continue
+        has_state = chat_id_str in chat_histories or chat_id_str in chat_predictions or chat_id_str in chat_markov
+        if has_state and chat_id_str not in _stored_chats:
+            continue  # Состояние не из чего перечитать (хранилище не загрузилось) — держим в памяти
+        victims.append(chat_id_str)
+        excess_chats -= 1
+        excess_bytes -= size
+    
+    for chat_id_str in victims:
+        _resident_bytes -= _resident.pop(chat_id_str)
+        chat_histories.pop(chat_id_str, None)
+        chat_predictions.pop(chat_id_str, None)
+        chat_markov.pop(chat_id_str, None)
+        if chat_id_str in _stored_chats:
+            _unloaded_chats.add(chat_id_str)
+        _resident_counters['evictions'] += 1
+
+@with_state_lock
+def cache_stats() -> dict:
+    """Рабочий набор чатов: сколько в памяти, оценка байт, попадания/промахи/выгрузки"""
+    return {
+        'chats': len(_resident),
+        'bytes': _resident_bytes,
+        'unloaded': len(_unloaded_chats),
+        **_resident_counters
+    }
+
+@with_state_lock
+def history_stats() -> dict:
+    """Размеры историй чатов в памяти: всего бросков и самая длинная история"""
+    sizes = [len(history) for history in chat_histories.values()]
+    return {'total': sum(sizes), 'max': max(sizes, default=0)}
+
+def _chat_counts() -> dict:
+    with _state_lock:
+        return {('resident',): len(_resident), ('unloaded',): len(_unloaded_chats)}
+
+metrics.Gauge('ludobot_chats', 'Чаты: в памяти и выгруженные в хранилище', _chat_counts, ['state'])
+metrics.Gauge('ludobot_resident_bytes', 'Оценка памяти чатов в рабочем наборе', lambda: _resident_bytes)
+metrics.Gauge('ludobot_history_spins', 'Бросков в историях чатов в памяти',
+              lambda: {(stat,): value for stat, value in history_stats().items()}, ['stat'])
+metrics.CounterFunc('ludobot_chat_cache_total', 'Обращения к чатам: в памяти (hit), загружен из хранилища (miss), выгружен',
+                    lambda: {(result,): value for result, value in _resident_counters.items()}, ['result'])
+
+def _stored_record(chat_id_str: str) -> Optional[ChatRecord]:
+    """Запись ещё не загруженного чата в том виде, в каком она ушла бы в хранилище"""
+    record = _stored_chats[chat_id_str]
+    history = record.history
+    if history is not None and not isinstance(history, bytes):
+        history = history_from_json(history).tobytes()  # Список чисел или текст старого формата
+    prediction = None if _stored_predictions_cleared else record.prediction
+    if not history and not prediction and not record.markov:
+        return None
+    return ChatRecord(history, prediction, record.markov)
+
+def chat_record(chat_id_str: str) -> Optional[ChatRecord]:
+    """Состояние одного чата для хранилища (None, если о чате ничего не известно)"""
+    history = chat_histories.get(chat_id_str)
+    prediction = chat_predictions.get(chat_id_str)
+    state = chat_markov.get(chat_id_str)
+    if not history and not prediction and state is None:
+        return None
+    return ChatRecord(
+        history.tobytes() if history else None,
+        prediction,
+        state.to_dict() if state is not None else None
+    )
+
+def stats_record() -> dict:
+    return daily_stats.to_dict()
+
+@with_state_lock
+def snapshot_state() -> Tuple[Dict[str, ChatRecord], dict]:
+    """Копия всего состояния (для полного снимка)"""
+    chats = {}
+    for chat_id in chat_histories.keys() | chat_predictions.keys() | chat_markov.keys():
+        record = chat_record(chat_id)
+        if record is not None:
+            chats[chat_id] = record
+    # Чаты, к которым ещё не обращались, переносятся из хранилища как есть
+    for chat_id in _unloaded_chats:
+        record = _stored_record(chat_id)
+        if record is not None:
+            chats[chat_id] = record
+    return chats, stats_record()
 
 def save_data():
-    """Сохраняет все данные в файлы"""
+    """Сохраняет все данные (полный снимок); отложенные изменения в него уже входят"""
+    global _stats_dirty, _clear_predictions_pending, _pending_changes
+    with _state_lock:
+        chats, stats = snapshot_state()
+        _dirty_chats.clear()
+        _stats_dirty = False
+        _clear_predictions_pending = False
+        _pending_changes = 0
+    with SAVE_SECONDS.labels('full').time():
+        storage.write_all(chats, stats)
+
+def _mark_dirty(chat_id_str: Optional[str] = None, stats: bool = False, clear_predictions: bool = False):
+    """Отмечает изменение; без запущенного потока записи сохраняет сразу"""
+    global _stats_dirty, _clear_predictions_pending, _pending_changes
+    with _state_lock:
+        if chat_id_str is not None:
+            _dirty_chats.add(chat_id_str)
+        _stats_dirty = _stats_dirty or stats
+        _clear_predictions_pending = _clear_predictions_pending or clear_predictions
+        _pending_changes += 1
+        pending = _pending_changes
+    
+    if _writer_thread is None:
+        flush()
+    elif pending >= FLUSH_MAX_CHANGES:
+        _writer_wakeup.set()
+
+def persist_chat(chat_id_str: str):
+    """Отмечает чат для сохранения (история, предсказание, марковская модель)"""
+    with _state_lock:
+        _update_resident_size(chat_id_str)
+        _evict_idle(keep=chat_id_str)
+    _mark_dirty(chat_id_str)
+
+def persist_stats():
+    """Отмечает статистику для сохранения"""
+    _mark_dirty(stats=True)
+
+def flush() -> int:
+    """
+    Сохраняет в хранилище все отложенные изменения одной пачкой.
+    
+    Returns:
+        int: Количество сохранённых чатов
+    """
+    global _stats_dirty, _clear_predictions_pending, _pending_changes, _stored_predictions_cleared
+    
+    # Копию снимаем под блокировкой, а пишем уже без неё — запись не задерживает обработчики
+    with _state_lock:
+        if not _dirty_chats and not _stats_dirty and not _clear_predictions_pending:
+            return 0
+        chats = {chat_id: chat_record(chat_id) for chat_id in _dirty_chats}
+        stats = stats_record() if _stats_dirty else None
+        clear_predictions = _clear_predictions_pending
+        _flushing_chats.update(_dirty_chats)
+        _dirty_chats.clear()
+        _stats_dirty = False
+        _clear_predictions_pending = False
+        _pending_changes = 0
+    
     try:
-        # Сохраняем истории
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(chat_histories, f, ensure_ascii=False, indent=2)
-        
-        # Сохраняем предсказания
-        with open(PREDICTIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(chat_predictions, f, ensure_ascii=False, indent=2)
-        
-        # Сохраняем статистику
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump({
-                "total": stats_total, 
-                "correct": stats_correct,
-                "reset_date": stats_reset_date
-            }, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении данных: {e}")
+        with SAVE_SECONDS.labels('flush').time():
+            storage.write(chats, stats=stats, clear_predictions=clear_predictions)
+    finally:
+        with _state_lock:
+            _flushing_chats.difference_update(chats)
+            if clear_predictions and not _clear_predictions_pending:
+                # Сброс предсказаний записан — хранилище само отдаёт чаты без старых предсказаний
+                _stored_predictions_cleared = False
+            # Сохранённые чаты теперь можно выгрузить
+            _evict_idle()
+    return len(chats)
 
-def get_today_key():
-    """Возвращает ключ для сегодняшней даты"""
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+def _writer_loop(interval: float):
+    while not _writer_stop.is_set():
+        _writer_wakeup.wait(interval)
+        _writer_wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            SAVE_ERRORS.inc()
+            logger.error(f"Ошибка при отложенной записи: {e}")
 
-def should_reset_stats():
-    """Проверяет, нужно ли сбросить статистику (если сейчас после 21:00 UTC)"""
-    now_utc = datetime.now(timezone.utc)
-    reset_datetime = datetime.combine(now_utc.date(), RESET_TIME_UTC).replace(tzinfo=timezone.utc)
-    return now_utc >= reset_datetime
+def start_writer(interval: float = None):
+    """
+    Запускает поток отложенной записи: сброс каждые interval секунд или после FLUSH_MAX_CHANGES изменений.
+    
+    Args:
+        interval: Период сброса в секундах (по умолчанию FLUSH_INTERVAL)
+    """
+    global _writer_thread
+    if _writer_thread is not None:
+        return
+    _writer_stop.clear()
+    _writer_thread = threading.Thread(target=_writer_loop, args=(interval or FLUSH_INTERVAL,),
+                                      name="chat-state-writer", daemon=True)
+    _writer_thread.start()
+    logger.info("Поток отложенной записи запущен")
 
+def stop_writer():
+    """Останавливает поток отложенной записи и сохраняет всё, что осталось"""
+    global _writer_thread
+    if _writer_thread is not None:
+        _writer_stop.set()
+        _writer_wakeup.set()
+        _writer_thread.join()
+        _writer_thread = None
+    flush()
+    logger.info("Отложенные изменения сохранены")
+
+@with_state_lock
 def check_and_reset_stats():
-    """Проверяет и сбрасывает статистику если нужно"""
-    global stats_total, stats_correct, stats_reset_date, chat_predictions
+    """Сбрасывает статистику, если наступили новые сутки (после 21:00 UTC); в остальное время — O(1)"""
+    global _stored_predictions_cleared
     
-    today_key = get_today_key()
+    if daily_stats.roll_if_due():
+        # Очищаем все предсказания (в том числе у ещё не загруженных чатов)
+        chat_predictions.clear()
+        _stored_predictions_cleared = True
+        
+        logger.info(f"Статистика сброшена (после 21:00 UTC). Дата сброса: {daily_stats.reset_date}")
+        
+        # Отмечаем изменения для сохранения
+        _mark_dirty(stats=True, clear_predictions=True)
+
+# Подписи цветов для отображения истории (как в сообщениях бота рулетки)
+COLOR_LABELS = {
+    'красное': '🔴 Красное',
+    'чёрное': '⚫️ Чёрное',
+    'зелёное': '🟢 Зеленое'
+}
+
+def history_from_json(value) -> SpinRing:
+    """История из хранилища: байты/список чисел или текст со строками "— N (...)" (старый формат)"""
+    if isinstance(value, str):
+        value = tokenize_spin_log(value).numbers
+    return SpinRing(MAX_HISTORY_LENGTH, value)
+
+def format_history(numbers: Sequence[int]) -> str:
+    """Текст истории для отображения: строки "— N (🔴 Красное)", newest-first"""
+    return "\n".join(f"— {n} ({COLOR_LABELS[color_of(n)]})" for n in numbers)
+
+@with_state_lock
+def get_history(chat_id: str) -> array:
+    """Возвращает копию сохранённой истории чата (array('B'), newest-first; пустая, если истории нет)"""
+    chat_id_str = str(chat_id)
+    _ensure_chat(chat_id_str)
+    history = chat_histories.get(chat_id_str)
+    return history.to_array() if history is not None else array('B')
+
+@with_state_lock
+def find_in_history(chat_id: str, numbers: Sequence[int]) -> int:
+    """
+    Ищет лог целиком в сохранённой истории чата (ничего не меняет).
     
-    # Проверяем, нужно ли сбросить статистику
-    if should_reset_stats():
-        # Если еще не сбрасывали сегодня или сбрасывали вчера
-        if stats_reset_date != today_key:
-            # Сбрасываем статистику
-            stats_total = 0
-            stats_correct = 0
-            stats_reset_date = today_key
-            
-            # Очищаем все предсказания
-            chat_predictions.clear()
-            
-            logger.info(f"Статистика сброшена (сейчас после 21:00 UTC). Дата сброса: {today_key}")
-            
-            # Сохраняем данные
-            save_data()
-
-def parse_history_text(text: str) -> List[str]:
-    """Парсит текст истории на отдельные строки"""
-    return [line.strip() for line in text.split('\n') if line.strip()]
-
-def extract_color_from_line(line: str) -> str:
-    """Извлекает цвет из строки истории"""
-    # Паттерн для строки типа "— 18 (🔴 Красное)"
-    match = re.match(r'^—\s*\d+\s*\((.+?)\)', line)
-    if match:
-        color_text = match.group(1).strip()
-        color_text_lower = color_text.lower()
+    Args:
+        chat_id: ID чата
+        numbers: Числа из сообщения (newest-first)
         
-        if '🔴' in color_text or 'красн' in color_text_lower:
-            return 'красное'
-        elif '⚫️' in color_text or '⚫' in color_text or 'чёрн' in color_text_lower or 'черн' in color_text_lower:
-            return 'чёрное'
-        elif '🟢' in color_text or 'зелен' in color_text_lower:
-            return 'зелёное'
+    Returns:
+        int: Сколько бросков истории новее лога (0 — лог совпадает с началом истории), -1 — лог не найден
+    """
+    chat_id_str = str(chat_id)
+    _ensure_chat(chat_id_str)
+    history = chat_histories.get(chat_id_str)
+    if not history or not numbers:
+        return -1
+    # Числа — по байту на бросок, поэтому поиск подстроки в байтах и есть поиск подпоследовательности
+    return history.to_array().tobytes().find(bytes(numbers))
+
+def rebuild_markov_state(chat_id_str: str, numbers: Sequence[int]) -> MarkovState:
+    """Пересчитывает марковскую модель чата с нуля по истории"""
+    if isinstance(numbers, SpinRing):
+        numbers = numbers.to_array()  # Один непрерывный кусок вместо среза кольца на каждую пару
+    state = MarkovState()
+    state.rebuild(numbers)
+    chat_markov[chat_id_str] = state
+    return state
+
+class _Prepended:
+    """new + saved без копирования saved: MarkovState.advance читает только края истории"""
+    
+    def __init__(self, new: Sequence[int], saved: Sequence[int]):
+        self.new = new
+        self.saved = saved
     
-    return None
+    def __len__(self):
+        return len(self.new) + len(self.saved)
+    
+    def __getitem__(self, item):
+        n = len(self.new)
+        if isinstance(item, slice):
+            start, stop, _ = item.indices(len(self))
+            return list(self.new[start:min(stop, n)]) + list(self.saved[max(start - n, 0):max(stop - n, 0)])
+        return self.new[item] if item < n else self.saved[item - n]
+
+def advance_markov_state(chat_id_str: str, saved: Sequence[int], new: Sequence[int], keep: int):
+    """Добавляет в марковскую модель чата только новые броски (new идут перед saved)"""
+    state = chat_markov.get(chat_id_str)
+    if state is None or state.length != len(saved):
+        # Состояния нет или оно рассинхронизировано с историей — пересчитываем сохранённую историю
+        state = rebuild_markov_state(chat_id_str, saved)
+    state.advance(_Prepended(new, saved), len(new), keep)
 
 def normalize_prediction(prediction: str) -> str:
     """Нормализует предсказание для сравнения"""
@@ -154,122 +509,140 @@ def normalize_prediction(prediction: str) -> str:
     
     return prediction
 
-def update_chat_history(clean_log_text: str, chat_id: str) -> str:
+def find_overlap(new: Sequence[int], saved: Sequence[int]) -> int:
+    """
+    Длина стыка: самый длинный хвост new, совпадающий с началом saved (KMP, O(len(new))).
+    
+    Args:
+        new: Числа из сообщения (newest-first)
+        saved: Сохранённая история (newest-first)
+        
+    Returns:
+        int: Количество совпавших бросков (0, если продолжения нет)
+    """
+    # Хвост new не длиннее самого new, поэтому образец — только начало сохранённой истории
+    pattern = saved[:len(new)]
+    m = len(pattern)
+    if m == 0:
+        return 0
+    
+    # Префикс-функция образца
+    fail = [0] * m
+    q = 0
+    for i in range(1, m):
+        while q and pattern[i] != pattern[q]:
+            q = fail[q - 1]
+        if pattern[i] == pattern[q]:
+            q += 1
+        fail[i] = q
+    
+    # Проход по new: q — длина совпавшего начала образца, заканчивающегося на текущем броске
+    q = 0
+    for x in new:
+        if q == m:
+            q = fail[q - 1]
+        while q and x != pattern[q]:
+            q = fail[q - 1]
+        if x == pattern[q]:
+            q += 1
+    return q
+
+@with_state_lock
+def update_chat_history(new_numbers: Sequence[int], chat_id: str, new_colors: Optional[bytes] = None) -> array:
     """
     Обновляет историю чата и проверяет предсказания.
     
     Args:
-        clean_log_text: Очищенный текст истории рулетки
+        new_numbers: Числа из сообщения рулетки (newest-first)
         chat_id: ID чата
+        new_colors: Коды цветов тех же бросков (ocp.SpinLog.colors); если не заданы, цвет определяется по числу
         
     Returns:
-        str: Обновленный текст истории для предсказаний
+        array: Копия обновленной истории чата (array('B') чисел, newest-first) для предсказаний
     """
-    global stats_total, stats_correct
-    
-    # Загружаем данные при первом вызове
-    if not chat_histories:
-        load_data()
+    stats_changed = False
     
     # Проверяем и сбрасываем статистику если нужно
     check_and_reset_stats()
     
     # Преобразуем chat_id в строку
     chat_id_str = str(chat_id)
+    _ensure_chat(chat_id_str)
     
     # Получаем текущую сохраненную историю
-    saved_history = chat_histories.get(chat_id_str, "").strip()
+    saved = chat_histories.get(chat_id_str)
+    new = array('B', new_numbers)
     
     # Получаем сохраненное предсказание для этого чата
     saved_prediction_data = chat_predictions.get(chat_id_str)
     
     # Если история пустая или не существует, сохраняем новую и возвращаем
-    if not saved_history:
-        chat_histories[chat_id_str] = clean_log_text
-        save_data()
-        return clean_log_text
-    
-    # Парсим обе истории на строки
-    new_lines = parse_history_text(clean_log_text)
-    saved_lines = parse_history_text(saved_history)
-    
-    # Переменные для алгоритма
-    non_matching_part = []  # Переменная 1 - несовпадения
-    matching_part = []       # Переменная 2 - совпадения
-    
-    # Курсоры
-    i = 0  # Курсор для new_lines
-    j = 0  # Курсор для saved_lines
-    
-    # Алгоритм сравнения
-    while i < len(new_lines):
-        if j < len(saved_lines) and new_lines[i] == saved_lines[j]:
-            # Совпадение найдено
-            matching_part.append(new_lines[i])
-            i += 1
-            j += 1
-        else:
-            # Несовпадение
-            if matching_part:
-                # Если до этого были совпадения, сбрасываем matching_part в non_matching_part
-                non_matching_part.extend(matching_part)
-                matching_part = []
-                j = 0  # Сбрасываем курсор сохраненной истории
-                # i не увеличиваем - проверяем ту же строку снова
-            else:
-                # Не было совпадений до этого, просто добавляем в non_matching_part
-                non_matching_part.append(new_lines[i])
-                i += 1
-                j = 0  # Сбрасываем курсор сохраненной истории
+    if not saved:
+        history = SpinRing(MAX_HISTORY_LENGTH, new)
+        chat_histories[chat_id_str] = history
+        rebuild_markov_state(chat_id_str, history)
+        persist_chat(chat_id_str)
+        return history.to_array()
+    
+    # Ищем, где новый лог стыкуется с сохранённой историей:
+    # matching_part — совпавший с началом сохранённой истории хвост new, non_matching_part — новые броски
+    overlap = find_overlap(new, saved)
+    non_matching_part = new[:len(new) - overlap]  # Переменная 1 - несовпадения
+    matching_part = new[len(new) - overlap:]      # Переменная 2 - совпадения
     
     # Проверяем предсказание, если оно есть и non_matching_part не пустой
     # И только если есть достаточно совпадений (len(matching_part) >= MIN_MATCHES)
     if saved_prediction_data and non_matching_part and len(matching_part) >= MIN_MATCHES:
-        # Берём последнюю строку из non_matching_part
-        last_line = non_matching_part[-1]
-        actual_color = extract_color_from_line(last_line)
+        # Берём последний бросок из non_matching_part — цвет уже проверен при разборе лога
+        if new_colors is not None:
+            actual_color = COLOR_NAMES[new_colors[len(non_matching_part) - 1]]
+        else:
+            actual_color = color_of(non_matching_part[-1])
+        
+        # Нормализуем предсказание
+        normalized_prediction = normalize_prediction(saved_prediction_data.get('prediction', ''))
+        
+        # Сравниваем
+        is_correct = (normalized_prediction == actual_color)
+        
+        # Обновляем статистику: общий прогноз и отдельно прогноз каждой модели
+        daily_stats.record(chat_id_str, CONSENSUS, 0, is_correct)
+        for model, model_prediction in saved_prediction_data.get('models', {}).items():
+            daily_stats.record(chat_id_str, model, model_prediction.get('k', 0),
+                               normalize_prediction(model_prediction.get('prediction', '')) == actual_color)
+        stats_changed = True
         
-        if actual_color:
-            # Нормализуем предсказание
-            normalized_prediction = normalize_prediction(saved_prediction_data.get('prediction', ''))
-            
-            # Сравниваем
-            is_correct = (normalized_prediction == actual_color)
-            
-            # Обновляем статистику
-            stats_total += 1
-            if is_correct:
-                stats_correct += 1
-            
-            logger.info(f"Проверка предсказания для чата {chat_id_str}: "
-                       f"предсказание '{normalized_prediction}' vs результат '{actual_color}' -> {is_correct}")
+        logger.info(f"Проверка предсказания для чата {chat_id_str}: "
+                   f"предсказание '{normalized_prediction}' vs результат '{actual_color}' -> {is_correct}")
     
     # Проверяем результаты совпадений
     if len(matching_part) >= MIN_MATCHES:
-        # Достаточно совпадений - объединяем non_matching_part с сохраненной историей
-        updated_lines = non_matching_part + saved_lines
+        # Достаточно совпадений - объединяем non_matching_part с сохраненной историей.
+        # Марковская модель обновляется до записи в кольцо: ей нужны вытесняемые старые броски
+        advance_markov_state(chat_id_str, saved, non_matching_part, saved.capacity)
+        saved.prepend(non_matching_part)  # Самые старые броски сверх ёмкости вытесняются
+        updated = saved
     else:
         # Недостаточно совпадений - заменяем историю полностью
-        updated_lines = new_lines
+        updated = SpinRing(MAX_HISTORY_LENGTH, new)
+        rebuild_markov_state(chat_id_str, updated)
         # Если история заменена полностью, удаляем предсказание для этого чата
         if chat_id_str in chat_predictions:
             del chat_predictions[chat_id_str]
             logger.info(f"История чата {chat_id_str} заменена полностью, предсказание удалено")
     
-    # Обрезаем до MAX_HISTORY_LENGTH если нужно
-    if len(updated_lines) > MAX_HISTORY_LENGTH:
-        updated_lines = updated_lines[:MAX_HISTORY_LENGTH]
-    
     # Обновляем сохраненную историю
-    updated_history = "\n".join(updated_lines)
-    chat_histories[chat_id_str] = updated_history
+    chat_histories[chat_id_str] = updated
     
-    # Сохраняем все данные
-    save_data()
+    # Отмечаем изменения для сохранения
+    persist_chat(chat_id_str)
+    if stats_changed:
+        persist_stats()
     
-    return updated_history
+    return updated.to_array()
 
-def save_prediction(chat_id: str, message_id: int, prediction: str):
+@with_state_lock
+def save_prediction(chat_id: str, message_id: int, prediction: str, models: Optional[Dict[str, dict]] = None):
     """
     Сохраняет предсказание для чата.
     
@@ -277,15 +650,20 @@ def save_prediction(chat_id: str, message_id: int, prediction: str):
         chat_id: ID чата
         message_id: ID сообщения с логами, на которое сделано предсказание
         prediction: Предсказание (например, "красное", "чёрное")
+        models: Прогнозы отдельных моделей {модель: {'prediction': str, 'k': int}} — для статистики по моделям
     """
     chat_id_str = str(chat_id)
+    _ensure_chat(chat_id_str)
     chat_predictions[chat_id_str] = {
         'prediction': prediction,
         'message_id': message_id
     }
-    save_data()
+    if models:
+        chat_predictions[chat_id_str]['models'] = models
+    persist_chat(chat_id_str)
     logger.info(f"Сохранено предсказание для чата {chat_id_str} на сообщение {message_id}: {prediction}")
 
+@with_state_lock
 def get_prediction_data(chat_id: str) -> Optional[dict]:
     """
     Возвращает сохраненное предсказание и message_id для чата.
@@ -297,8 +675,27 @@ def get_prediction_data(chat_id: str) -> Optional[dict]:
         Optional[dict]: {'prediction': str, 'message_id': int} или None
     """
     chat_id_str = str(chat_id)
+    _ensure_chat(chat_id_str)
     return chat_predictions.get(chat_id_str)
 
+@with_state_lock
+def get_markov_state(chat_id: str) -> Optional[MarkovState]:
+    """
+    Возвращает инкрементальную марковскую модель чата (соответствует сохранённой истории).
+    
+    Args:
+        chat_id: ID чата
+        
+    Returns:
+        Optional[MarkovState]: состояние или None, если истории ещё нет
+    """
+    chat_id_str = str(chat_id)
+    _ensure_chat(chat_id_str)
+    state = chat_markov.get(chat_id_str)
+    if state is None and chat_histories.get(chat_id_str):
+        state = rebuild_markov_state(chat_id_str, chat_histories[chat_id_str])
+    return state
+
 def get_current_stats() -> Tuple[int, int]:
     """
     Возвращает текущую статистику.
@@ -308,8 +705,9 @@ def get_current_stats() -> Tuple[int, int]:
     """
     # Проверяем и сбрасываем статистику если нужно
     check_and_reset_stats()
-    return stats_correct, stats_total
+    return daily_stats.win_rate()
 
+@with_state_lock
 def clear_chat_prediction(chat_id: str):
     """
     Очищает сохраненное предсказание для чата.
@@ -318,10 +716,12 @@ def clear_chat_prediction(chat_id: str):
         chat_id: ID чата
     """
     chat_id_str = str(chat_id)
+    _ensure_chat(chat_id_str)
     if chat_id_str in chat_predictions:
         del chat_predictions[chat_id_str]
-        save_data()
+        persist_chat(chat_id_str)
         logger.info(f"Очищено предсказание для чата {chat_id_str}")
 
 # Загружаем данные при импорте модуля
+storage: StorageBackend = create_storage()
 load_data()
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""
+inference_executor.py
+
+Пул процессов для обучения моделей и получения предсказаний вне event loop бота.
+
+Обучение RandomForest/Logistic занимает заметное время, и если выполнять его прямо
+в async-обработчике, то Application.run_polling стоит, а все остальные чаты ждут.
+Поэтому тяжёлые задачи отправляются сюда, а обработчик только await-ит результат.
+
+Пул состоит из однопроцессных шардов (по числу ядер). Задачи с ключом (например,
+digest истории + модель) всегда попадают в один и тот же шард — так кэш обученных
+моделей внутри воркера (only_color_predictor.predictor_cache) действительно срабатывает
+на повторных запросах. Задачи без ключа раздаются по кругу.
+
+Содержит:
+  - start(max_workers=None)        # создать пул (по числу ядер) и прогреть воркеры
+  - run(func, *args, key=None)     # await-совместимый запуск функции в пуле
+  - broadcast(func, *args)         # выполнить функцию в каждом воркере (например, собрать статистику кэша)
+  - shutdown(wait=True)            # корректная остановка пула
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Модули, которые импортируются в воркерах заранее, чтобы первый запрос не платил за импорт sklearn
+PRELOAD_MODULES = ['only_color_predictor', 'sklearn.linear_model', 'sklearn.ensemble', 'sklearn.preprocessing']
+
+_shards: List[ProcessPoolExecutor] = []
+_round_robin = itertools.count()
+
+
+def _warm_up():
+    """Инициализатор воркера: импортирует тяжёлые библиотеки до первой задачи"""
+    import importlib
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+    # only_color_predictor импортирует numpy/pandas/sklearn лениво — загружаем их сразу
+    importlib.import_module('only_color_predictor').load_ml_libraries()
+
+
+def _noop():
+    return os.getpid()
+
+
+def _get_context():
+    """forkserver (с предзагрузкой модулей) там, где он есть, иначе spawn"""
+    if 'forkserver' in mp.get_all_start_methods():
+        ctx = mp.get_context('forkserver')
+        ctx.set_forkserver_preload(PRELOAD_MODULES)
+        return ctx
+    return mp.get_context('spawn')
+
+
+def start(max_workers: Optional[int] = None) -> List[ProcessPoolExecutor]:
+    """Создаёт пул процессов (по умолчанию — по количеству ядер) и прогревает воркеры"""
+    if _shards:
+        return _shards
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    ctx = _get_context()
+    for _ in range(max_workers):
+        shard = ProcessPoolExecutor(max_workers=1, mp_context=ctx, initializer=_warm_up)
+        # Пустая задача поднимает процесс сразу после старта, а не на первом запросе
+        shard.submit(_noop)
+        _shards.append(shard)
+    logger.info(f"Пул инференса запущен: {max_workers} процессов")
+    return _shards
+
+
+def _pick_shard(key) -> ProcessPoolExecutor:
+    shards = _shards if _shards else start()
+    if key is None:
+        return shards[next(_round_robin) % len(shards)]
+    return shards[hash(key) % len(shards)]
+
+
+async def run(func, *args, key=None):
+    """Выполняет func(*args) в пуле процессов и возвращает результат.
+    func и аргументы должны быть picklable (функции уровня модуля).
+    key: ключ привязки к воркеру — одинаковые ключи выполняются в одном процессе.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pick_shard(key), func, *args)
+
+
+async def broadcast(func, *args) -> list:
+    """Выполняет func(*args) в каждом воркере и возвращает список результатов"""
+    shards = _shards if _shards else start()
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(shard, func, *args) for shard in shards))
+
+
+def shutdown(wait: bool = True):
+    """Останавливает пул процессов; незапущенные задачи отменяются"""
+    if not _shards:
+        return
+    for shard in _shards:
+        shard.shutdown(wait=wait, cancel_futures=True)
+    _shards.clear()
+    logger.info("Пул инференса остановлен")
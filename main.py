@@ -2,16 +2,23 @@
 # Если ошибка о конфликте, нужно создать новый токен бота: Телеграм @BotFather - команда /revoke
 # ТОЛЬКО для Render прямо в коде дать BOT_TOKEN
 
+# Загрузка переменных окружения (.env) — до всех модулей, которые читают их при импорте,
+# включая startup_profile (IMPORT_PROFILE). python-dotenv импортируется быстро
+from dotenv import load_dotenv
+load_dotenv()
+
+# Отчёт о времени запуска — импортируется сразу, чтобы учесть все остальные импорты
+import startup_profile
+
 import logging
-import threading
 import asyncio
-import aiohttp
+import hashlib
 import os
 import re
 import time
+from array import array
 from datetime import datetime, timezone
-from dotenv import load_dotenv
-from flask import Flask
+from functools import wraps
 from telegram import Update, Bot
 from telegram.error import BadRequest
 from telegram.ext import (
@@ -23,15 +30,23 @@ from telegram.ext import (
 )
 import signal
 import sys
-from functools import partial
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 # Импортируем модуль для предсказаний
 import only_color_predictor as ocp
 # Импортируем модуль для управления историей чатов и статистики
 import chat_history_manager as chm
+# Пул процессов для обучения моделей вне event loop
+import inference_executor
+# HTTP-сервер (webhook, /, /ping и /metrics) в event loop бота
+import web_server
+# Метрики Prometheus (/metrics)
+import metrics
+from single_flight import SingleFlight
+# Очередь исходящих сообщений (лимиты Telegram, прогнозы раньше справки)
+from send_queue import SendQueue, PRIORITY_INFO, PRIORITY_PREDICTION
 
-# Загрузка переменных окружения
-load_dotenv()
+startup_profile.mark("импорт модулей")
 
 # Настройка логгера
 logging.basicConfig(
@@ -48,6 +63,15 @@ class Config:
     ALLOWED_CHAT_IDS = [-1002157100033, -1002439723121, -1002248982019]  # @Family_Worlds | @Einstein_bot_test_2 | Group(Private): BOT TEST
     CREATOR = "@andranik_amrahyan"
     
+    # Получение обновлений: "webhook" (Telegram сам присылает обновления на RENDER_APP_URL + WEBHOOK_PATH)
+    # или "polling" (запасной вариант, например для локального запуска)
+    UPDATE_MODE = os.getenv("UPDATE_MODE", "webhook")
+    WEBHOOK_PATH = "/telegram-webhook"
+    # Секрет, который Telegram присылает в каждом запросе на webhook (выводится из токена, если не задан)
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+    WEB_HOST = "0.0.0.0"
+    WEB_PORT = int(os.getenv("PORT", "8080"))
+    
     # Конфигурация для отслеживания предсказаний
     ROULETTE_BOT_ID = 6964500387  # Айди игрового бота рулетки
     
@@ -73,20 +97,68 @@ class Config:
         }
     }
 
-# Инициализация Flask
-app_flask = Flask(__name__)
+# Метрики конвейера прогнозов (отдаются web_server на /metrics)
+REQUESTS = metrics.Counter('ludobot_requests_total', 'Обработанные обновления по обработчикам', ['handler'])
+ERRORS = metrics.Counter('ludobot_errors_total', 'Ошибки по этапам обработки', ['stage'])
+HANDLER_SECONDS = metrics.Histogram('ludobot_handler_seconds', 'Время обработчика обновления', ['handler'])
+PARSE_SECONDS = metrics.Histogram('ludobot_parse_seconds', 'Разбор лога рулетки (tokenize_spin_log)')
+UPDATE_HISTORY_SECONDS = metrics.Histogram('ludobot_update_history_seconds',
+                                           'Слияние лога с историей чата (update_chat_history)')
+MODEL_SECONDS = metrics.Histogram('ludobot_model_seconds', 'Обучение (train) и предсказание (predict) моделей',
+                                  ['model', 'phase'])
+CACHE_HITS = metrics.Counter('ludobot_cache_hits_total', 'Попадания: готовый ответ (reply), обученная модель (model)',
+                             ['cache'])
+CACHE_MISSES = metrics.Counter('ludobot_cache_misses_total', 'Промахи тех же кэшей', ['cache'])
+metrics.CounterFunc('ludobot_coalesced_requests_total', 'Запросы, получившие результат уже идущего расчёта',
+                    lambda: prediction_flights.shared)
+metrics.Gauge('ludobot_send_queue_depth', 'Сообщений в очереди отправки по приоритетам',
+              lambda: {(str(priority),): outbox.stats()['queued_by_priority'].get(priority, 0)
+                       for priority in (PRIORITY_PREDICTION, PRIORITY_INFO)},
+              ['priority'])
+# Кэш обученных моделей живёт в воркерах пула: его статистика собирается периодически
+# (refresh_worker_cache_stats), а не при каждой выдаче /metrics
+worker_cache_stats: List[dict] = []
+metrics.Gauge('ludobot_model_cache_entries', 'Обученных моделей в кэше воркера пула',
+              lambda: {(str(worker),): stats['entries'] for worker, stats in enumerate(worker_cache_stats)},
+              ['worker'])
+metrics.Gauge('ludobot_model_cache_bytes', 'Оценка памяти моделей в кэше воркера пула',
+              lambda: {(str(worker),): stats['bytes'] for worker, stats in enumerate(worker_cache_stats)},
+              ['worker'])
+metrics.CounterFunc('ludobot_model_cache_evictions_total', 'Вытеснения из кэша моделей воркера пула',
+                    lambda: {(str(worker),): stats['evictions'] for worker, stats in enumerate(worker_cache_stats)},
+                    ['worker'])
+metrics.CounterFunc('ludobot_sent_messages_total', 'Исходящие сообщения: отправлено, ошибки, повторы после RetryAfter',
+                    lambda: {('sent',): outbox.sent, ('failed',): outbox.failed, ('retried',): outbox.retried},
+                    ['result'])
 
-@app_flask.route("/")
-def home():
-    return "Telegram Bot is running!"
+def instrumented(handler_name: str):
+    """Считает вызовы обработчика, его время и необработанные в нём ошибки"""
+    def decorator(func):
+        requests = REQUESTS.labels(handler_name)
+        seconds = HANDLER_SECONDS.labels(handler_name)
+        
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            requests.inc()
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                ERRORS.labels(handler_name).inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
 
-@app_flask.route("/ping")
-def ping():
-    return "pong", 200
+# Все ответы бота уходят через очередь: token bucket на чат и на бота, RetryAfter, приоритеты
+outbox = SendQueue()
 
-def run_web_server():
-    app_flask.run(host="0.0.0.0", port=8080)
+async def reply(update: Update, text: str, priority: int = PRIORITY_INFO, **kwargs):
+    """Ответ на сообщение update через очередь отправки"""
+    return await outbox.send(update.effective_chat.id, priority, update.message.reply_text, text, **kwargs)
 
+@instrumented('help')
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда помощи"""
     help_text = (
@@ -114,8 +186,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "</code>\n"
         f"👨💻 Создатель: {Config.CREATOR}"
     )
-    await update.message.reply_text(help_text, parse_mode="HTML")
+    await reply(update, help_text, parse_mode="HTML")
 
+@instrumented('rec')
 async def rec_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда рекомендаций"""
     rec_text = (
@@ -153,8 +226,31 @@ async def rec_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         #
         # f"🤖 Рекомендации от: {Config.CREATOR}"
     )
-    await update.message.reply_text(rec_text, parse_mode="HTML")
+    await reply(update, rec_text, parse_mode="HTML")
+
+async def run_model(chat_id, numbers, model, k_used, digest, chat_state=True):
+    """Возвращает (prediction, info) для модели.
+    Markov берётся из инкрементального состояния чата (O(1)), остальные модели обучаются в пуле процессов.
+    Задачи привязаны к воркеру по (digest истории, модель), чтобы повторный запрос попал в его кэш моделей.
+    chat_state=False — numbers не текущая история чата, и состояние Markov чата к ним не подходит.
+    """
+    if model == 'Markov' and chat_state:
+        state = chm.get_markov_state(chat_id)
+        if state is not None and state.length == len(numbers):
+            with MODEL_SECONDS.labels(model, 'predict').time():
+                return state.predict(k_used)
+    prediction, info, timings = await inference_executor.run(ocp.predict_next_timed, numbers, k_used, model,
+                                                             key=(digest, model))
+    # Время меряется в воркере пула и приходит вместе с результатом
+    if timings['cached']:
+        CACHE_HITS.labels('model').inc()
+    else:
+        CACHE_MISSES.labels('model').inc()
+        MODEL_SECONDS.labels(model, 'train').observe(timings['train'])
+    MODEL_SECONDS.labels(model, 'predict').observe(timings['predict'])
+    return prediction, info
 
+@instrumented('ludobot')
 async def ludobot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /ludobot"""
     # await update.message.reply_text(
@@ -167,9 +263,11 @@ async def ludobot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Проверяем, что команда является ответом на сообщение
     if not update.message.reply_to_message:
-        await update.message.reply_text(
+        await reply(
+            update,
             "❌ Пожалуйста, отправьте команду /ludobot в ответ на сообщение с историей рулетки.",
-            reply_to_message_id=update.message.message_id
+            reply_to_message_id=update.message.message_id,
+            priority=PRIORITY_PREDICTION
         )
         return
 
@@ -178,227 +276,353 @@ async def ludobot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = replied_message.text or replied_message.caption
 
     if not text:
-        await update.message.reply_text(
+        await reply(
+            update,
             "❌ Сообщение, на которое вы ответили, не содержит текста.",
-            reply_to_message_id=update.message.message_id
+            reply_to_message_id=update.message.message_id,
+            priority=PRIORITY_PREDICTION
         )
         return
 
-    # Очищаем текст от лишних строк и оставляем только строки с результатами рулетки
-    lines = text.split('\n')
-    roulette_pattern = r'^—\s*(\d+)\s*\((.+)\)'
-    found_lines = []
-    
-    for line in lines:
-        line = line.strip()
-        if not line:  # Пропускаем пустые строки
-            continue
-        match = re.match(roulette_pattern, line)
-        if match:
-            found_lines.append(line)
+    # Один проход по тексту: строки "— N (цвет)" -> броски (число, цвет) newest-first, сверенные с RED.
+    # Дальше (слияние, проверка предсказания, модели) используются уже разобранные броски
+    with PARSE_SECONDS.time():
+        spins = ocp.tokenize_spin_log(text)
+    if spins.rejected:
+        logger.warning(f"Чат {chat_id}: пропущено строк с неверным числом или цветом: {spins.rejected}")
 
-    if not found_lines:
-        await update.message.reply_text(
+    if not spins:
+        await reply(
+            update,
             "❌ Сообщение, на которое вы ответили, не содержит историю рулетки в правильном формате.\n"
             "Формат должен быть:\n"
             "— 22 (⚫️ Чёрное)\n"
             "— 31 (⚫️ Чёрное)\n"
             "— 1 (🔴 Красное)",
-            reply_to_message_id=update.message.message_id
+            reply_to_message_id=update.message.message_id,
+            priority=PRIORITY_PREDICTION
         )
         return
     
-    if len(found_lines) < Config.MIN_RESULTS_FOR_ANALYSIS:  # Минимум логов для анализа
-        await update.message.reply_text(
+    if len(spins) < Config.MIN_RESULTS_FOR_ANALYSIS:  # Минимум логов для анализа
+        await reply(
+            update,
             f"❌ Для анализа необходимо как минимум {Config.MIN_RESULTS_FOR_ANALYSIS} результатов в истории рулетки.",
-            reply_to_message_id=update.message.message_id
+            reply_to_message_id=update.message.message_id,
+            priority=PRIORITY_PREDICTION
         )
         return
 
-    # Сохраняем очищенные строки в переменную для передачи в predictor
-    clean_log_text = "\n".join(found_lines)
+    # Несколько игроков часто отвечают на одно и то же сообщение рулетки почти одновременно:
+    # такие запросы считаются один раз, остальные получают тот же ответ
+    flight_key = (chat_id, replied_message.message_id, ocp.history_digest(spins.numbers))
+    try:
+        precomputed = precomputed_replies.get(chat_id)
+        if precomputed is not None and precomputed[0] == flight_key:
+            # Прогноз уже посчитан, когда сообщение рулетки пришло в чат (roulette_message_handler)
+            CACHE_HITS.labels('reply').inc()
+            analysis = precomputed[1]
+        else:
+            CACHE_MISSES.labels('reply').inc()
+            analysis = await prediction_flights.run(flight_key, predict_for_message,
+                                                    flight_key, chat_id, replied_message, spins)
+        # Предсказание сохраняется и статистика дня подставляется только сейчас — когда ответ правда отправляется
+        response = await serve_prediction(chat_id, replied_message, analysis)
+        
+        # Отправляем сообщение с прогнозами
+        await reply(
+            update,
+            response,
+            parse_mode="HTML",
+            reply_to_message_id=update.message.message_id,
+            priority=PRIORITY_PREDICTION
+        )
+    except Exception as e:
+        ERRORS.labels('ludobot').inc()
+        logger.error(f"Ошибка в ludobot_command: {e}")
+        await reply(
+            update,
+            f"❌ Произошла ошибка при анализе истории рулетки: {str(e)}",
+            reply_to_message_id=update.message.message_id,
+            priority=PRIORITY_PREDICTION
+        )
+
+# Одновременные запросы по одному сообщению рулетки: ключ (чат, id сообщения, digest бросков)
+prediction_flights = SingleFlight()
+
+class Analysis(NamedTuple):
+    """Прогнозы по сообщению рулетки — без строки статистики дня, она добавляется при отправке"""
+    body: str                 # Прогнозы моделей и рекомендация (HTML)
+    consensus: Optional[str]  # Цвет, за который минимум 2 модели, или None
+    models: Dict[str, dict]   # Прогнозы моделей без ошибок: model -> {'prediction', 'k'}
+
+# Прогнозы на последнее обработанное сообщение рулетки в каждом чате: chat_id -> (ключ, Analysis)
+precomputed_replies: Dict[int, Tuple[tuple, Analysis]] = {}
+# Самое новое сообщение бота рулетки, слитое с историей чата: chat_id -> message_id
+latest_roulette_messages: Dict[int, int] = {}
+
+def is_roulette_message(message) -> bool:
+    """Сообщение написал сам бот рулетки (не пересланное)"""
+    return bool(
+        message.from_user and
+        message.from_user.id == Config.ROULETTE_BOT_ID and
+        getattr(message, 'forward_from', None) is None
+    )
+
+async def predict_for_message(flight_key, chat_id, replied_message, spins) -> Analysis:
+    """Прогнозы на сообщение рулетки (одна работа на все одновременные запросы к нему); предсказание не сохраняет"""
+    # Сообщения одного чата обрабатываются по очереди (история и предсказание чата меняются согласованно),
+    # разные чаты — параллельно
+    async with chm.get_chat_lock(chat_id):
+        # Сообщение рулетки старее последнего виденного: его лог не продолжает историю, и слияние
+        # заменило бы глубокую историю его бросками
+        stale = (is_roulette_message(replied_message) and
+                 replied_message.message_id < latest_roulette_messages.get(chat_id, 0))
+        analysis = await analyze_history(chat_id, spins, merge=not stale)
+        if is_roulette_message(replied_message):
+            latest_roulette_messages[chat_id] = max(latest_roulette_messages.get(chat_id, 0),
+                                                    replied_message.message_id)
     
-    # Обновляем историю чата (Прибавляем к старой, имеющейся истории текущего чата)
-    updated_history = chm.update_chat_history(clean_log_text, chat_id)
-    # print(updated_history)
+    # Запоминаем прогнозы, если сообщение не старее уже запомненного
+    precomputed = precomputed_replies.get(chat_id)
+    if precomputed is None or precomputed[0][1] <= replied_message.message_id:
+        precomputed_replies[chat_id] = (flight_key, analysis)
+    return analysis
+
+async def serve_prediction(chat_id, replied_message, analysis: Analysis) -> str:
+    """
+    Текст ответа на /ludobot: прогнозы и статистика дня на момент отправки.
+    Здесь же сохраняется предсказание для проверки следующим броском — только для запрошенных
+    сообщений, поэтому в статистику дня идут лишь прогнозы, которые игроки действительно получили.
+    """
+    async with chm.get_chat_lock(chat_id):
+        save_served_prediction(chat_id, replied_message, analysis)
     
     # Получаем текущую статистику для отображения
     correct_predictions, total_predictions = chm.get_current_stats()
     win_rate = (correct_predictions / total_predictions * 100) if total_predictions > 0 else 0
     
+    response = analysis.body + "────────────────────"
+            
+    # Добавляем статистику
+    if total_predictions > 0:
+        stats_text = f"📊 Сегодня правильно предсказаны: {correct_predictions}/{total_predictions} (Винрейт: {win_rate:.1f}%)"
+        response += f"\n{stats_text}"
+    
+    response += "\n📚 Используйте <code>/rec</code> для получения рекомендаций по стратегии"
+    # response += f"📊 Проанализировано результатов: {len(spins)}"
+    return response
+
+def save_served_prediction(chat_id, replied_message, analysis: Analysis):
+    """Сохраняет консенсус отправленного ответа, если его ещё можно проверить следующим броском"""
+    # Проверяем условия для сохранения нового предсказания
+    if not analysis.consensus or not is_roulette_message(replied_message):
+        return
+    
+    # Если есть сохраненное предсказание, проверяем, что текущее сообщение новее
+    saved_prediction_data = chm.get_prediction_data(chat_id)
+    if saved_prediction_data:
+        saved_message_id = saved_prediction_data.get('message_id', 0)
+        if replied_message.message_id <= saved_message_id:
+            logger.info(f"Сообщение {replied_message.message_id} не новее сохраненного {saved_message_id}, предсказание не сохранено")
+            return
+    
+    # В историю уже слито более новое сообщение рулетки: бросок после этого сообщения уже известен
+    latest_message_id = latest_roulette_messages.get(chat_id, 0)
+    if replied_message.message_id < latest_message_id:
+        logger.info(f"Сообщение {replied_message.message_id} старее последнего сообщения рулетки {latest_message_id}, предсказание не сохранено")
+        return
+    
+    # Сохраняем предсказание для чата, если все условия выполнены
+    chm.save_prediction(
+        chat_id=chat_id, 
+        message_id=replied_message.message_id, 
+        prediction=analysis.consensus,
+        # Прогнозы моделей без ошибок — для статистики точности по моделям и k
+        models=analysis.models
+    )
+    logger.info(f"Сохранено предсказание для чата {chat_id} на сообщение {replied_message.message_id}: {analysis.consensus}")
+
+@instrumented('roulette_message')
+async def roulette_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Сообщение бота рулетки в разрешённом чате: история сразу сливается (прошлое предсказание проверяется
+    по новому броску), а прогнозы моделей считаются заранее — /ludobot на это сообщение отвечает готовым.
+    Новое предсказание здесь не сохраняется: это происходит, только когда ответ запрошен (serve_prediction).
+    Отредактированные сообщения пропускаются.
+    """
+    if update.edited_message is not None:
+        return
+    message = update.effective_message
+    text = message.text or message.caption
+    if not text:
+        return
+    
+    with PARSE_SECONDS.time():
+        spins = ocp.tokenize_spin_log(text)
+    if len(spins) < Config.MIN_RESULTS_FOR_ANALYSIS:
+        return
+    
+    chat_id = update.effective_chat.id
+    flight_key = (chat_id, message.message_id, ocp.history_digest(spins.numbers))
     try:
-        # Передаем очищенный текст в модуль предсказаний
-        ocp.LAST_LOG_TEXT = updated_history
-        
-        # Получаем предсказания от всех моделей
-        models_to_run = ['Markov', 'Logistic', 'RF']
-        predictions = []
+        await prediction_flights.run(flight_key, predict_for_message, flight_key, chat_id, message, spins)
+    except Exception as e:
+        ERRORS.labels('precompute').inc()
+        logger.error(f"Ошибка при предварительном расчёте прогноза для чата {chat_id}: {e}")
+
+async def analyze_history(chat_id, spins, merge=True) -> Analysis:
+    """
+    Слияние истории и прогнозы моделей (под блокировкой чата); предсказание не сохраняет.
+    merge=False или лог, уже лежащий в истории не с начала (старое сообщение), — история не меняется,
+    а прогноз считается по истории на момент этого сообщения (или по самому логу, если его там нет).
+    """
+    with UPDATE_HISTORY_SECONDS.time():
+        offset = chm.find_in_history(chat_id, spins.numbers)
+        live = merge and offset <= 0
+        if live:
+            # Обновляем историю чата (Прибавляем к старой, имеющейся истории текущего чата)
+            updated_history = chm.update_chat_history(spins.numbers, chat_id, spins.colors)
+        elif offset >= 0:
+            updated_history = chm.get_history(chat_id)[offset:]
+        else:
+            updated_history = array('B', spins.numbers)
+    # print(chm.format_history(updated_history))
+    
+    # Получаем предсказания от всех моделей
+    models_to_run = ['Markov', 'Logistic', 'RF']
+    predictions = []
+
+    # Используем автоматический выбор k для каждой модели
+    numbers = updated_history  # array('B') newest-first — модели работают с ним напрямую
+    n = len(numbers)
+    k_values = [ocp.choose_k_for_model(n, model) for model in models_to_run]
+    digest = ocp.history_digest(numbers)
+
+    # Обучение идёт в пуле процессов, модели считаются параллельно, а event loop свободен
+    results = await asyncio.gather(
+        *(run_model(chat_id, numbers, model, k_used, digest, chat_state=live)
+          for model, k_used in zip(models_to_run, k_values)),
+        return_exceptions=True
+    )
+
+    for model, k_used, result in zip(models_to_run, k_values, results):
+        if isinstance(result, Exception):
+            ERRORS.labels('model').inc()
+            logger.error(f"Ошибка в модели {model}: {result}")
+            predictions.append({
+                'model': model,
+                'k': 0,
+                'prediction': f"Ошибка: {str(result)}",
+                'info': {}
+            })
+            continue
+
+        pred, info = result
+        predictions.append({
+            'model': model,
+            'k': k_used,
+            'prediction': pred,
+            'info': info
+        })
+
+    # Формируем ответное сообщение с персонажами
+    response = "🎰 <b>Прогнозы наших экспертов:</b>\n\n"
+    
+    for pred in predictions:
+        model_name = pred['model']
+        prediction = pred['prediction']
+        k_used = pred['k']
+        info = pred['info']
         
-        for model in models_to_run:
-            try:
-                # Используем автоматический выбор k для каждой модели
-                numbers = ocp.parse_numbers_from_text(updated_history)
-                n = len(numbers)
-                k_used = ocp.choose_k_for_model(n, model)
-                
-                pred_fn, trained = ocp.train_and_get_predictor(numbers, k_used, model)
-                pred, info = pred_fn(numbers[:k_used])
-                
-                predictions.append({
-                    'model': model,
-                    'k': k_used,
-                    'prediction': pred,
-                    'info': info
-                })
-                
-            except Exception as e:
-                logger.error(f"Ошибка в модели {model}: {e}")
-                predictions.append({
-                    'model': model,
-                    'k': 0,
-                    'prediction': f"Ошибка: {str(e)}",
-                    'info': {}
-                })
-
-        # Формируем ответное сообщение с персонажами
-        response = "🎰 <b>Прогнозы наших экспертов:</b>\n\n"
+        # Получаем конфигурацию персонажа
+        character = Config.CHARACTERS.get(model_name, {
+            'name': model_name,
+            'description': 'закономерности',
+            'emoji': '❓'
+        })
         
-        for pred in predictions:
-            model_name = pred['model']
-            prediction = pred['prediction']
-            k_used = pred['k']
-            info = pred['info']
-            
-            # Получаем конфигурацию персонажа
-            character = Config.CHARACTERS.get(model_name, {
-                'name': model_name,
-                'description': 'закономерности',
-                'emoji': '❓'
-            })
-            
-            # Экранируем специальные символы HTML
-            safe_prediction = str(prediction).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-            
-            # Определяем эмодзи для цвета предсказания
-            if "красное" in safe_prediction.lower():
-                color_emoji = "🔴"
-            elif "чёрное" in safe_prediction.lower():
-                color_emoji = "⚫️"
-            elif "зелёное" in safe_prediction.lower():
-                color_emoji = "🟢"
-            else:
-                color_emoji = "❓"
-            
-            # Вычисляем вероятность с учетом типа модели
-            probability = "?"
-            if info and isinstance(info, dict):
-                if model_name == 'Markov':
-                    # Для Markov: применяем сглаживание Лапласа с разными весами для разных цветов
-                    # Веса: красное=1, чёрное=1, зелёное=0.1 (зелёный выпадает реже)
-                    alpha_weights = {
-                        'красное': 1.0,
-                        'чёрное': 1.0,
-                        'зелёное': 0.1
-                    }
-                    
-                    # Вычисляем сглаженные вероятности с учетом весов
-                    total_smooth = sum(info.get(color, 0) + alpha_weights.get(color, 1.0) for color in alpha_weights)
-                    if safe_prediction in alpha_weights:
-                        prob_value = (info.get(safe_prediction, 0) + alpha_weights[safe_prediction]) / total_smooth
-                        probability = f"{prob_value * 100:.1f}%"
-                    else:
-                        probability = "33.3%"
-                    
-                else:
-                    # Для Logistic и RF: используем готовые вероятности
-                    if safe_prediction in info:
-                        prob_value = info[safe_prediction]
-                        probability = f"{prob_value * 100:.1f}%"
-            
-            # Формируем строку с персонажем
-            response += (f"{character['emoji']} <b>{character['name']}</b> смотрит на {character['description']} "
-                        f"и говорит: {color_emoji} <b>{safe_prediction}</b> ({probability})\n\n")
+        # Экранируем специальные символы HTML
+        safe_prediction = str(prediction).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
         
-        # Анализируем консенсус моделей
-        color_counts = {}
-        for pred in predictions:
-            color = pred['prediction']
-            if "красное" in color.lower() or "чёрное" in color.lower() or "зелёное" in color.lower():
-                color_counts[color] = color_counts.get(color, 0) + 1
+        # Определяем эмодзи для цвета предсказания
+        if "красное" in safe_prediction.lower():
+            color_emoji = "🔴"
+        elif "чёрное" in safe_prediction.lower():
+            color_emoji = "⚫️"
+        elif "зелёное" in safe_prediction.lower():
+            color_emoji = "🟢"
+        else:
+            color_emoji = "❓"
         
-        # Находим цвет с максимальным количеством голосов
-        consensus_prediction = None
-        if color_counts:
-            consensus_color = max(color_counts.items(), key=lambda x: x[1])
-            if consensus_color[1] >= 2:  # Если минимум 2 модели согласны
-                consensus_prediction = consensus_color[0]
-                if "красное" in consensus_prediction.lower():
-                    consensus_emoji = "🔴"
-                elif "чёрное" in consensus_prediction.lower():
-                    consensus_emoji = "⚫️"
-                else:
-                    consensus_emoji = "🟢"
+        # Вычисляем вероятность с учетом типа модели
+        probability = "?"
+        if info and isinstance(info, dict):
+            if model_name == 'Markov':
+                # Для Markov: применяем сглаживание Лапласа с разными весами для разных цветов
+                # Веса: красное=1, чёрное=1, зелёное=0.1 (зелёный выпадает реже)
+                alpha_weights = {
+                    'красное': 1.0,
+                    'чёрное': 1.0,
+                    'зелёное': 0.1
+                }
                 
-                # response += f"💡 <b>Консенсус:</b> {consensus_emoji} {consensus_prediction} ({consensus_color[1]}/3 моделей)\n\n"
-                response += f"💡 <b>Рекомендуем:</b> {consensus_prediction}\n\n"
-                
-        response += "────────────────────"
+                # Вычисляем сглаженные вероятности с учетом весов
+                total_smooth = sum(info.get(color, 0) + alpha_weights.get(color, 1.0) for color in alpha_weights)
+                if safe_prediction in alpha_weights:
+                    prob_value = (info.get(safe_prediction, 0) + alpha_weights[safe_prediction]) / total_smooth
+                    probability = f"{prob_value * 100:.1f}%"
+                else:
+                    probability = "33.3%"
                 
-        # Добавляем статистику
-        if total_predictions > 0:
-            stats_text = f"📊 Сегодня правильно предсказаны: {correct_predictions}/{total_predictions} (Винрейт: {win_rate:.1f}%)"
-            response += f"\n{stats_text}"
-        
-        response += "\n📚 Используйте <code>/rec</code> для получения рекомендаций по стратегии"
-        # response += f"📊 Проанализировано результатов: {len(found_lines)}"
-        
-        # Отправляем сообщение с прогнозами
-        sent_message = await update.message.reply_text(
-            response,
-            parse_mode="HTML",
-            reply_to_message_id=update.message.message_id
-        )
-        
-        # Получаем информацию о прошлом предсказании для этого чата
-        saved_prediction_data = chm.get_prediction_data(chat_id)
-        
-        # Проверяем условия для сохранения нового предсказания
-        should_save_prediction = (
-            consensus_prediction and 
-            replied_message.from_user and 
-            replied_message.from_user.id == Config.ROULETTE_BOT_ID and
-            getattr(replied_message, 'forward_from', None) is None
-        )
-        
-        # Если есть сохраненное предсказание, проверяем, что текущее сообщение новее
-        if should_save_prediction and saved_prediction_data:
-            saved_message_id = saved_prediction_data.get('message_id', 0)
-            if replied_message.message_id <= saved_message_id:
-                logger.info(f"Сообщение {replied_message.message_id} не новее сохраненного {saved_message_id}, предсказание не сохранено")
-                should_save_prediction = False
-        
-        # Сохраняем предсказание для чата, если все условия выполнены
-        if should_save_prediction:
-            chm.save_prediction(
-                chat_id=chat_id, 
-                message_id=replied_message.message_id, 
-                prediction=consensus_prediction
-            )
-            logger.info(f"Сохранено предсказание для чата {chat_id} на сообщение {replied_message.message_id}: {consensus_prediction}")
+            else:
+                # Для Logistic и RF: используем готовые вероятности
+                if safe_prediction in info:
+                    prob_value = info[safe_prediction]
+                    probability = f"{prob_value * 100:.1f}%"
         
-    except Exception as e:
-        logger.error(f"Ошибка в ludobot_command: {e}")
-        await update.message.reply_text(
-            f"❌ Произошла ошибка при анализе истории рулетки: {str(e)}",
-            reply_to_message_id=update.message.message_id
-        )
+        # Формируем строку с персонажем
+        response += (f"{character['emoji']} <b>{character['name']}</b> смотрит на {character['description']} "
+                    f"и говорит: {color_emoji} <b>{safe_prediction}</b> ({probability})\n\n")
+    
+    # Анализируем консенсус моделей
+    color_counts = {}
+    for pred in predictions:
+        color = pred['prediction']
+        if "красное" in color.lower() or "чёрное" in color.lower() or "зелёное" in color.lower():
+            color_counts[color] = color_counts.get(color, 0) + 1
+    
+    # Находим цвет с максимальным количеством голосов
+    consensus_prediction = None
+    if color_counts:
+        consensus_color = max(color_counts.items(), key=lambda x: x[1])
+        if consensus_color[1] >= 2:  # Если минимум 2 модели согласны
+            consensus_prediction = consensus_color[0]
+            if "красное" in consensus_prediction.lower():
+                consensus_emoji = "🔴"
+            elif "чёрное" in consensus_prediction.lower():
+                consensus_emoji = "⚫️"
+            else:
+                consensus_emoji = "🟢"
+            
+            # response += f"💡 <b>Консенсус:</b> {consensus_emoji} {consensus_prediction} ({consensus_color[1]}/3 моделей)\n\n"
+            response += f"💡 <b>Рекомендуем:</b> {consensus_prediction}\n\n"
+    
+    # Прогнозы моделей без ошибок — для статистики точности по моделям и k
+    models = {pred['model']: {'prediction': pred['prediction'], 'k': pred['k']}
+              for pred in predictions if pred['k']}
+    return Analysis(response, consensus_prediction, models)
 
 # Обработчик для новых чатов
+@instrumented('new_chat')
 async def handle_new_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.bot.id in [user.id for user in update.message.new_chat_members]:
         chat_id = update.effective_chat.id
         if chat_id not in Config.ALLOWED_CHAT_IDS:
-            await context.bot.send_message(
+            await outbox.send(
+                chat_id,
+                PRIORITY_INFO,
+                context.bot.send_message,
                 chat_id=chat_id,
                 text=(
                     f"🚫 Бот доступен только для разрешенных чатов.\n"
@@ -409,43 +633,84 @@ async def handle_new_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await help_command(update, context)
 
-# Самопингование
-async def self_ping(context):
+async def reset_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Начинает новые сутки статистики и очищает сохранённые предсказания"""
+    chm.check_and_reset_stats()
+
+async def refresh_worker_cache_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Собирает статистику кэша моделей из каждого воркера пула (для /metrics)"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{Config.RENDER_APP_URL}/ping") as resp:
-                logger.info(f"Self-ping status: {resp.status}")
+        worker_cache_stats[:] = await inference_executor.broadcast(ocp.cache_stats)
     except Exception as e:
-        logger.error(f"Self-ping error: {str(e)}")
-
-# Обработчик остановки
-async def shutdown(application):
-    logger.info("Starting graceful shutdown...")
-    application.job_queue.stop()  # Останавливаем все задачи
-    await application.stop()
-    await application.shutdown()
-    logger.info("Application stopped successfully")
-
-def handle_signal(application, loop, signal_name):
-    logger.info(f"Received {signal_name} signal")
-    loop.create_task(shutdown(application))
+        logger.error(f"Не удалось получить статистику кэша моделей: {e}")
 
 async def post_init(application):
-    # Регистрируем периодический самопинг через job_queue
-    application.job_queue.run_repeating(
-        self_ping,
-        interval=180,  # 3 минут
-        first=10  # Первый пинг через 10 сек после старта
+    # Поднимаем пул процессов для моделей заранее, чтобы первый запрос не ждал импорт sklearn
+    inference_executor.start()
+    startup_profile.mark("пул инференса запущен")
+    # Запись истории и статистики на диск — в фоновом потоке, а не в обработчиках
+    chm.start_writer()
+    outbox.start()
+    logger.info(startup_profile.report())
+
+    # Сброс дневной статистики ровно в 21:00 UTC (проверка в обработчиках остаётся страховкой)
+    application.job_queue.run_daily(
+        reset_stats_job,
+        time=chm.RESET_TIME_UTC.replace(tzinfo=timezone.utc)
     )
+    # Статистика кэша моделей в воркерах: задача встаёт в очередь каждого воркера, поэтому не чаще раза в 30 с
+    application.job_queue.run_repeating(refresh_worker_cache_stats, interval=30, first=5)
+
+
+async def run_bot(application):
+    """
+    Запускает бота и HTTP-сервер в одном event loop и работает до SIGINT/SIGTERM.
     
-    # Настраиваем обработчик сигналов только для UNIX-систем
+    В режиме webhook Telegram присылает обновления на WEBHOOK_PATH этого же сервера;
+    в режиме polling сервер отвечает только на / и /ping, а обновления забирает updater.
+    """
+    stop_event = asyncio.Event()
+    # Настраиваем обработчик сигналов только для UNIX-систем (в Windows остановка — по KeyboardInterrupt)
     if sys.platform != 'win32':
         loop = asyncio.get_running_loop()
         for signame in ('SIGINT', 'SIGTERM'):
-            loop.add_signal_handler(
-                getattr(signal, signame),
-                partial(handle_signal, application, loop, signame)
-            )
+            loop.add_signal_handler(getattr(signal, signame), stop_event.set)
+    
+    webhook = Config.UPDATE_MODE == "webhook"
+    web_app = web_server.create_web_app(
+        application,
+        webhook_path=Config.WEBHOOK_PATH if webhook else None,
+        secret_token=Config.WEBHOOK_SECRET
+    )
+    
+    async with application:  # initialize() ... shutdown()
+        await post_init(application)
+        runner = await web_server.start_web_server(web_app, Config.WEB_HOST, Config.WEB_PORT)
+        try:
+            if webhook:
+                await application.bot.set_webhook(
+                    url=f"{Config.RENDER_APP_URL}{Config.WEBHOOK_PATH}",
+                    allowed_updates=Update.ALL_TYPES,
+                    secret_token=Config.WEBHOOK_SECRET
+                )
+                logger.info(f"Webhook установлен: {Config.RENDER_APP_URL}{Config.WEBHOOK_PATH}")
+            else:
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                logger.info("Обновления получаются через polling")
+            await application.start()
+            
+            await stop_event.wait()
+            logger.info("Starting graceful shutdown...")
+        finally:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()  # Останавливает и job_queue
+            await outbox.stop()  # Дожидаемся отправки ответов, пока бот ещё инициализирован
+            await runner.cleanup()
+            inference_executor.shutdown()  # Останавливаем пул процессов с моделями
+            chm.stop_writer()  # Сохраняем отложенные изменения
+    logger.info("Application stopped successfully")
 
 # --- Обработчик для ludobot_command: точное сообщение "лудобот" (без ничего до/после, регистронезависимо) ---
 async def ludobot_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -463,14 +728,12 @@ async def ludobot_text_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await ludobot_command(update, context)
 
 def main():
-    # Запуск Flask в отдельном потоке
-    threading.Thread(target=run_web_server, daemon=True).start()
-
     # Создание и настройка бота
     application = ApplicationBuilder()\
         .token(Config.BOT_TOKEN)\
-        .post_init(post_init)\
+        .concurrent_updates(True)\
         .build()
+    startup_profile.mark("приложение создано")
     
     # Фильтр для разрешенных чатов
     allowed_chat = filters.Chat(chat_id=Config.ALLOWED_CHAT_IDS)
@@ -486,6 +749,16 @@ def main():
     application.add_handler(CommandHandler("ludobot", ludobot_command, filters=allowed_chat))
     application.add_handler(CommandHandler("rec", rec_command, filters=allowed_chat))
     
+    # Сообщения бота рулетки: история и прогнозы обновляются сразу, не дожидаясь команды
+    application.add_handler(
+        MessageHandler(
+            # Правка старого сообщения — не новый бросок: её лог не сливается с историей
+            filters.User(user_id=Config.ROULETTE_BOT_ID) & allowed_chat & (filters.TEXT | filters.CAPTION) &
+            ~filters.UpdateType.EDITED_MESSAGE,
+            roulette_message_handler
+        )
+    )
+    
     # --- Точное совпадение сообщения "лудобот" (без чего-либо до/после) ---
     ludobot_exact_re = re.compile(r'^\s*лудобот\s*$', re.IGNORECASE)
     application.add_handler(
@@ -497,12 +770,9 @@ def main():
 
     # Запуск бота
     try:
-        application.run_polling()
+        asyncio.run(run_bot(application))
     except (KeyboardInterrupt, SystemExit):
         logger.info("Application stopped by user")
-    finally:
-        if application.running:
-            application.stop()
 
 if __name__ == "__main__":
     main()
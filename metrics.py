@@ -0,0 +1,228 @@
+"""
+metrics.py
+
+Метрики бота в текстовом формате Prometheus (отдаются на GET /metrics, см. web_server).
+
+Счётчики и гистограммы обновляются без общих блокировок: у каждого потока свой шард значений
+(threading.local), поток пишет только в свой шард, а при выдаче /metrics шарды суммируются.
+Блокировка берётся один раз на поток — при создании его шарда. Гауджи ничего не хранят:
+значение считается функцией в момент выдачи.
+
+  - REQUESTS = Counter(name, documentation, labelnames)  # REQUESTS.labels('ludobot').inc()
+  - Histogram(name, documentation, labelnames, buckets)   # h.labels(...).observe(секунды); with h.time(): ...
+  - Gauge(name, documentation, func, labelnames)          # func() -> число или {значения меток: число}
+  - CounterFunc(...)                                      # то же, но счётчик, который уже ведётся в другом модуле
+  - render() -> str                                       # все метрики (text format 0.0.4)
+"""
+
+import bisect
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Секунды: от разбора лога (доли миллисекунды) до обучения RandomForest на длинной истории
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: Dict[str, '_Metric'] = {}
+
+
+class _Shards:
+    """size чисел, у каждого потока — свой список; читать — только через totals()"""
+
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        self._shards: List[list] = []
+        self._lock = threading.Lock()
+
+    def mine(self) -> list:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = [0] * self._size
+            with self._lock:
+                self._shards.append(values)
+            return values
+
+    def totals(self) -> list:
+        with self._lock:
+            shards = list(self._shards)
+        return [sum(column) for column in zip(*shards)] if shards else [0] * self._size
+
+
+class _CounterChild:
+    __slots__ = ('_shards',)
+
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount: float = 1):
+        self._shards.mine()[0] += amount
+
+    def samples(self, name: str, labels: str):
+        yield name, labels, self._shards.totals()[0]
+
+
+class _Timer:
+    __slots__ = ('_child', '_started')
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._started)
+
+
+class _HistogramChild:
+    __slots__ = ('_buckets', '_shards')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self._buckets = buckets
+        # Счётчик на каждую корзину (не накопительный), корзина +Inf и сумма значений
+        self._shards = _Shards(len(buckets) + 2)
+
+    def observe(self, value: float):
+        values = self._shards.mine()
+        values[bisect.bisect_left(self._buckets, value)] += 1
+        values[-1] += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+    def samples(self, name: str, labels: str):
+        totals = self._shards.totals()
+        prefix = labels[1:-1] + ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), totals):
+            cumulative += count
+            yield f"{name}_bucket", f'{{{prefix}le="{_format(bound)}"}}', cumulative
+        yield f"{name}_sum", labels, totals[-1]
+        yield f"{name}_count", labels, cumulative
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        _registry[name] = self
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        # Ключ — строки, как в выдаче: labels(1) и labels('1') — один и тот же ряд
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получено {values}")
+            child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, _labels(self.labelnames, values))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._children[()].inc(amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def time(self) -> _Timer:
+        return _Timer(self._children[()])
+
+
+class Gauge(_Metric):
+    """Значение считается при выдаче: func() -> число (без меток) или {кортеж значений меток: число}"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, func: Callable, labelnames: Sequence[str] = ()):
+        self._func = func
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry[name] = self
+
+    def samples(self):
+        value = self._func()
+        if not self.labelnames:
+            yield self.name, '', value
+            return
+        for values, number in value.items():
+            yield self.name, _labels(self.labelnames, values), number
+
+
+class CounterFunc(Gauge):
+    """Монотонный счётчик, который уже ведётся в другом модуле (например, SingleFlight.shared)"""
+    kind = 'counter'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Sequence) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)) + '}'
+
+
+def _format(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def render() -> str:
+    """Все зарегистрированные метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in list(_registry.values()):
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            # Одна сломанная функция гауджа не должна ломать весь /metrics
+            lines.append(f"# {metric.name}: {type(e).__name__}: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in samples:
+            lines.append(f"{name}{labels} {_format(value)}")
+    return '\n'.join(lines) + '\n'
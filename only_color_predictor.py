@@ -5,30 +5,63 @@ only_color_predictor.py
   - оценки моделей на ваших логах (адаптирован для малых и больших наборов данных)
   - быстрого получения предсказания цвета следующего броска из текста лога через predict_from_text(...)
 
-Запуск: Python 3.8+. Требует scikit-learn, pandas, numpy.
+Запуск: Python 3.8+. Требует scikit-learn, pandas, numpy (импортируются лениво — Markov и парсинг работают без них).
 
 Содержит:
+  - tokenize_spin_log(text)  # один проход по логу бота рулетки -> SpinLog(numbers, colors, rejected)
   - parse_numbers_from_text(text)
   - color_of(num)
-  - build_dataset(numbers, k)
-  - evaluate_models(numbers, max_k=MAX_K)
+  - build_feature_matrix(numbers, k)  # векторизованные признаки (NumPy)
+  - build_dataset(numbers, k)         # те же признаки в виде pd.DataFrame
+  - evaluate_models(numbers, max_k=MAX_K, refit_stride=1, n_jobs=None)  # walk-forward, параллельно по k × модель
   - train_and_get_predictor(numbers, k, model_name)
+  - MarkovState  # инкрементальная марковская модель (сохраняется по чатам, см. chat_history_manager)
+  - PredictorCache / predictor_cache / cache_stats()  # LRU-кэш обученных моделей по digest истории
+  - FlatForest  # RandomForest в виде массивов узлов для быстрого предсказания одной строки
   - predict_from_text(text, k, model_name, order='newest')  # удобная обёртка
+  - predict_next(numbers, k, model_name)  # обучение + предсказание одним вызовом (для пула процессов)
+  - predict_next_timed(numbers, k, model_name)  # то же + время обучения/предсказания (для метрик)
+  - predict_many(histories, models, ks)   # пакетные предсказания по чатам × моделям × k
 
 Примеры использования приведены в блоке __main__.
 """
 
+import os
 import re
-import numpy as np
-import pandas as pd
+import time
+import hashlib
+import logging
+from array import array
+from collections import OrderedDict
+from typing import NamedTuple
+from concurrent.futures import ProcessPoolExecutor
 from collections import Counter
-from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import LabelEncoder
+
+logger = logging.getLogger(__name__)
+
+# Тяжёлые библиотеки (numpy, pandas, sklearn) импортируются лениво — при первом использовании модели,
+# которой они нужны (см. _load_numpy / load_ml_libraries). Парсинг и Markov работают без них.
+np = None
+pd = None
+sliding_window_view = None
+LogisticRegression = None
+RandomForestClassifier = None
+LabelEncoder = None
 
 # RED set (европейская/стандартная раскраска рулетки)
 RED = {1,3,5,7,9,12,14,16,18,19,21,23,25,27,30,32,34,36}
 
+# Коды цветов для векторизованных признаков: код = индекс в COLOR_NAMES
+COLOR_NAMES = ('красное', 'чёрное', 'зелёное')
+COLOR_CODES = {name: code for code, name in enumerate(COLOR_NAMES)}
+# Таблицы подстановки число -> код цвета / дюжина (parse_numbers_from_text допускает числа 0..99)
+COLOR_CODE_OF = [COLOR_CODES['зелёное']] + [COLOR_CODES['красное'] if x in RED else COLOR_CODES['чёрное']
+                                           for x in range(1, 100)]
+DOZEN_OF = [3 if x == 0 else ((x - 1) // 12) for x in range(100)]
+# NumPy-версии таблиц создаются в _load_numpy()
+COLOR_LUT = None
+DOZEN_LUT = None
+
 # ---- КОНФИГУРАЦИЯ ----
 
 # - LAST_LOG_TEXT: вставьте ваш лог как в примере ниже (можно использовать многострочную строку).
@@ -71,6 +104,13 @@ MODEL = 'RF'
 # Максимально допустимое значение k (удобно менять в одном месте)
 MAX_K = 4
 
+# Ограничения кэша обученных моделей (см. PredictorCache)
+PREDICTOR_CACHE_MAX_ENTRIES = 128
+PREDICTOR_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# RF: предсказание по "расплющенному" лесу (FlatForest) вместо clf.predict_proba — без валидации sklearn и joblib
+RF_FLAT_INFERENCE = True
+
 # --- Описания моделей и рекомендации по размерам лога / выбору k ---
 MODEL_DESCRIPTIONS = {
     'Markov': {
@@ -88,6 +128,40 @@ MODEL_DESCRIPTIONS = {
 }
 
 
+def _load_numpy():
+    """Импортирует NumPy и строит таблицы подстановки (один раз)"""
+    global np, sliding_window_view, COLOR_LUT, DOZEN_LUT
+    if np is None:
+        started = time.perf_counter()
+        import numpy
+        from numpy.lib.stride_tricks import sliding_window_view as _sliding_window_view
+        sliding_window_view = _sliding_window_view
+        COLOR_LUT = numpy.array(COLOR_CODE_OF, dtype=numpy.int8)
+        DOZEN_LUT = numpy.array(DOZEN_OF, dtype=numpy.int8)
+        np = numpy
+        logger.info(f"numpy импортирован за {(time.perf_counter() - started) * 1000:.0f} мс")
+    return np
+
+
+def load_ml_libraries():
+    """Импортирует numpy, pandas и sklearn (один раз). Вызывается лениво из моделей Logistic/RF,
+    а также заранее в воркерах пула (inference_executor), чтобы первый запрос не ждал импорт.
+    """
+    global pd, LogisticRegression, RandomForestClassifier, LabelEncoder
+    _load_numpy()
+    if pd is None:
+        started = time.perf_counter()
+        import pandas
+        from sklearn.linear_model import LogisticRegression as _LogisticRegression
+        from sklearn.ensemble import RandomForestClassifier as _RandomForestClassifier
+        from sklearn.preprocessing import LabelEncoder as _LabelEncoder
+        LogisticRegression = _LogisticRegression
+        RandomForestClassifier = _RandomForestClassifier
+        LabelEncoder = _LabelEncoder
+        pd = pandas
+        logger.info(f"pandas/sklearn импортированы за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
 def color_of(num: int) -> str:
     """Возвращает цвета и "обучает" моделей на русском: 'красное' / 'чёрное' / 'зелёное'."""
     if num == 0:
@@ -95,200 +169,644 @@ def color_of(num: int) -> str:
     return "красное" if num in RED else "чёрное"
 
 
+# Строка лога бота рулетки: "— 22 (⚫️ Чёрное)"; группы — число и подпись цвета
+SPIN_LINE_RE = re.compile(r'^[ \t]*—[ \t]*(\d+)[ \t]*\(([^)\n]*)\)', re.MULTILINE)
+NUMBER_RE = re.compile(r'\b(?:0|[1-9][0-9]?)\b')
+# Ключевые слова подписи -> код цвета
+LABEL_KEYWORDS = (('красн', COLOR_CODES['красное']), ('чёрн', COLOR_CODES['чёрное']),
+                  ('черн', COLOR_CODES['чёрное']), ('зел', COLOR_CODES['зелёное']))
+# Строки лога повторяются (37 чисел × 3 подписи), поэтому разбор пары (число, подпись) кэшируется:
+# (число, код цвета) или None для отклонённой строки
+_spin_cache = {}
+_SPIN_CACHE_LIMIT = 4096
+
+
+class SpinLog(NamedTuple):
+    """Броски из лога рулетки в порядке текста (newest-first); iter() даёт пары (число, код цвета)"""
+    numbers: array   # array('B') чисел 0..36
+    colors: bytes    # коды цветов (индексы COLOR_NAMES) тех же бросков
+    rejected: int    # строки "— N (...)" с числом вне 0..36 или цветом, не совпадающим с RED
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        return zip(self.numbers, self.colors)
+
+
+def _parse_spin(number_text: str, label: str):
+    """(число, код цвета) для строки лога или None, если число вне 0..36 или подпись противоречит RED"""
+    number = int(number_text)
+    if number > 36:
+        return None
+    code = COLOR_CODE_OF[number]
+    lowered = label.lower()
+    label_code = next((c for word, c in LABEL_KEYWORDS if word in lowered), None)
+    if label_code is not None and label_code != code:  # подпись без цвета принимается
+        return None
+    return number, code
+
+
+def tokenize_spin_log(text: str) -> SpinLog:
+    """Разбирает лог бота рулетки за один проход скомпилированным выражением.
+
+    Каждая строка вида "— N (подпись)" проверяется: число должно быть 0..36, а цвет из подписи —
+    совпадать с цветом числа по RED. Неподходящие строки пропускаются и считаются в rejected,
+    прочий текст игнорируется.
+    """
+    numbers = array('B')
+    colors = bytearray()
+    rejected = 0
+    cached = _spin_cache.get
+    for pair in SPIN_LINE_RE.findall(text):
+        spin = cached(pair, False)
+        if spin is False:
+            spin = _parse_spin(*pair)
+            if len(_spin_cache) < _SPIN_CACHE_LIMIT:
+                _spin_cache[pair] = spin
+        if spin is None:
+            rejected += 1
+            continue
+        numbers.append(spin[0])
+        colors.append(spin[1])
+    return SpinLog(numbers, bytes(colors), rejected)
+
+
 def parse_numbers_from_text(text: str) -> list:
     """Парсит последовательность чисел (0..99) из текста.
     Возвращает список int в том же порядке, что и в тексте.
-    Работает корректно с EM-DASH (—) и unicode-символами.
+    Лог бота рулетки ("— N (цвет)") разбирается tokenize_spin_log; если таких строк нет,
+    берутся все числа 0..99 подряд. Работает корректно с EM-DASH (—) и unicode-символами.
+    """
+    spins = tokenize_spin_log(text)
+    if spins.numbers or spins.rejected:
+        return spins.numbers.tolist()
+    return [int(n) for n in NUMBER_RE.findall(text)]
+
+
+def feature_columns(k):
+    """Имена признаков для данного k в том порядке, в котором они лежат в матрице"""
+    return [f'num_l{i+1}' for i in range(k)] + [f'dozen_l{i+1}' for i in range(k)] + ['run_len_last_color']
+
+
+def _tail_run_lengths(codes):
+    """Длина серии одинаковых цветов, заканчивающейся в каждой позиции (по возрастанию индекса)"""
+    n = len(codes)
+    idx = np.arange(n)
+    change = np.empty(n, dtype=bool)
+    change[:1] = True
+    np.not_equal(codes[1:], codes[:-1], out=change[1:])
+    starts = np.maximum.accumulate(np.where(change, idx, 0))
+    return idx - starts + 1
+
+
+class FeatureBlock:
+    """Признаки сразу для всех k <= k_max: одна матрица с k_max лагами, из которой вырезаются меньшие k.
+
+    Строка t (k_min <= t < N) содержит numbers[t-1], ..., numbers[t-k_max] (недоступные лаги заполнены нулями,
+    для k <= t они в срез не попадают), дюжины этих чисел и длину хвостовой серии без ограничения по k.
     """
-    nums = re.findall(r'\b(?:0|[1-9][0-9]?)\b', text)
-    return [int(n) for n in nums]
+
+    def __init__(self, numbers, k_max, k_min=1):
+        _load_numpy()
+        arr = np.asarray(numbers, dtype=np.intp)
+        N = len(arr)
+        self.k_max = k_max
+        self.k_min = k_min
+        n_rows = max(0, N - k_min)
+        self.matrix = np.empty((n_rows, 2 * k_max + 1), dtype=np.float64)
+        self.colors = COLOR_LUT[arr]
+        if n_rows == 0:
+            return
+        # padded[j + k_max] = numbers[j]; окно t = padded[t:t+k_max], развёрнутое -> numbers[t-1-i]
+        padded = np.concatenate([np.zeros(k_max, dtype=np.intp), arr])
+        lags = sliding_window_view(padded[:k_max + N - 1], k_max)[k_min:N, ::-1]
+        self.matrix[:, :k_max] = lags
+        self.matrix[:, k_max:2 * k_max] = DOZEN_LUT[lags]
+        self.matrix[:, 2 * k_max] = _tail_run_lengths(self.colors)[k_min - 1:N - 1]
+
+    def features(self, k):
+        """(X, y) для данного k — как build_feature_matrix(numbers, k), без повторного построения"""
+        if not self.k_min <= k <= self.k_max:
+            raise ValueError(f"FeatureBlock построен для k={self.k_min}..{self.k_max}, запрошено k={k}")
+        cols = list(range(k)) + list(range(self.k_max, self.k_max + k)) + [2 * self.k_max]
+        rows = self.matrix[k - self.k_min:]
+        X = np.empty((len(rows), 2 * k + 1), dtype=np.float64)  # новая C-contiguous матрица
+        np.take(rows, cols, axis=1, out=X)
+        # длина хвостовой серии внутри окна не может превышать k
+        np.minimum(X[:, 2 * k], k, out=X[:, 2 * k])
+        return X, self.colors[k:]
+
+
+def build_feature_matrix(numbers, k):
+    """Векторизованная версия build_dataset.
+
+    numbers: последовательность int (newest-first, index 0 = последний бросок) или np.ndarray.
+    Возвращает кортеж (X, y):
+      X — C-contiguous float64 матрица (N-k, 2k+1) с колонками feature_columns(k)
+          (num_l* без нормировки, dozen_l*, run_len_last_color);
+      y — int8 коды цвета таргета (индексы в COLOR_NAMES).
+    """
+    return FeatureBlock(numbers, k, k_min=k).features(k)
 
 
 def build_dataset(numbers, k):
     """Строит таблицу признаков для прогноза цвета следующего броска.
     numbers: list интов, ожидается порядок newest-first (index 0 = последний бросок).
     k: число последних бросков, которые используются как признаки.
-    Возвращает pd.DataFrame.
+    Возвращает pd.DataFrame (обёртка над build_feature_matrix).
     """
-    N = len(numbers)
-    rows = []
-    for t in range(k, N):
-        prev = numbers[t-k:t]
-        target = numbers[t]
-        prev_colors = [color_of(x) for x in prev]
-        prev_dozen = [3 if x == 0 else ((x - 1) // 12) for x in prev]
-        # run of last color in the prev sequence (tail run length)
-        run = 1
-        last_color = prev_colors[-1]
-        for j in range(len(prev_colors) - 2, -1, -1):
-            if prev_colors[j] == last_color:
-                run += 1
-            else:
-                break
-        row = {f'num_l{i+1}': prev[-(i+1)] for i in range(k)}
-        row.update({f'dozen_l{i+1}': prev_dozen[-(i+1)] for i in range(k)})
-        row['run_len_last_color'] = run
-        row['target_color'] = color_of(target)
-        rows.append(row)
-    df = pd.DataFrame(rows)
-    # Если df пустой — вернём пустой датафрейм с правильными колонками
-    if df.empty:
-        cols = [f'num_l{i+1}' for i in range(k)] + [f'dozen_l{i+1}' for i in range(k)] + ['run_len_last_color', 'target_color']
-        return pd.DataFrame(columns=cols)
+    load_ml_libraries()
+    X, y = build_feature_matrix(numbers, k)
+    cols = feature_columns(k)
+    df = pd.DataFrame(X.astype(np.int64), columns=cols)
+    df['target_color'] = np.array(COLOR_NAMES, dtype=object)[y]
     return df
 
 
-def evaluate_models(numbers, max_k=MAX_K):
+# Модели, которые участвуют в оценке evaluate_models (порядок колонок результата)
+EVAL_MODELS = ('Markov', 'Logistic', 'RF')
+# Ниже этого числа строк сетка k × модель считается последовательно — запуск процессов дороже самой оценки
+EVAL_PARALLEL_MIN_ROWS = 500
+
+# Кодирование цветов для sklearn — как у LabelEncoder (алфавитный порядок имён), чтобы ничьи разрешались одинаково
+_SORTED_COLOR_NAMES = sorted(COLOR_NAMES)
+_CODE_TO_LABEL_OF = [_SORTED_COLOR_NAMES.index(name) for name in COLOR_NAMES]
+
+
+def _evaluate_cell(numbers, k, model_name, refit_stride=1):
+    """Walk-forward оценка одной модели для одного k.
+
+    Возвращает кортеж (средняя точность или NaN, время в секундах).
+    """
+    started = time.perf_counter()
+    load_ml_libraries()
+    X, y_codes = build_feature_matrix(numbers, k)
+    N = len(X)
+    # Минимальный стартовой размер обучающего множества — 5 строк или 10% от N
+    train_start = max(5, int(0.1 * N))
+    if N == 0 or train_start >= N:
+        # Не получается сделать ни одной итерации обучения/тестирования
+        return np.nan, time.perf_counter() - started
+    step = max(1, int(max(1, N // 10)))  # шаг итерации — при малых N =1, при больших ~N/10
+    scores = []
+
+    if model_name == 'Markov':
+        # частотный по последовательностям цветов; счётчики накапливаются инкрементально
+        colors = COLOR_LUT[np.asarray(numbers, dtype=np.intp)]
+        keys = [row.tobytes() for row in sliding_window_view(colors[:len(colors) - 1], k)]
+        freq = {}
+        target_counts = Counter()
+        counted = 0
+        for i in range(train_start, N, step):
+            for key, nxt in zip(keys[counted:i], y_codes[counted:i]):
+                freq.setdefault(key, Counter())[nxt] += 1
+                target_counts[nxt] += 1
+            counted = i
+            cell = freq.get(keys[i])
+            pred = cell.most_common(1)[0][0] if cell else target_counts.most_common(1)[0][0]
+            scores.append(1 if pred == y_codes[i] else 0)
+    else:
+        X[:, :k] /= 36.0
+        y = np.array(_CODE_TO_LABEL_OF, dtype=np.int8)[y_codes]  # кодируем метки один раз, а не на каждом шаге
+        model = None
+        n_classes = 0
+        for n_step, i in enumerate(range(train_start, N, step)):
+            try:
+                seen = len(np.unique(y[:i]))
+                if model is None or seen != n_classes or n_step % refit_stride == 0:
+                    if model_name == 'Logistic':
+                        # refit_stride=1 — холодное обучение на каждом шаге (точности как у исходной оценки).
+                        # При редком переобучении warm start продолжает оптимизацию с прошлых коэффициентов
+                        # (результат зависит от прошлого решения); при появлении нового класса форма
+                        # коэффициентов меняется — начинаем заново
+                        if refit_stride == 1 or model is None or seen != n_classes:
+                            model = LogisticRegression(max_iter=400, warm_start=refit_stride > 1)
+                    else:
+                        model = RandomForestClassifier(n_estimators=80, random_state=42)
+                    n_classes = seen
+                    model.fit(X[:i], y[:i])
+                yp = model.predict(X[i:i+1])[0]
+                scores.append(1 if yp == y[i] else 0)
+            except Exception:
+                # на малых данных возможны ошибки — считаем как NaN (не учитываем)
+                model = None
+    score = np.nan if len(scores) == 0 else np.mean(scores)
+    return score, time.perf_counter() - started
+
+
+def evaluate_models(numbers, max_k=MAX_K, refit_stride=1, n_jobs=None):
     """Оценка моделей на данных numbers для разных k (1..max_k).
 
     Подход: расширяющееся окно (time-series style) — последовательно обучаем на первых i строках
     и тестируем на i+1 (как в оригинале), но пороги уменьшены, чтобы работать и на малых N.
 
-    Возвращает pd.DataFrame с усреднёнными точностями для каждой модели по k.
+    refit_stride: Logistic/RF переобучаются раз в refit_stride шагов окна (1 — на каждом шаге, с нуля:
+                  точности совпадают с исходной оценкой); между переобучениями прогноз делает последняя
+                  обученная модель, а Logistic дообучается warm start — точности могут немного отличаться.
+    n_jobs: число процессов для сетки k × модель; None — по числу ядер, если данных достаточно
+            (см. EVAL_PARALLEL_MIN_ROWS), 1 — последовательно.
+
+    Возвращает pd.DataFrame с усреднёнными точностями для каждой модели по k
+    и временем расчёта каждой ячейки в колонках '<модель>_sec'.
     """
-    results = []
-    for k in range(1, max_k + 1):
-        data = build_dataset(numbers, k)
-        if data.empty:
-            results.append({'k': k, 'Markov': np.nan, 'Logistic': np.nan, 'RF': np.nan})
-            continue
-        X = data[[f'num_l{i+1}' for i in range(k)] + [f'dozen_l{i+1}' for i in range(k)] + ['run_len_last_color']].copy()
-        for col in [f'num_l{i+1}' for i in range(k)]:
-            X[col] = X[col] / 36.0
-        y = data['target_color'].values
-        le = LabelEncoder(); le.fit(y)
-        N = len(X)
-        # Минимальный стартовой размер обучающего множества — 5 строк или 10% от N
-        train_start = max(5, int(0.1 * N))
-        if train_start >= N:
-            # Не получается сделать ни одной итерации обучения/тестирования
-            results.append({'k': k, 'Markov': np.nan, 'Logistic': np.nan, 'RF': np.nan})
-            continue
-        step = max(1, int(max(1, N // 10)))  # шаг итерации — при малых N =1, при больших ~N/10
-        models = {'Markov': None,
-                  'Logistic': LogisticRegression(max_iter=400),
-                  'RF': RandomForestClassifier(n_estimators=80, random_state=42)}
-        scores = {name: [] for name in models}
-        # подготовить цветовые последовательности для Markov
-        color_seq = []
-        for idx in range(k, k + len(data)):
-            prev_nums = numbers[idx-k:idx]
-            color_seq.append([color_of(x) for x in prev_nums])
-        # expanding-window evaluation
-        for i in range(train_start, N, step):
-            X_train = X.iloc[:i]; y_train = y[:i]
-            X_test = X.iloc[i:i+1]; y_test = y[i]
-            # Markov: частотный по последовательностям цветов
-            freq = {}
-            for seq, nxt in zip(color_seq[:i], y[:i]):
-                freq.setdefault(tuple(seq), Counter())[nxt] += 1
-            last_key = tuple(color_seq[i])
-            if last_key in freq:
-                pred_markov = freq[last_key].most_common(1)[0][0]
+    load_ml_libraries()
+    numbers = list(numbers)
+    cells = [(k, name) for k in range(1, max_k + 1) for name in EVAL_MODELS]
+    if n_jobs is None:
+        n_jobs = (os.cpu_count() or 1) if len(numbers) >= EVAL_PARALLEL_MIN_ROWS else 1
+    n_jobs = max(1, min(n_jobs, len(cells)))
+
+    args = ([numbers] * len(cells), [k for k, _ in cells], [name for _, name in cells],
+            [refit_stride] * len(cells))
+    if n_jobs == 1:
+        outcomes = list(map(_evaluate_cell, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            outcomes = list(executor.map(_evaluate_cell, *args))
+
+    rows = {k: {'k': k} for k in range(1, max_k + 1)}
+    for (k, name), (score, seconds) in zip(cells, outcomes):
+        rows[k][name] = score
+        rows[k][f'{name}_sec'] = seconds
+    columns = ['k', *EVAL_MODELS, *(f'{name}_sec' for name in EVAL_MODELS)]
+    return pd.DataFrame(list(rows.values()), columns=columns).set_index('k')
+
+
+class MarkovState:
+    """Инкрементальная марковская модель по цветам (та же, что ветка 'Markov' в train_and_get_predictor).
+
+    Хранит частоты сразу для нескольких k (orders). Вместо пересчёта с нуля на каждый запрос
+    принимает только новые броски (advance), а вышедшие за пределы истории броски вычитает.
+    Предсказание — поиск в словаре, O(1). Состояние сериализуется в компактный dict (to_dict/from_dict).
+
+    Обучающие пары такие же, как в build_dataset: для numbers (newest-first) пара idx (k <= idx < N) —
+    ключ = цвета numbers[idx-k:idx], таргет = цвет numbers[idx].
+    Для каждого цвета хранится [count, stamp], где stamp — абсолютный номер самого свежего таргета;
+    при равных count побеждает более свежий цвет — ровно так Counter.most_common разрешает ничьи
+    в пакетной версии.
+    """
+
+    def __init__(self, orders=None):
+        self.orders = tuple(sorted(orders)) if orders else tuple(range(1, MAX_K + 1))
+        self.reset()
+
+    def reset(self):
+        self.freq = {k: {} for k in self.orders}    # k -> {ключ (коды цветов): {код: [count, stamp]}}
+        self.totals = {k: {} for k in self.orders}  # k -> {код: [count, stamp]} по всем таргетам
+        self.head = []    # коды цветов последних max(orders) бросков, newest-first
+        self.length = 0   # сколько бросков истории учтено
+        self.total = 0    # сколько бросков добавлено за всё время (для stamp)
+
+    def rebuild(self, numbers):
+        """Пересчитывает состояние с нуля по истории numbers (newest-first)"""
+        self.reset()
+        self.advance(numbers, len(numbers))
+
+    def advance(self, numbers, n_new, keep=None):
+        """Учитывает n_new новых бросков.
+
+        numbers: вся история newest-first после добавления новых бросков в начало, но до обрезки;
+                 numbers[n_new:] должна совпадать с уже учтённой историей.
+        keep: длина, до которой история обрезается после добавления (None — без обрезки).
+        """
+        N = len(numbers)
+        if N - n_new != self.length:
+            raise ValueError(f"MarkovState: учтено {self.length} бросков, а передано {N - n_new}")
+        keep = N if keep is None else min(keep, N)
+        new_total = self.total + n_new
+
+        for k in self.orders:
+            # новые пары: окно содержит хотя бы один новый бросок, таргет остаётся в истории
+            for idx in range(k, min(n_new + k, keep)):
+                self._count(k, numbers, idx, new_total - 1 - idx, 1)
+            # удалённые пары: таргет вышел за пределы keep
+            for idx in range(max(keep, n_new + k), N):
+                self._count(k, numbers, idx, 0, -1)
+
+        self.head = [COLOR_CODE_OF[x] for x in numbers[:min(self.orders[-1], keep)]]
+        self.length = keep
+        self.total = new_total
+
+    def _count(self, k, numbers, idx, stamp, delta):
+        key = tuple(COLOR_CODE_OF[x] for x in numbers[idx-k:idx])
+        target = COLOR_CODE_OF[numbers[idx]]
+        cell = self.freq[k].setdefault(key, {})
+        self._bump(cell, target, stamp, delta)
+        if not cell:
+            del self.freq[k][key]
+        self._bump(self.totals[k], target, stamp, delta)
+
+    @staticmethod
+    def _bump(cell, code, stamp, delta):
+        entry = cell.get(code)
+        if delta > 0:
+            if entry is None:
+                cell[code] = [1, stamp]
             else:
-                pred_markov = Counter(y_train).most_common(1)[0][0]
-            scores['Markov'].append(1 if pred_markov == y_test else 0)
-            # Logistic & RF
-            for name, model in list(models.items())[1:]:
-                try:
-                    model.fit(X_train, le.transform(y_train))
-                    yp = model.predict(X_test)[0]
-                    scores[name].append(1 if yp == le.transform([y_test])[0] else 0)
-                except Exception:
-                    # на малых данных возможны ошибки — считаем как NaN (не учитываем)
-                    pass
-        avg_scores = {name: np.nan if len(vals) == 0 else np.mean(vals) for name, vals in scores.items()}
-        results.append({'k': k, **avg_scores})
-    return pd.DataFrame(results).set_index('k')
-
-
-def train_and_get_predictor(numbers, k, model_name):
+                entry[0] += 1
+                entry[1] = max(entry[1], stamp)
+        else:
+            entry[0] -= 1
+            if entry[0] == 0:
+                del cell[code]
+
+    @staticmethod
+    def _ranked(cell):
+        return sorted(cell.items(), key=lambda item: (-item[1][0], -item[1][1]))
+
+    def predict(self, k, latest_prev_newest_first=None):
+        """Предсказывает цвет следующего броска.
+        latest_prev_newest_first: последние броски newest-first; по умолчанию — голова учтённой истории.
+        Возвращает кортеж (predicted_color, {цвет: count}).
+        """
+        if k not in self.freq:
+            raise ValueError(f"MarkovState не содержит порядок k={k} (есть: {self.orders})")
+        if self.length < k + 1:
+            raise ValueError("Недостаточно данных для построения признаков: data is empty")
+        if latest_prev_newest_first is None:
+            codes = self.head[:k]
+        else:
+            codes = [COLOR_CODE_OF[x] for x in latest_prev_newest_first[:k]]
+        cell = self.freq[k].get(tuple(reversed(codes)))
+        if cell:
+            ranked = self._ranked(cell)
+            return COLOR_NAMES[ranked[0][0]], {COLOR_NAMES[c]: cnt for c, (cnt, _) in cell.items()}
+        ranked = self._ranked(self.totals[k])[:3]
+        return COLOR_NAMES[ranked[0][0]], {COLOR_NAMES[c]: cnt for c, (cnt, _) in ranked}
+
+    @staticmethod
+    def _pack(cell):
+        flat = [0, -1] * len(COLOR_NAMES)
+        for code, (cnt, stamp) in cell.items():
+            flat[2 * code] = cnt
+            flat[2 * code + 1] = stamp
+        return flat
+
+    @staticmethod
+    def _unpack(flat):
+        return {code: [flat[2 * code], flat[2 * code + 1]]
+                for code in range(len(COLOR_NAMES)) if flat[2 * code] > 0}
+
+    def to_dict(self):
+        """Компактное JSON-совместимое представление: ключи — строки кодов цветов, значения — [count, stamp] * 3"""
+        return {
+            'orders': list(self.orders),
+            'length': self.length,
+            'total': self.total,
+            'head': ''.join(map(str, self.head)),
+            'freq': {str(k): {''.join(map(str, key)): self._pack(cell) for key, cell in table.items()}
+                     for k, table in self.freq.items()},
+            'totals': {str(k): self._pack(cell) for k, cell in self.totals.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls(orders=data['orders'])
+        state.length = data['length']
+        state.total = data['total']
+        state.head = [int(c) for c in data['head']]
+        for k in state.orders:
+            state.freq[k] = {tuple(int(c) for c in key): cls._unpack(flat)
+                             for key, flat in data['freq'][str(k)].items()}
+            state.totals[k] = cls._unpack(data['totals'][str(k)])
+        return state
+
+
+def history_digest(numbers) -> str:
+    """Content-hash последовательности чисел (0..99): одинаковая история -> одинаковый digest"""
+    if hasattr(numbers, 'astype'):  # np.ndarray
+        data = numbers.astype('uint8').tobytes()
+    else:
+        data = bytes(numbers)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class PredictorCache:
+    """LRU-кэш обученных моделей: ключ (digest истории, k, model_name) -> (predictor, clf).
+
+    Вытеснение — по количеству записей и по суммарному (оценочному) размеру моделей.
+    Счётчики hits/misses/evictions доступны через stats().
+    """
+
+    def __init__(self, max_entries=PREDICTOR_CACHE_MAX_ENTRIES, max_bytes=PREDICTOR_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+predictor_cache = PredictorCache()
+
+
+def cache_stats() -> dict:
+    """Статистика predictor_cache текущего процесса (функция уровня модуля — можно вызывать в воркерах пула)"""
+    return predictor_cache.stats()
+
+
+TREE_NODE_BYTES = 64  # Узел дерева sklearn (дети, признак, порог, impurity, число образцов) без value
+MODEL_OVERHEAD_BYTES = 1024  # Объект модели, параметры, LabelEncoder
+
+
+def _estimate_model_nbytes(clf, numbers) -> int:
+    """Оценка памяти, занимаемой обученной моделью (для вытеснения из кэша).
+
+    Считается по размерам массивов, без сериализации: pickle.dumps леса на каждом промахе кэша
+    занимал десятки миллисекунд — дольше самого предсказания.
+    """
+    if clf is None:
+        # Markov: число ключей ограничено числом обучающих пар
+        return 64 * (len(numbers) + 1)
+    if hasattr(clf, 'estimators_'):
+        # RF: узлы всех деревьев + value (вероятности классов) в каждом узле
+        node_bytes = TREE_NODE_BYTES + 8 * clf.n_outputs_ * int(np.max(clf.n_classes_))
+        return MODEL_OVERHEAD_BYTES + node_bytes * sum(est.tree_.node_count for est in clf.estimators_)
+    # Logistic: коэффициенты и свободные члены
+    return MODEL_OVERHEAD_BYTES + sum(getattr(clf, name).nbytes for name in ('coef_', 'intercept_', 'classes_')
+                                      if hasattr(clf, name))
+
+
+def train_and_get_predictor(numbers, k, model_name, use_cache=True, features=None, digest=None):
     """Обучает модель на всех доступных данных и возвращает функцию-predictor(latest_prev_newest_first).
 
+    Результат кэшируется в predictor_cache по (digest истории, k, model_name): повторный запрос
+    на ту же историю не обучает модель заново. use_cache=False — всегда обучать.
+    features: необязательная функция k -> (X, y) с готовыми признаками (см. FeatureBlock, predict_many).
+    digest: уже посчитанный history_digest(numbers).
+    Возвращает кортеж (predictor, clf); для Markov clf = None.
+    """
+    if not use_cache:
+        return _train_predictor(numbers, k, model_name, features)
+    key = (digest or history_digest(numbers), k, model_name)
+    cached = predictor_cache.get(key)
+    if cached is not None:
+        return cached
+    result = _train_predictor(numbers, k, model_name, features)
+    predictor_cache.put(key, result, _estimate_model_nbytes(result[1], numbers))
+    return result
+
+
+def _train_predictor(numbers, k, model_name, features=None):
+    """Обучает модель на всех доступных данных (без кэша) и возвращает функцию-predictor(latest_prev_newest_first).
+
     model_name: 'Markov', 'Logistic' или 'RF'
     numbers: list int newest-first
+    features: необязательная функция k -> (X, y); по умолчанию build_feature_matrix.
     predictor принимает аргумент latest_prev_newest_first — список, где index 0 = последний бросок.
     """
-    data = build_dataset(numbers, k)
-    if data.empty:
+    if len(numbers) <= k:
         raise ValueError("Недостаточно данных для построения признаков: data is empty")
-    X = data[[f'num_l{i+1}' for i in range(k)] + [f'dozen_l{i+1}' for i in range(k)] + ['run_len_last_color']].copy()
-    for col in [f'num_l{i+1}' for i in range(k)]:
-        X[col] = X[col] / 36.0
-    y = data['target_color'].values
-    le = LabelEncoder(); le.fit(y)
-
-    # сохранём имена колонок, чтобы в predict передавать DataFrame с теми же именами
-    feature_columns = X.columns.tolist()
 
     if model_name == 'Markov':
-        freq = {}
-        color_seq = []
-        for idx in range(k, k + len(data)):
-            prev_nums = numbers[idx-k:idx]
-            color_seq.append([color_of(x) for x in prev_nums])
-        for seq, nxt in zip(color_seq, y):
-            freq.setdefault(tuple(seq), Counter())[nxt] += 1
+        # Markov не нуждается в матрице признаков — считаем частоты напрямую
+        state = MarkovState(orders=[k])
+        state.rebuild(numbers)
 
         def predictor(latest_prev_newest_first):
             # latest_prev_newest_first: newest-first (index 0 = last result)
-            prev = list(reversed(latest_prev_newest_first[:k]))
-            key = tuple([color_of(x) for x in prev])
-            if key in freq:
-                most = freq[key].most_common(1)[0]
-                return most[0], {c: cnt for c, cnt in freq[key].items()}
-            else:
-                top = Counter(y).most_common(3)
-                return top[0][0], {c: cnt for c, cnt in top}
+            return state.predict(k, latest_prev_newest_first)
 
         return predictor, None
 
-    elif model_name == 'Logistic':
+    load_ml_libraries()
+    X, y_codes = features(k) if features is not None else build_feature_matrix(numbers, k)
+    X[:, :k] /= 36.0
+    y = np.array(COLOR_NAMES, dtype=object)[y_codes]
+    le = LabelEncoder(); le.fit(y)
+
+    if model_name == 'Logistic':
         clf = LogisticRegression(max_iter=400)
         clf.fit(X, le.transform(y))
-
-        def predictor(latest_prev_newest_first):
-            prev = latest_prev_newest_first[:k]
-            num_feats = [prev[i] / 36.0 for i in range(k)]
-            dozen_feats = [3 if prev[i] == 0 else ((prev[i] - 1) // 12) for i in range(k)]
-            prev_colors = [color_of(x) for x in reversed(prev)]
-            run = 1
-            for j in range(len(prev_colors) - 2, -1, -1):
-                if prev_colors[j] == prev_colors[-1]:
-                    run += 1
-                else:
-                    break
-            feat = np.array(num_feats + dozen_feats + [run]).reshape(1, -1)
-            # создать DataFrame с теми же именами признаков — тогда sklearn не будет ругаться
-            feat_df = pd.DataFrame(feat, columns=feature_columns)
-            p_idx = clf.predict(feat_df)[0]
-            probs = {le.inverse_transform([i])[0]: prob for i, prob in enumerate(clf.predict_proba(feat_df)[0])}
-            return le.inverse_transform([p_idx])[0], probs
-
-        return predictor, clf
+        return _make_predictor(clf.predict_proba, le, k), clf
 
     else:
         clf = RandomForestClassifier(n_estimators=100, random_state=42)
         clf.fit(X, le.transform(y))
+        if RF_FLAT_INFERENCE:
+            flat = FlatForest(clf)
+            return _make_predictor(flat.predict_proba, le, k), clf
+        return _make_predictor(clf.predict_proba, le, k), clf
+
+
+def _fill_features(buf, prev, k):
+    """Заполняет строку признаков (как в build_feature_matrix) для prev = последние k бросков newest-first"""
+    for i in range(k):
+        buf[i] = prev[i] / 36.0
+        buf[k + i] = DOZEN_OF[prev[i]]
+    # run: сколько бросков подряд, начиная с самого свежего, того же цвета
+    first = COLOR_CODE_OF[prev[0]]
+    run = 1
+    for x in prev[1:k]:
+        if COLOR_CODE_OF[x] != first:
+            break
+        run += 1
+    buf[2 * k] = run
+
+
+def _make_predictor(predict_proba, le, k):
+    """Predictor для Logistic/RF: заполняет заранее выделенный буфер признаков, один раз вызывает
+    predict_proba и берёт argmax из полученных вероятностей (без pd.DataFrame и clf.predict).
+    """
+    feat = np.empty((1, 2 * k + 1), dtype=np.float64)
+    row = feat[0]
+    class_names = [str(name) for name in le.classes_]
 
-        def predictor(latest_prev_newest_first):
-            prev = latest_prev_newest_first[:k]
-            num_feats = [prev[i] / 36.0 for i in range(k)]
-            dozen_feats = [3 if prev[i] == 0 else ((prev[i] - 1) // 12) for i in range(k)]
-            prev_colors = [color_of(x) for x in reversed(prev)]
-            run = 1
-            for j in range(len(prev_colors) - 2, -1, -1):
-                if prev_colors[j] == prev_colors[-1]:
-                    run += 1
-                else:
-                    break
-            feat = np.array(num_feats + dozen_feats + [run]).reshape(1, -1)
-            feat_df = pd.DataFrame(feat, columns=feature_columns)
-            p_idx = clf.predict(feat_df)[0]
-            probs = {le.inverse_transform([i])[0]: prob for i, prob in enumerate(clf.predict_proba(feat_df)[0])}
-            return le.inverse_transform([p_idx])[0], probs
+    def predictor(latest_prev_newest_first):
+        _fill_features(row, latest_prev_newest_first[:k], k)
+        proba = predict_proba(feat)[0]
+        probs = {name: float(p) for name, p in zip(class_names, proba)}
+        return class_names[int(np.argmax(proba))], probs
+
+    return predictor
 
-        return predictor, clf
+
+class FlatForest:
+    """RandomForestClassifier, разложенный в плоские таблицы узлов (left/right/feature/threshold/proba).
+
+    Позволяет получить вероятности для одной строки простым обходом деревьев, минуя проверку входа,
+    joblib и выделение массивов внутри sklearn. Результат совпадает с clf.predict_proba.
+    """
+
+    def __init__(self, clf):
+        left, right, feature, threshold, proba, roots = [], [], [], [], [], []
+        offset = 0
+        for est in clf.estimators_:
+            tree = est.tree_
+            value = tree.value[:, 0, :]
+            sums = value.sum(axis=1, keepdims=True)
+            sums[sums == 0] = 1.0
+            is_leaf = tree.children_left == -1
+            roots.append(offset)
+            left.append(np.where(is_leaf, -1, tree.children_left + offset))
+            right.append(np.where(is_leaf, -1, tree.children_right + offset))
+            feature.append(tree.feature)
+            threshold.append(tree.threshold)
+            proba.append(value / sums)
+            offset += tree.node_count
+        # Списки Python быстрее индексируются поэлементно, чем массивы NumPy
+        self.left = np.concatenate(left).tolist()
+        self.right = np.concatenate(right).tolist()
+        self.feature = np.concatenate(feature).tolist()
+        self.threshold = np.concatenate(threshold).tolist()
+        self.proba = [tuple(p) for p in np.concatenate(proba).tolist()]
+        self.roots = roots
+        self.n_classes = int(clf.n_classes_)
+
+    def predict_proba(self, X):
+        """Вероятности классов для строк X (shape (n, n_features)), как у clf.predict_proba"""
+        # sklearn сравнивает признаки во float32 — делаем так же, чтобы пороги срабатывали одинаково
+        rows = np.asarray(X, dtype=np.float32).tolist()
+        out = np.empty((len(rows), self.n_classes), dtype=np.float64)
+        left, right, feature, threshold, proba = self.left, self.right, self.feature, self.threshold, self.proba
+        for r, x in enumerate(rows):
+            acc = [0.0] * self.n_classes
+            for node in self.roots:
+                while left[node] != -1:
+                    node = left[node] if x[feature[node]] <= threshold[node] else right[node]
+                leaf = proba[node]
+                for c in range(self.n_classes):
+                    acc[c] += leaf[c]
+            out[r] = acc
+        out /= len(self.roots)
+        return out
 
 
 def predict_from_text(text: str, k: int, model_name: str = 'RF', order: str = 'newest'):
@@ -308,6 +826,85 @@ def predict_from_text(text: str, k: int, model_name: str = 'RF', order: str = 'n
     return pred_fn(numbers[:k])
 
 
+def predict_next(numbers, k: int, model_name: str):
+    """Обучает модель на numbers (newest-first) и сразу предсказывает цвет следующего броска.
+
+    В отличие от train_and_get_predictor возвращает не замыкание, а готовый результат,
+    поэтому функцию можно выполнять в пуле процессов (см. inference_executor).
+    Возвращает кортеж (predicted_color, info_dict).
+    """
+    pred_fn, _ = train_and_get_predictor(numbers, k, model_name)
+    return pred_fn(numbers[:k])
+
+
+def predict_next_timed(numbers, k: int, model_name: str):
+    """predict_next с замером времени — воркер пула возвращает его вместе с результатом (метрики в main).
+
+    Возвращает кортеж (predicted_color, info_dict, timings), где
+    timings = {'train': секунды, 'predict': секунды, 'cached': модель взята из predictor_cache}.
+    """
+    hits = predictor_cache.hits
+    started = time.perf_counter()
+    pred_fn, _ = train_and_get_predictor(numbers, k, model_name)
+    trained = time.perf_counter()
+    prediction, info = pred_fn(numbers[:k])
+    timings = {
+        'train': trained - started,
+        'predict': time.perf_counter() - trained,
+        'cached': predictor_cache.hits > hits
+    }
+    return prediction, info, timings
+
+
+def predict_many(histories, models=EVAL_MODELS, ks=None):
+    """Пакетные предсказания для нескольких чатов, моделей и k за один вызов.
+
+    histories: dict chat_id -> текст лога или список чисел (newest-first).
+    models: имена моделей ('Markov', 'Logistic', 'RF').
+    ks: None — k выбирается для каждой модели через choose_k_for_model; int или список int — эти k.
+
+    Каждая история парсится один раз; признаки строятся одной матрицей при максимальном k
+    и режутся для меньших k (FeatureBlock); Markov считается одним MarkovState на все k.
+    Возвращает dict (chat_id, model, k) -> {'chat_id', 'model', 'k', 'prediction', 'info', 'error'};
+    при ошибке prediction = None, а error содержит текст ошибки.
+    """
+    if isinstance(ks, int):
+        ks = [ks]
+    results = {}
+    for chat_id, history in histories.items():
+        numbers = parse_numbers_from_text(history) if isinstance(history, str) else list(history)
+        n = len(numbers)
+        jobs = [(model, k) for model in models
+                for k in (ks if ks is not None else [choose_k_for_model(n, model)])]
+        digest = history_digest(numbers)
+
+        markov_ks = sorted({k for model, k in jobs if model == 'Markov' and 0 < k < n})
+        markov_state = None
+        if markov_ks:
+            markov_state = MarkovState(orders=markov_ks)
+            markov_state.rebuild(numbers)
+
+        block = None
+        ml_ks = [k for model, k in jobs if model != 'Markov' and 0 < k < n]
+        if ml_ks:
+            block = FeatureBlock(numbers, max(ml_ks), k_min=min(ml_ks))
+
+        for model, k in jobs:
+            result = {'chat_id': chat_id, 'model': model, 'k': k, 'prediction': None, 'info': {}, 'error': None}
+            try:
+                if n <= k:
+                    raise ValueError("Недостаточно данных для построения признаков: data is empty")
+                if model == 'Markov':
+                    result['prediction'], result['info'] = markov_state.predict(k)
+                else:
+                    pred_fn, _ = train_and_get_predictor(numbers, k, model, features=block.features, digest=digest)
+                    result['prediction'], result['info'] = pred_fn(numbers[:k])
+            except Exception as e:
+                result['error'] = str(e)
+            results[(chat_id, model, k)] = result
+    return results
+
+
 def recommend_log_size_and_k(n_rows: int):
     """Дадим советы по длине лога и выбору k (пропорция от длины).
 
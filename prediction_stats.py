@@ -0,0 +1,134 @@
+"""
+prediction_stats.py
+
+Статистика точности предсказаний по игровым суткам (сутки начинаются в 21:00 UTC).
+
+Счётчики текущих суток хранятся по ключу (чат, модель, k) и сразу агрегируются по модели,
+поэтому запись результата — O(1), а винрейт за сегодня — один поиск в словаре.
+Момент следующего сброса вычисляется один раз; проверка «пора ли сбрасывать» — сравнение чисел.
+При сбросе сутки сворачиваются в компактный архив: {модель: [всего, верно], "модель/k": [...]}.
+
+Модель CONSENSUS — общий прогноз бота (то, что раньше было stats_total/stats_correct).
+
+  - DailyStats(reset_time)
+  - stats.record(chat_id, model, k, is_correct)
+  - stats.win_rate(model=CONSENSUS)   # -> (верно, всего) за текущие сутки
+  - stats.chat_counters(chat_id)      # -> {(модель, k): [всего, верно]}
+  - stats.roll_if_due(now=None)       # сбросить, если наступили новые сутки; True — если сбросили
+  - stats.to_dict() / DailyStats.from_dict(data, reset_time)
+"""
+
+import time as time_module
+from datetime import datetime, time, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+CONSENSUS = 'consensus'
+ARCHIVE_DAYS = 90  # Сколько прошедших суток хранить в архиве
+
+
+class DailyStats:
+    """Счётчики точности за текущие игровые сутки и архив прошедших"""
+
+    def __init__(self, reset_time: time, reset_date: Optional[str] = None):
+        """
+        Args:
+            reset_time: Время сброса (UTC)
+            reset_date: Дата сброса, с которого идут текущие сутки (YYYY-MM-DD); по умолчанию — последний
+                наступивший момент сброса
+        """
+        self.reset_time = reset_time
+        self.buckets: Dict[Tuple[str, str, int], list] = {}  # (чат, модель, k) -> [всего, верно]
+        self.totals: Dict[str, list] = {}  # модель -> [всего, верно] по всем чатам
+        self.archive: Dict[str, Dict[str, list]] = {}  # дата сброса -> {модель или "модель/k": [всего, верно]}
+        self.reset_date = reset_date or self._period_start(datetime.now(timezone.utc)).strftime("%Y-%m-%d")
+        self.next_reset = self._deadline_after(self.reset_date)
+
+    def _period_start(self, now: datetime) -> datetime:
+        """Последний момент сброса, не позже now"""
+        start = datetime.combine(now.date(), self.reset_time, tzinfo=timezone.utc)
+        return start if start <= now else start - timedelta(days=1)
+
+    def _deadline_after(self, reset_date: str) -> float:
+        """Момент следующего сброса (unix-время) для суток, начавшихся в reset_date"""
+        day = datetime.strptime(reset_date, "%Y-%m-%d").date() + timedelta(days=1)
+        return datetime.combine(day, self.reset_time, tzinfo=timezone.utc).timestamp()
+
+    def record(self, chat_id: str, model: str, k: int, is_correct: bool):
+        """Учитывает результат проверки одного предсказания"""
+        bucket = self.buckets.get((chat_id, model, k))
+        if bucket is None:
+            bucket = self.buckets[(chat_id, model, k)] = [0, 0]
+        total = self.totals.get(model)
+        if total is None:
+            total = self.totals[model] = [0, 0]
+        bucket[0] += 1
+        total[0] += 1
+        if is_correct:
+            bucket[1] += 1
+            total[1] += 1
+
+    def win_rate(self, model: str = CONSENSUS) -> Tuple[int, int]:
+        """
+        Returns:
+            Tuple[int, int]: (правильные предсказания, общее количество) модели за текущие сутки
+        """
+        total = self.totals.get(model)
+        return (total[1], total[0]) if total else (0, 0)
+
+    def chat_counters(self, chat_id: str) -> Dict[Tuple[str, int], list]:
+        """Счётчики чата за текущие сутки: {(модель, k): [всего, верно]}"""
+        return {(model, k): list(counts) for (chat, model, k), counts in self.buckets.items() if chat == chat_id}
+
+    def roll_if_due(self, now: Optional[float] = None) -> bool:
+        """
+        Начинает новые сутки, если наступил момент сброса.
+
+        Returns:
+            bool: True, если статистика сброшена
+        """
+        now = time_module.time() if now is None else now
+        if now < self.next_reset:
+            return False
+
+        self._archive_current()
+        self.buckets = {}
+        self.totals = {}
+        self.reset_date = self._period_start(datetime.fromtimestamp(now, timezone.utc)).strftime("%Y-%m-%d")
+        self.next_reset = self._deadline_after(self.reset_date)
+        return True
+
+    def _archive_current(self):
+        if not self.totals:
+            return
+        day = {model: list(counts) for model, counts in self.totals.items()}
+        for (_, model, k), (total, correct) in self.buckets.items():
+            counts = day.setdefault(f"{model}/{k}", [0, 0])
+            counts[0] += total
+            counts[1] += correct
+        self.archive[self.reset_date] = day
+        for old_day in sorted(self.archive)[:-ARCHIVE_DAYS]:
+            del self.archive[old_day]
+
+    def to_dict(self) -> dict:
+        correct, total = self.win_rate()
+        return {
+            # total/correct/reset_date — общий винрейт в прежнем формате stats.json
+            "total": total,
+            "correct": correct,
+            "reset_date": self.reset_date,
+            "buckets": [[chat, model, k, counts[0], counts[1]] for (chat, model, k), counts in self.buckets.items()],
+            "totals": {model: list(counts) for model, counts in self.totals.items()},
+            "archive": dict(self.archive)
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, reset_time: time) -> "DailyStats":
+        stats = cls(reset_time, data.get("reset_date") or None)
+        for chat, model, k, total, correct in data.get("buckets", []):
+            stats.buckets[(chat, model, k)] = [total, correct]
+        stats.totals = {model: list(counts) for model, counts in data.get("totals", {}).items()}
+        if CONSENSUS not in stats.totals and data.get("total"):
+            # Старый формат: только общий счётчик без разбивки по чатам
+            stats.totals[CONSENSUS] = [data.get("total", 0), data.get("correct", 0)]
+        stats.archive = data.get("archive", {})
+        return stats
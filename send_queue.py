@@ -0,0 +1,330 @@
+"""
+send_queue.py
+
+Очередь исходящих сообщений бота с учётом лимитов Telegram.
+
+Telegram ограничивает бота примерно 30 сообщениями в секунду на всех и ~20 в минуту в одну группу;
+при превышении API отвечает RetryAfter. Все ответы бота идут через эту очередь:
+  - глобальный и по-чатовые token bucket — сообщение уходит, только когда есть токен в обоих;
+  - приоритеты: ответы с прогнозами (PRIORITY_PREDICTION) уходят раньше /help и /rec (PRIORITY_INFO);
+    внутри одного приоритета — по порядку постановки;
+  - чат, упёршийся в лимит, не задерживает остальные чаты;
+  - RetryAfter: чат ставится на паузу на указанное время, сообщение возвращается в начало очереди чата
+    (до MAX_RETRIES раз), отправитель получает результат или ошибку как при прямом вызове.
+Отправки выполняются параллельно (отдельными задачами), поэтому пропускная способность упирается
+в лимит API, а не во время ответа Telegram.
+
+  - outbox = SendQueue()
+  - outbox.start()                                       # в запущенном event loop
+  - await outbox.send(chat_id, priority, func, *args, **kwargs)  # func — корутина отправки (reply_text, ...)
+  - outbox.stats()                                       # глубина очереди, отправлено, задержки
+  - await outbox.stop(timeout)                           # дожидается очереди и останавливается
+Пока очередь не запущена, send() отправляет сразу (скрипты, benchmark).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from telegram.error import RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram Bot API (можно переопределить через окружение)
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))      # Сообщений в секунду на всех
+CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", str(20 / 60)))  # Сообщений в секунду в один чат (группы: 20 в минуту)
+CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))           # Сколько сообщений подряд можно отправить в чат
+MAX_RETRIES = 3  # Сколько раз повторять сообщение после RetryAfter
+LATENCY_WINDOW = 1024  # По скольким последним отправкам считаются перцентили задержки
+
+PRIORITY_PREDICTION = 0  # Ответы на /ludobot (прогнозы и ошибки анализа)
+PRIORITY_INFO = 1        # /help, /rec, приветствия
+
+SEND_SECONDS = metrics.Histogram('ludobot_send_seconds',
+                                 'Время отправки сообщения: от постановки в очередь (queued) и только запрос к API (api)',
+                                 ['priority', 'phase'])
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity в запасе"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — есть сейчас)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float):
+        """Ни одного токена ближайшие seconds секунд (RetryAfter)"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('chat_id', 'priority', 'seq', 'func', 'args', 'kwargs', 'future', 'enqueued', 'attempts')
+
+    def __init__(self, chat_id, priority, seq, func, args, kwargs, future):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class SendQueue:
+    """Планировщик исходящих сообщений: приоритеты, лимиты на чат и на бота, RetryAfter"""
+
+    MAX_IDLE_BUCKETS = 4096  # Сверх этого числа полные bucket'ы чатов без очереди удаляются
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: int = CHAT_BURST, max_retries: int = MAX_RETRIES):
+        # Без запаса: сообщения идут равномерно, и в любую секунду уходит не больше global_rate (+1)
+        self._global = TokenBucket(global_rate, 1)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._jobs: Dict[int, List[Tuple[int, int, _Job]]] = {}  # chat_id -> куча (приоритет, seq, job)
+        # Чаты, которым можно отправлять: (приоритет, seq) первого сообщения чата на момент постановки.
+        # Записи могут устаревать — при извлечении сверяются с текущим первым сообщением чата
+        self._ready: List[Tuple[int, int, int]] = []
+        self._waiting: List[Tuple[float, int]] = []  # (когда появится токен, chat_id)
+        self._waiting_chats: Set[int] = set()
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+        self._queued = Counter()  # Приоритет -> сообщений в очереди
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._latency = deque(maxlen=LATENCY_WINDOW)   # От постановки в очередь до ответа Telegram
+        self._api_time = deque(maxlen=LATENCY_WINDOW)  # Только запрос к API
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._dispatch())
+
+    async def stop(self, timeout: float = 5.0):
+        """Дожидается отправки очереди (не дольше timeout), затем останавливает планировщик"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (sum(self._queued.values()) or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for heap in self._jobs.values():
+            for _, _, job in heap:
+                job.future.cancel()
+        if self._jobs:
+            logger.warning(f"Очередь отправки остановлена, не отправлено: {sum(self._queued.values())}")
+        self._jobs.clear()
+        self._ready.clear()
+        self._waiting.clear()
+        self._waiting_chats.clear()
+        self._queued.clear()
+
+    async def send(self, chat_id: int, priority: int, func: Callable[..., Awaitable[Any]], /, *args, **kwargs) -> Any:
+        """
+        Параметры очереди только позиционные: в kwargs для func может быть свой chat_id
+        (например, bot.send_message(chat_id=..., text=...)).
+
+        Args:
+            chat_id: Чат, в который уходит сообщение (по нему считается лимит чата)
+            priority: PRIORITY_PREDICTION или PRIORITY_INFO (меньше — раньше)
+            func: Корутина отправки, например update.message.reply_text
+
+        Returns:
+            Результат func (отправленное сообщение); ошибки func пробрасываются
+        """
+        if self._task is None:
+            return await func(*args, **kwargs)
+
+        job = _Job(chat_id, priority, next(self._seq), func, args, kwargs,
+                   asyncio.get_running_loop().create_future())
+        if len(self._buckets) > self.MAX_IDLE_BUCKETS:
+            self._prune_buckets()
+        self._push(job)
+        return await job.future
+
+    def _push(self, job: _Job):
+        heap = self._jobs.setdefault(job.chat_id, [])
+        heapq.heappush(heap, (job.priority, job.seq, job))
+        self._queued[job.priority] += 1
+        if heap[0][2] is job and job.chat_id not in self._waiting_chats:
+            heapq.heappush(self._ready, (job.priority, job.seq, job.chat_id))
+        self._wakeup.set()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._jobs and b.full(now)]:
+            del self._buckets[chat_id]
+
+    def _schedule(self, chat_id: int, now: float):
+        """Ставит первое сообщение чата в готовые или ждёт токен чата"""
+        heap = self._jobs.get(chat_id)
+        if not heap:
+            self._jobs.pop(chat_id, None)
+            return
+        delay = self._bucket(chat_id).delay(now)
+        if delay > 0:
+            if chat_id not in self._waiting_chats:
+                self._waiting_chats.add(chat_id)
+                heapq.heappush(self._waiting, (now + delay, chat_id))
+        else:
+            priority, seq, _ = heap[0]
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+
+    def _release_waiting(self, now: float):
+        while self._waiting and self._waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self._waiting)
+            self._waiting_chats.discard(chat_id)
+            self._schedule(chat_id, now)
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            self._release_waiting(now)
+
+            timeout = None
+            if self._ready:
+                timeout = self._global.delay(now)
+                if timeout <= 0:
+                    self._dispatch_one(now)
+                    continue
+            if self._waiting:
+                until_chat = self._waiting[0][0] - now
+                timeout = until_chat if timeout is None else min(timeout, until_chat)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch_one(self, now: float):
+        _, seq, chat_id = heapq.heappop(self._ready)
+        heap = self._jobs.get(chat_id)
+        if chat_id in self._waiting_chats or not heap or heap[0][1] != seq:
+            return  # Устаревшая запись
+
+        job = heap[0][2]
+        if job.future.done():  # Отправитель отменён — сообщение больше не нужно
+            heapq.heappop(heap)
+            self._queued[job.priority] -= 1
+            self._schedule(chat_id, now)
+            return
+
+        bucket = self._bucket(chat_id)
+        if bucket.delay(now) > 0:
+            self._schedule(chat_id, now)
+            return
+
+        heapq.heappop(heap)
+        self._queued[job.priority] -= 1
+        bucket.take(now)
+        self._global.take(now)
+        task = asyncio.ensure_future(self._send(job))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+        self._schedule(chat_id, now)
+
+    async def _send(self, job: _Job):
+        job.attempts += 1
+        started = time.monotonic()
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            now = time.monotonic()
+            self._bucket(job.chat_id).pause(e.retry_after, now)
+            if job.attempts <= self.max_retries and not job.future.done():
+                self.retried += 1
+                logger.warning(f"RetryAfter {e.retry_after} с для чата {job.chat_id}, "
+                               f"повтор {job.attempts}/{self.max_retries}")
+                self._push(job)  # Тот же (приоритет, seq) — снова первым в своём чате
+                return
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            now = time.monotonic()
+            self.sent += 1
+            self._latency.append(now - job.enqueued)
+            self._api_time.append(now - started)
+            SEND_SECONDS.labels(str(job.priority), 'queued').observe(now - job.enqueued)
+            SEND_SECONDS.labels(str(job.priority), 'api').observe(now - started)
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def stats(self) -> dict:
+        latency = list(self._latency)
+        api_time = list(self._api_time)
+        return {
+            'queued': sum(self._queued.values()),
+            'queued_by_priority': {p: n for p, n in self._queued.items() if n},
+            'sending': len(self._sending),
+            'chats_waiting': len(self._waiting_chats),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'latency_p50': _percentile(latency, 0.5),
+            'latency_p95': _percentile(latency, 0.95),
+            'api_time_p50': _percentile(api_time, 0.5)
+        }
@@ -0,0 +1,60 @@
+"""
+single_flight.py
+
+Объединение одновременных одинаковых запросов (single-flight).
+
+Когда несколько игроков почти одновременно отвечают /ludobot на одно и то же сообщение рулетки,
+слияние истории и все модели достаточно посчитать один раз. Первый вызов с данным ключом
+запускает работу отдельной задачей, остальные вызовы с тем же ключом, пришедшие до её
+завершения, ждут ту же задачу и получают тот же результат (или то же исключение).
+После завершения ключ освобождается — следующий вызов снова выполняет работу.
+
+Работа идёт отдельной задачей (asyncio.Task), поэтому отмена одного из ожидающих
+не отменяет её для остальных.
+
+  - flights = SingleFlight()
+  - await flights.run(key, func, *args)   # func — async-функция
+  - flights.stats()                       # {'in_flight', 'started', 'shared'}
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Одна выполняющаяся задача на ключ; повторные вызовы с тем же ключом ждут её результат"""
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0  # Сколько раз работа действительно выполнялась
+        self.shared = 0   # Сколько вызовов получили результат чужой задачи
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.shared += 1
+            logger.info(f"Запрос {key} уже выполняется — ждём его результат")
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Исключение получают ожидающие; если все они отменены, asyncio не должен ругаться,
+        # что оно «никем не получено»
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._tasks),
+            'started': self.started,
+            'shared': self.shared
+        }
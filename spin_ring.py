@@ -0,0 +1,107 @@
+"""
+spin_ring.py
+
+Кольцевой буфер истории бросков одного чата.
+
+Хранит не больше capacity чисел (по байту на бросок) в порядке newest-first. Добавление новых
+бросков в начало и обрезка старых — O(1) на бросок, без копирования всей истории; самые старые
+броски вытесняются автоматически. Память на чат фиксирована: capacity байт.
+
+  - SpinRing(capacity, numbers=())  # numbers newest-first; лишние старые броски отбрасываются
+  - ring.prepend(new)               # new (newest-first) становится началом истории
+  - ring.truncate(n)                # оставить n самых свежих
+  - ring[i], ring[a:b], len(ring), iter(ring)
+  - ring.to_array() / ring.tobytes() / ring.tolist()  # копии newest-first
+"""
+
+from array import array
+from typing import Iterable, Sequence
+
+
+class SpinRing:
+    """Кольцевой буфер бросков newest-first фиксированной ёмкости"""
+
+    __slots__ = ('capacity', '_buf', '_head', '_len')
+
+    def __init__(self, capacity: int, numbers: Iterable[int] = ()):
+        if capacity <= 0:
+            raise ValueError("Ёмкость SpinRing должна быть положительной")
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._head = 0  # Позиция самого свежего броска; элемент i лежит в (_head + i) % capacity
+        self._len = 0
+        numbers = bytes(numbers)[:capacity]
+        self._buf[:len(numbers)] = numbers
+        self._len = len(numbers)
+
+    def prepend(self, new: Sequence[int]):
+        """Добавляет броски new (newest-first) перед историей; вытесняет самые старые"""
+        buf = self._buf
+        capacity = self.capacity
+        head = self._head
+        # Идём от самого старого из новых к самому свежему — каждый становится новой головой
+        for x in reversed(new[:capacity] if len(new) > capacity else new):
+            head = (head - 1) % capacity
+            buf[head] = x
+        self._head = head
+        self._len = min(self._len + min(len(new), capacity), capacity)
+
+    def truncate(self, n: int):
+        """Оставляет только n самых свежих бросков"""
+        if n < self._len:
+            self._len = max(n, 0)
+
+    def clear(self):
+        self._head = 0
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _segments(self, start: int, stop: int):
+        """Куски буфера для элементов [start, stop) (не больше двух из-за перехода через край)"""
+        if start >= stop:
+            return b'', b''
+        begin = (self._head + start) % self.capacity
+        end = begin + (stop - start)
+        if end <= self.capacity:
+            return self._buf[begin:end], b''
+        return self._buf[begin:], self._buf[:end - self.capacity]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._len)
+            if step != 1:
+                return self.to_array()[item]
+            first, second = self._segments(start, stop)
+            result = array('B', first)
+            result.frombytes(second)
+            return result
+        if item < 0:
+            item += self._len
+        if not 0 <= item < self._len:
+            raise IndexError("SpinRing index out of range")
+        return self._buf[(self._head + item) % self.capacity]
+
+    def __iter__(self):
+        first, second = self._segments(0, self._len)
+        yield from first
+        yield from second
+
+    def __eq__(self, other):
+        if isinstance(other, SpinRing):
+            return self.tobytes() == other.tobytes()
+        return NotImplemented
+
+    def __repr__(self):
+        return f"SpinRing(capacity={self.capacity}, len={self._len})"
+
+    def tobytes(self) -> bytes:
+        first, second = self._segments(0, self._len)
+        return bytes(first) + bytes(second)
+
+    def to_array(self) -> array:
+        return self[:]
+
+    def tolist(self) -> list:
+        return list(self.tobytes())
@@ -0,0 +1,100 @@
+"""
+startup_profile.py
+
+Встроенный отчёт о времени запуска бота (аналог `python -X importtime`, но без флагов интерпретатора).
+
+  - mark(label)   # отметка этапа запуска (время от импорта этого модуля)
+  - install()     # включить замер времени импорта каждого модуля (self / cumulative)
+  - report(top)   # текстовый отчёт: этапы запуска + самые дорогие импорты
+
+Подробный замер импортов включается переменной окружения IMPORT_PROFILE=1
+(или вызовом install()); отметки этапов работают всегда и почти ничего не стоят.
+Модуль должен импортироваться первым — до тяжёлых библиотек (main загружает .env ещё раньше,
+поэтому IMPORT_PROFILE можно задать и там).
+"""
+
+import os
+import sys
+import time
+from importlib.abc import MetaPathFinder
+from typing import Dict, List, Tuple
+
+_started = time.perf_counter()
+
+_marks: List[Tuple[str, float]] = []
+_import_times: Dict[str, Tuple[float, float]] = {}  # модуль -> (self, cumulative) в секундах
+_stack: List[float] = []  # время вложенных импортов для текущего уровня
+
+
+class _TimingLoader:
+    """Обёртка над loader: замеряет exec_module и вычитает время вложенных импортов"""
+
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        _stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            cumulative = time.perf_counter() - started
+            nested = _stack.pop()
+            if _stack:
+                _stack[-1] += cumulative
+            _import_times[module.__name__] = (cumulative - nested, cumulative)
+
+
+class _TimingFinder(MetaPathFinder):
+    """Находит spec через остальные finder-ы и подменяет loader на замеряющий"""
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimingLoader(spec.loader)
+                return spec
+        return None
+
+
+def install():
+    """Включает замер времени импорта модулей (повторный вызов ничего не делает)"""
+    if not any(isinstance(finder, _TimingFinder) for finder in sys.meta_path):
+        sys.meta_path.insert(0, _TimingFinder())
+
+
+def mark(label: str):
+    """Запоминает этап запуска с временем от старта"""
+    _marks.append((label, time.perf_counter() - _started))
+
+
+def elapsed_ms() -> float:
+    return (time.perf_counter() - _started) * 1000
+
+
+def report(top: int = 15) -> str:
+    """Отчёт о запуске: этапы и top самых медленных импортов (по cumulative)"""
+    lines = [f"Запуск: {elapsed_ms():.0f} мс"]
+    previous = 0.0
+    for label, at in _marks:
+        lines.append(f"  {at * 1000:8.1f} мс  (+{(at - previous) * 1000:7.1f})  {label}")
+        previous = at
+    if _import_times:
+        lines.append("Импорты (self | cumulative, мс):")
+        slowest = sorted(_import_times.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        for name, (self_time, cumulative) in slowest:
+            lines.append(f"  {self_time * 1000:8.1f} | {cumulative * 1000:8.1f}  {name}")
+    return "\n".join(lines)
+
+
+if os.getenv("IMPORT_PROFILE") == "1":
+    install()
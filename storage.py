@@ -0,0 +1,681 @@
+"""
+storage.py
+
+Хранилища состояния чатов для chat_history_manager.
+
+Состояние одного чата — ChatRecord (история, последнее предсказание, марковская модель),
+плюс общая статистика (словарь). Бэкенд сохраняет изменения по чатам, а не всё сразу:
+  - BinaryStorage # бинарный снимок с индексом чатов (mmap, чат декодируется при обращении) + журнал
+  - JsonStorage   # снимок в JSON-файлах + журнал изменений (append-only), сворачиваемый в фоне
+  - SqliteStorage # SQLite в режиме WAL: одна строка на чат, изменения пачкой в одной транзакции
+
+Интерфейс (StorageBackend):
+  - load()                                  # -> ({chat_id: ChatRecord} (Mapping, может быть ленивым), stats или None)
+                                            #    отображение отражает и последующие write() — из него можно
+                                            #    перечитать выгруженный из памяти чат
+  - write(chats, stats=None, clear_predictions=False)  # изменения; None вместо ChatRecord — удалить чат
+  - write_all(chats, stats)                 # полный снимок (заменяет всё сохранённое)
+  - close()
+"""
+
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+from collections.abc import Mapping
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRecord(NamedTuple):
+    """Сохраняемое состояние одного чата"""
+    history: Optional[bytes]  # Числа newest-first, по байту на бросок (в старом JSON-снимке — текст или список)
+    prediction: Optional[dict]  # {'prediction': str, 'message_id': int}
+    markov: Optional[dict]  # MarkovState.to_dict()
+
+
+class StorageBackend:
+    """Базовый класс хранилища"""
+
+    def load(self) -> Tuple[Mapping, Optional[dict]]:
+        """
+        Все чаты ({chat_id: ChatRecord}; запись может декодироваться только при обращении) и статистика.
+        Отображение живое: после write() по нему читается уже сохранённое состояние чата.
+        """
+        raise NotImplementedError
+
+    def write(self, chats: Dict[str, Optional[ChatRecord]], stats: Optional[dict] = None,
+              clear_predictions: bool = False):
+        """
+        Сохраняет изменения.
+
+        Args:
+            chats: Изменившиеся чаты (None — чат удалён)
+            stats: Новая статистика, если она изменилась
+            clear_predictions: Удалить предсказания всех чатов (применяется до chats)
+        """
+        raise NotImplementedError
+
+    def write_all(self, chats: Dict[str, ChatRecord], stats: dict):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _write_json_atomic(path: str, data, compact: bool):
+    """Записывает JSON во временный файл и атомарно подменяет им path"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        if compact:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        else:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _load_json(path: str, what: str):
+    try:
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке {what}: {e}")
+    return None
+
+
+class LayeredChats(Mapping):
+    """Записи чатов из снимка (декодируются при обращении) с изменениями из журнала поверх"""
+
+    def __init__(self, base: Mapping, overlay: Dict[str, Optional[ChatRecord]], predictions_cleared: bool):
+        self.base = base
+        self.overlay = overlay  # Чаты из журнала; None — чат удалён
+        self.predictions_cleared = predictions_cleared  # В журнале есть сброс предсказаний — для записей снимка
+
+    def __getitem__(self, chat_id: str) -> ChatRecord:
+        if chat_id in self.overlay:
+            record = self.overlay[chat_id]
+            if record is None:
+                raise KeyError(chat_id)
+            return record
+        record = self.base[chat_id]
+        if self.predictions_cleared and record.prediction:
+            record = record._replace(prediction=None)
+        return record
+
+    def __iter__(self):
+        for chat_id, record in self.overlay.items():
+            if record is not None:
+                yield chat_id
+        for chat_id in self.base:
+            if chat_id not in self.overlay:
+                yield chat_id
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, chat_id):
+        if chat_id in self.overlay:
+            return self.overlay[chat_id] is not None
+        return chat_id in self.base
+
+    def clear_predictions(self):
+        self.predictions_cleared = True
+        for chat_id, record in self.overlay.items():
+            if record is not None and record.prediction:
+                self.overlay[chat_id] = record._replace(prediction=None)
+
+    def freeze(self):
+        """Текущее состояние уходит в нижний слой, дальнейшие изменения копятся в пустом overlay"""
+        # Сначала base: читатель, не нашедший чат в старом overlay, найдёт его в новом base
+        self.base = LayeredChats(self.base, self.overlay, self.predictions_cleared)
+        self.overlay = {}
+        self.predictions_cleared = False
+
+    def reset(self, base: Mapping):
+        self.base = base
+        self.overlay = {}
+        self.predictions_cleared = False
+
+
+class JournaledStorage(StorageBackend):
+    """
+    Снимок + журнал изменений.
+
+    Каждое изменение дописывается в журнал одной JSON-строкой с полным состоянием изменившегося
+    чата (или статистики). Когда журнал дорастает до JOURNAL_COMPACT_BYTES, он переименовывается
+    в .compacting, а фоновый поток пишет новый снимок (состояние берётся из snapshot_source)
+    и удаляет старый журнал. При загрузке снимок читается, затем проигрываются оба журнала.
+    Формат снимка задают подклассы (_load_snapshot / _write_snapshot).
+
+    Отображение, которое вернул load(), обновляется при каждом write(): перед сворачиванием его
+    изменения уходят в нижний слой, а после записи снимка этот слой заменяется самим снимком.
+    Поэтому изменения в памяти ограничены размером журнала.
+    """
+
+    JOURNAL_FILE = "chat_state.journal"
+
+    JOURNAL_COMPACT_BYTES = 1024 * 1024  # При таком размере журнала он сворачивается в новый снимок
+
+    def __init__(self, directory: str = ".",
+                 snapshot_source: Optional[Callable[[], Tuple[Dict[str, ChatRecord], dict]]] = None):
+        """
+        Args:
+            directory: Папка с файлами данных
+            snapshot_source: Функция, возвращающая текущее состояние целиком (для сворачивания журнала);
+                без неё журнал не сворачивается
+        """
+        self.directory = directory
+        self.journal_path = os.path.join(directory, self.JOURNAL_FILE)
+        self.snapshot_source = snapshot_source
+        self._journal = None  # Открытый на дозапись файл журнала
+        self._compaction_thread: Optional[threading.Thread] = None
+        self._chats: Optional[LayeredChats] = None  # Отображение из load(), которое поддерживается актуальным
+
+    def _load_snapshot(self) -> Tuple[Mapping, Optional[dict]]:
+        raise NotImplementedError
+
+    def _write_snapshot(self, chats: Dict[str, ChatRecord], stats: dict):
+        raise NotImplementedError
+
+    def _reopen_snapshot(self, chats: Dict[str, ChatRecord]) -> Mapping:
+        """Записи только что записанного снимка (chats — то, что в него записано)"""
+        return chats
+
+    def load(self) -> Tuple[Mapping, Optional[dict]]:
+        base, stats = self._load_snapshot()
+        overlay = {}
+        predictions_cleared = False
+
+        # Проигрываем журнал поверх снимка: сначала незавершённое сворачивание, затем текущий журнал
+        for path in (self.journal_path + ".compacting", self.journal_path):
+            stats, cleared = self._replay_journal(path, overlay, stats)
+            predictions_cleared = predictions_cleared or cleared
+
+        self._chats = LayeredChats(base, overlay, predictions_cleared)
+        return self._chats, stats
+
+    def _replay_journal(self, path: str, overlay: Dict[str, Optional[ChatRecord]],
+                        stats: Optional[dict]) -> Tuple[Optional[dict], bool]:
+        """Применяет записи журнала к overlay; возвращает итоговую статистику и флаг сброса предсказаний"""
+        if not os.path.exists(path):
+            return stats, False
+
+        applied = 0
+        predictions_cleared = False
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная строка (падение во время записи) — пропускаем только её
+                    logger.warning(f"Повреждённая запись в журнале {path} пропущена")
+                    continue
+
+                kind = record.get('t')
+                if kind == 'chat':
+                    chat = ChatRecord(record.get('h') or None, record.get('p') or None, record.get('m') or None)
+                    overlay[record['id']] = chat if any(chat) else None
+                elif kind == 'stats':
+                    stats = {key: value for key, value in record.items() if key != 't'}
+                elif kind == 'clear_predictions':
+                    predictions_cleared = True
+                    for chat_id, chat in overlay.items():
+                        if chat is not None and chat.prediction:
+                            overlay[chat_id] = chat._replace(prediction=None)
+                applied += 1
+
+        if applied:
+            logger.info(f"Из журнала {path} применено записей: {applied}")
+        return stats, predictions_cleared
+
+    def write(self, chats: Dict[str, Optional[ChatRecord]], stats: Optional[dict] = None,
+              clear_predictions: bool = False):
+        lines = []
+        if clear_predictions:
+            lines.append({'t': 'clear_predictions'})
+        for chat_id, record in chats.items():
+            if record is None:
+                record = ChatRecord(None, None, None)
+            lines.append({
+                't': 'chat',
+                'id': chat_id,
+                'h': list(record.history) if record.history else None,
+                'p': record.prediction,
+                'm': record.markov
+            })
+        if stats is not None:
+            lines.append({'t': 'stats', **stats})
+        if not lines:
+            return
+
+        # Отображение из load() обновляется и тогда, когда запись на диск не удалась:
+        # выгруженный из памяти чат перечитается с последним состоянием
+        if self._chats is not None:
+            if clear_predictions:
+                self._chats.clear_predictions()
+            self._chats.overlay.update(chats)
+
+        try:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal.write("".join(json.dumps(line, ensure_ascii=False, separators=(',', ':')) + "\n"
+                                        for line in lines))
+            self._journal.flush()
+            if self._journal.tell() >= self.JOURNAL_COMPACT_BYTES and self.snapshot_source is not None:
+                self.compact()
+        except Exception as e:
+            logger.error(f"Ошибка при записи в журнал: {e}")
+
+    def write_all(self, chats: Dict[str, ChatRecord], stats: dict):
+        """Полный снимок; журнал после него больше не нужен"""
+        self.wait_for_compaction()
+        try:
+            self._write_snapshot(chats, stats)
+            self._close_journal()
+            for path in (self.journal_path + ".compacting", self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            if self._chats is not None:
+                self._chats.reset(self._reopen_snapshot(chats))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении данных: {e}")
+
+    def compact(self):
+        """
+        Сворачивает журнал в снимок в фоновом потоке.
+
+        Состояние снимается в вызывающем потоке (в момент переименования журнала),
+        новые записи сразу идут в свежий журнал. Если процесс упадёт посередине,
+        при загрузке проигрываются оба журнала. Если прошлый снимок не записался,
+        журнал дописывается к оставшемуся .compacting.
+        """
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+
+        chats, stats = self.snapshot_source()
+        if self._chats is not None:
+            self._chats.freeze()
+        compacting_path = self.journal_path + ".compacting"
+        self._close_journal()
+        if os.path.exists(compacting_path):
+            # Прошлый снимок не записался: .compacting ещё нужен при загрузке, поэтому журнал
+            # дописывается в его конец (порядок записей сохраняется), а не заменяет его
+            self._append_journal(compacting_path)
+        else:
+            os.replace(self.journal_path, compacting_path)
+
+        self._compaction_thread = threading.Thread(target=self._finish_compaction,
+                                                   args=(chats, stats, compacting_path),
+                                                   name="journal-compaction")
+        self._compaction_thread.start()
+
+    def _append_journal(self, compacting_path: str):
+        """Переносит текущий журнал в конец .compacting"""
+        with open(self.journal_path, 'rb') as src, open(compacting_path, 'ab') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        # Упадём до удаления — записи проиграются дважды, но каждая несёт полное состояние чата
+        os.remove(self.journal_path)
+
+    def _finish_compaction(self, chats: Dict[str, ChatRecord], stats: dict, compacting_path: str):
+        try:
+            self._write_snapshot(chats, stats)
+            os.remove(compacting_path)
+            if self._chats is not None:
+                # Нижний слой (снимок + свёрнутый журнал) заменяется новым снимком
+                self._chats.base = self._reopen_snapshot(chats)
+            logger.info("Журнал свёрнут в снимок")
+        except Exception as e:
+            # .compacting остаётся на диске: следующий compact() допишет в него журнал и повторит снимок
+            logger.error(f"Ошибка при сворачивании журнала: {e}")
+
+    def wait_for_compaction(self):
+        """Дожидается завершения фонового сворачивания журнала (если оно идёт)"""
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def close(self):
+        self.wait_for_compaction()
+        self._close_journal()
+
+
+class JsonStorage(JournaledStorage):
+    """Снимок в JSON-файлах (истории, предсказания, марковские модели, статистика) + журнал"""
+
+    HISTORY_FILE = "chat_histories.json"
+    PREDICTIONS_FILE = "chat_predictions.json"
+    STATS_FILE = "stats.json"
+    MARKOV_FILE = "chat_markov.json"
+
+    def __init__(self, directory: str = ".",
+                 snapshot_source: Optional[Callable[[], Tuple[Dict[str, ChatRecord], dict]]] = None):
+        super().__init__(directory, snapshot_source)
+        self.history_path = os.path.join(directory, self.HISTORY_FILE)
+        self.predictions_path = os.path.join(directory, self.PREDICTIONS_FILE)
+        self.stats_path = os.path.join(directory, self.STATS_FILE)
+        self.markov_path = os.path.join(directory, self.MARKOV_FILE)
+
+    def has_snapshot(self) -> bool:
+        return any(os.path.exists(path) for path in
+                   (self.history_path, self.predictions_path, self.stats_path, self.markov_path))
+
+    def _load_snapshot(self) -> Tuple[Dict[str, ChatRecord], Optional[dict]]:
+        histories = _load_json(self.history_path, "историй") or {}
+        predictions = _load_json(self.predictions_path, "предсказаний") or {}
+        markov = _load_json(self.markov_path, "марковских моделей") or {}
+        stats = _load_json(self.stats_path, "статистики")
+        chats = {
+            chat_id: ChatRecord(histories.get(chat_id), predictions.get(chat_id), markov.get(chat_id))
+            for chat_id in histories.keys() | predictions.keys() | markov.keys()
+        }
+        return chats, stats
+
+    def _write_snapshot(self, chats: Dict[str, ChatRecord], stats: dict):
+        """Записывает файлы снимка; каждый файл подменяется атомарно"""
+        # Истории и марковские модели компактно — это данные не для чтения человеком
+        _write_json_atomic(self.history_path,
+                           {chat_id: list(r.history) for chat_id, r in chats.items() if r.history}, True)
+        _write_json_atomic(self.predictions_path,
+                           {chat_id: r.prediction for chat_id, r in chats.items() if r.prediction}, False)
+        _write_json_atomic(self.markov_path,
+                           {chat_id: r.markov for chat_id, r in chats.items() if r.markov}, True)
+        _write_json_atomic(self.stats_path, stats, False)
+
+
+# Бинарный снимок:
+#   заголовок  SNAPSHOT_HEADER: сигнатура, число чатов, смещение индекса, смещение и длина статистики (JSON)
+#   записи     по чату: u32 длина истории + история (байт на бросок), u32 + предсказание (JSON),
+#              u32 + марковская модель (JSON)
+#   индекс     по чату: u16 длина id + id (UTF-8) + u64 смещение записи
+SNAPSHOT_MAGIC = b'LDB1'
+SNAPSHOT_HEADER = struct.Struct('<4sIQQI')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+
+
+def encode_snapshot(chats: Dict[str, ChatRecord], stats: Optional[dict]) -> bytes:
+    """Бинарный снимок состояния (формат — см. SNAPSHOT_HEADER)"""
+    body = bytearray(SNAPSHOT_HEADER.size)
+    index = bytearray()
+    for chat_id, record in chats.items():
+        offset = len(body)
+        history = bytes(record.history) if record.history else b''
+        prediction = json.dumps(record.prediction, ensure_ascii=False).encode('utf-8') if record.prediction else b''
+        markov = json.dumps(record.markov, separators=(',', ':')).encode('utf-8') if record.markov else b''
+        for part in (history, prediction, markov):
+            body += _U32.pack(len(part))
+            body += part
+        key = chat_id.encode('utf-8')
+        index += _U16.pack(len(key)) + key + _U64.pack(offset)
+
+    index_offset = len(body)
+    body += index
+    stats_offset = len(body)
+    stats_bytes = json.dumps(stats, ensure_ascii=False).encode('utf-8') if stats is not None else b''
+    body += stats_bytes
+    SNAPSHOT_HEADER.pack_into(body, 0, SNAPSHOT_MAGIC, len(chats), index_offset, stats_offset, len(stats_bytes))
+    return bytes(body)
+
+
+class SnapshotChats(Mapping):
+    """
+    Чаты бинарного снимка: при открытии читается только индекс (id -> смещение),
+    запись чата декодируется при обращении к нему.
+    """
+
+    def __init__(self, data):
+        """
+        Args:
+            data: Содержимое снимка (mmap или bytes)
+        """
+        self._data = data
+        self._offsets: Dict[str, int] = {}
+        self.stats: Optional[dict] = None
+        if not len(data):
+            return
+
+        magic, count, index_offset, stats_offset, stats_length = SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Неизвестный формат бинарного снимка")
+        position = index_offset
+        for _ in range(count):
+            (key_length,) = _U16.unpack_from(data, position)
+            key = bytes(data[position + 2:position + 2 + key_length]).decode('utf-8')
+            (self._offsets[key],) = _U64.unpack_from(data, position + 2 + key_length)
+            position += 2 + key_length + 8
+        if stats_length:
+            self.stats = json.loads(bytes(data[stats_offset:stats_offset + stats_length]).decode('utf-8'))
+
+    def _part(self, position: int) -> Tuple[bytes, int]:
+        (length,) = _U32.unpack_from(self._data, position)
+        start = position + 4
+        return bytes(self._data[start:start + length]), start + length
+
+    def __getitem__(self, chat_id: str) -> ChatRecord:
+        position = self._offsets[chat_id]
+        history, position = self._part(position)
+        prediction, position = self._part(position)
+        markov, _ = self._part(position)
+        return ChatRecord(
+            history or None,
+            json.loads(prediction.decode('utf-8')) if prediction else None,
+            json.loads(markov.decode('utf-8')) if markov else None
+        )
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._offsets
+
+
+class BinaryStorage(JournaledStorage):
+    """
+    Бинарный снимок с индексом чатов + журнал.
+
+    Снимок отображается в память (mmap): при старте читается только индекс, а состояние чата
+    декодируется при первом обращении — время запуска почти не зависит от числа чатов.
+    Если бинарного снимка ещё нет, читается JSON-снимок прежнего формата (JsonStorage);
+    следующее сворачивание журнала запишет уже бинарный.
+    """
+
+    SNAPSHOT_FILE = "chat_state.snap"
+
+    def __init__(self, directory: str = ".",
+                 snapshot_source: Optional[Callable[[], Tuple[Dict[str, ChatRecord], dict]]] = None):
+        super().__init__(directory, snapshot_source)
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_FILE)
+        self._mmap = None
+
+    def _load_snapshot(self) -> Tuple[Mapping, Optional[dict]]:
+        if not os.path.exists(self.snapshot_path):
+            legacy = JsonStorage(self.directory)
+            if legacy.has_snapshot():
+                logger.info("Бинарного снимка нет — загружается JSON-снимок")
+                return legacy._load_snapshot()
+            return {}, None
+
+        self._close_mmap()
+        chats = self._open_snapshot()
+        return chats, chats.stats
+
+    def _open_snapshot(self) -> "SnapshotChats":
+        with open(self.snapshot_path, 'rb') as f:
+            if sys.platform == 'win32' or os.fstat(f.fileno()).st_size == 0:
+                # В Windows отображённый файл нельзя подменить новым снимком — читаем целиком
+                data = f.read()
+            else:
+                # Прежний mmap не закрывается: его закроет сборщик мусора, когда отпустят старые записи
+                data = self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return SnapshotChats(data)
+
+    def _reopen_snapshot(self, chats: Dict[str, ChatRecord]) -> Mapping:
+        return self._open_snapshot()
+
+    def _write_snapshot(self, chats: Dict[str, ChatRecord], stats: dict):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(encode_snapshot(chats, stats))
+            f.flush()
+            os.fsync(f.fileno())
+        # Старый файл остаётся доступен через уже открытый mmap, пока тот не закрыт
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def close(self):
+        super().close()
+        self._close_mmap()
+
+
+class SqliteStorage(StorageBackend):
+    """
+    SQLite в режиме WAL.
+
+    Таблица chats — одна строка на чат (история BLOB-ом, предсказание и марковская модель JSON-ом),
+    таблица meta — статистика. Изменение одного чата переписывает одну строку; все изменения
+    одного write() идут одной транзакцией. Запросы — константные строки с параметрами,
+    sqlite3 кэширует их подготовленные выражения.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS chats ("
+        "chat_id TEXT PRIMARY KEY, history BLOB, prediction TEXT, markov TEXT)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+    UPSERT_CHAT = "INSERT OR REPLACE INTO chats (chat_id, history, prediction, markov) VALUES (?, ?, ?, ?)"
+    DELETE_CHAT = "DELETE FROM chats WHERE chat_id = ?"
+    UPSERT_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+    SELECT_CHAT = "SELECT history, prediction, markov FROM chats WHERE chat_id = ?"
+
+    def __init__(self, path: str = "chat_state.sqlite3"):
+        self.path = path
+        # Пишут из разных потоков (фоновая запись), поэтому соединение общее под блокировкой
+        self._lock = threading.Lock()
+        self._chats: Optional[SqliteChats] = None  # Отображение из load(): список чатов обновляет write()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+
+    def load(self) -> Tuple[Mapping, Optional[dict]]:
+        """Читает только список чатов; строка чата выбирается при обращении к нему"""
+        with self._lock:
+            chat_ids = [row[0] for row in self._conn.execute("SELECT chat_id FROM chats")]
+            stats_row = self._conn.execute("SELECT value FROM meta WHERE key = 'stats'").fetchone()
+        self._chats = SqliteChats(self, chat_ids)
+        return self._chats, json.loads(stats_row[0]) if stats_row else None
+
+    def read_chat(self, chat_id: str) -> Optional[ChatRecord]:
+        with self._lock:
+            row = self._conn.execute(self.SELECT_CHAT, (chat_id,)).fetchone()
+        if row is None:
+            return None
+        history, prediction, markov = row
+        return ChatRecord(history or None,
+                          json.loads(prediction) if prediction else None,
+                          json.loads(markov) if markov else None)
+
+    @staticmethod
+    def _chat_row(chat_id: str, record: ChatRecord) -> tuple:
+        return (
+            chat_id,
+            bytes(record.history) if record.history else None,
+            json.dumps(record.prediction, ensure_ascii=False) if record.prediction else None,
+            json.dumps(record.markov, separators=(',', ':')) if record.markov else None
+        )
+
+    def write(self, chats: Dict[str, Optional[ChatRecord]], stats: Optional[dict] = None,
+              clear_predictions: bool = False):
+        upserts = [self._chat_row(chat_id, record) for chat_id, record in chats.items() if record is not None]
+        deletes = [(chat_id,) for chat_id, record in chats.items() if record is None]
+        try:
+            with self._lock, self._conn:
+                if clear_predictions:
+                    self._conn.execute("UPDATE chats SET prediction = NULL")
+                if deletes:
+                    self._conn.executemany(self.DELETE_CHAT, deletes)
+                if upserts:
+                    self._conn.executemany(self.UPSERT_CHAT, upserts)
+                if stats is not None:
+                    self._conn.execute(self.UPSERT_META, ('stats', json.dumps(stats, ensure_ascii=False)))
+        except Exception as e:
+            logger.error(f"Ошибка при записи в SQLite: {e}")
+            return
+        if self._chats is not None:
+            self._chats.track([row[0] for row in upserts], [row[0] for row in deletes])
+
+    def write_all(self, chats: Dict[str, ChatRecord], stats: dict):
+        try:
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM chats")
+                self._conn.executemany(self.UPSERT_CHAT,
+                                       [self._chat_row(chat_id, record) for chat_id, record in chats.items()])
+                self._conn.execute(self.UPSERT_META, ('stats', json.dumps(stats, ensure_ascii=False)))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении данных в SQLite: {e}")
+            return
+        if self._chats is not None:
+            self._chats.track(chats, (), replace=True)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SqliteChats(Mapping):
+    """Чаты SQLite-хранилища: список id известен сразу, строка чата читается при обращении"""
+
+    def __init__(self, storage: SqliteStorage, chat_ids):
+        self._storage = storage
+        self._chat_ids = set(chat_ids)
+
+    def __getitem__(self, chat_id: str) -> ChatRecord:
+        record = self._storage.read_chat(chat_id) if chat_id in self._chat_ids else None
+        if record is None:
+            raise KeyError(chat_id)
+        return record
+
+    def __iter__(self):
+        return iter(self._chat_ids)
+
+    def __len__(self):
+        return len(self._chat_ids)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chat_ids
+
+    def track(self, upserted, deleted, replace: bool = False):
+        """Обновляет список чатов после записи"""
+        if replace:
+            self._chat_ids = set(upserted)
+            return
+        self._chat_ids.update(upserted)
+        self._chat_ids.difference_update(deleted)
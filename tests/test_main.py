@@ -0,0 +1,139 @@
+"""
+Обработчики бота на поддельных объектах Telegram (без сети).
+
+Запуск из корня репозитория: python -m unittest discover tests
+Данные чатов пишутся во временную папку (DATA_DIR задаётся до импорта main).
+"""
+
+import os
+import random
+import sys
+import tempfile
+import types
+import unittest
+
+DATA_DIR = tempfile.mkdtemp(prefix="ludobot-tests-")
+os.environ["DATA_DIR"] = DATA_DIR
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import chat_history_manager as chm  # noqa: E402
+import inference_executor  # noqa: E402
+import only_color_predictor as ocp  # noqa: E402
+
+COLOR_LABELS = {'красное': '🔴 Красное', 'чёрное': '⚫️ Чёрное', 'зелёное': '🟢 Зеленое'}
+
+
+class FakeMessage:
+    """Сообщение Telegram: только поля, которые читают обработчики"""
+
+    _last_id = 1000
+
+    def __init__(self, text, chat_id, from_user_id=None, reply_to=None):
+        FakeMessage._last_id += 1
+        self.message_id = FakeMessage._last_id
+        self.text = text
+        self.caption = None
+        self.chat_id = chat_id
+        self.from_user = types.SimpleNamespace(id=from_user_id) if from_user_id else None
+        self.reply_to_message = reply_to
+        self.forward_from = None
+        self.new_chat_members = []
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return FakeMessage(text, self.chat_id)
+
+
+class FakeBot:
+    def __init__(self):
+        self.id = 1
+        self.sent = []
+        self.left = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def leave_chat(self, chat_id):
+        self.left.append(chat_id)
+
+
+def update_for(message):
+    return types.SimpleNamespace(message=message, effective_message=message, edited_message=None,
+                                 effective_chat=types.SimpleNamespace(id=message.chat_id))
+
+
+def roulette_text(spins):
+    """Сообщение бота рулетки с бросками spins (newest-first)"""
+    return "Последние результаты:\n" + "\n".join(f"— {n} ({COLOR_LABELS[ocp.color_of(n)]})" for n in spins)
+
+
+class HandlersTest(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        inference_executor.start(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        inference_executor.shutdown()
+
+    def setUp(self):
+        self.bot = FakeBot()
+        self.context = types.SimpleNamespace(bot=self.bot, application=None)
+
+    async def test_ludobot_on_old_message_keeps_history(self):
+        chat_id = main.Config.ALLOWED_CHAT_IDS[0]
+        window = chm.MESSAGE_WINDOW
+        step = window - chm.MIN_MATCHES  # Соседние сообщения перекрываются ровно на MIN_MATCHES бросков
+        rng = random.Random(23)
+        spins = [rng.randint(0, 36) for _ in range(window + step * 15)]  # oldest-first
+
+        messages = []
+        for end in range(window, len(spins) + 1, step):
+            message = FakeMessage(roulette_text(spins[end - window:end][::-1]), chat_id,
+                                  from_user_id=main.Config.ROULETTE_BOT_ID)
+            await main.roulette_message_handler(update_for(message), self.context)
+            messages.append(message)
+        history_length = len(chm.get_history(chat_id))
+        self.assertEqual(history_length, len(spins))
+
+        # /ludobot на одно из первых сообщений: его лог не продолжает историю и не должен её заменить
+        request = FakeMessage("/ludobot", chat_id, from_user_id=5, reply_to=messages[2])
+        await main.ludobot_command(update_for(request), self.context)
+
+        self.assertEqual(len(chm.get_history(chat_id)), history_length)
+        self.assertIn("Рекомендуем", request.replies[-1])
+
+    async def test_edited_roulette_message_is_ignored(self):
+        chat_id = main.Config.ALLOWED_CHAT_IDS[1]
+        rng = random.Random(7)
+        message = FakeMessage(roulette_text([rng.randint(0, 36) for _ in range(chm.MESSAGE_WINDOW)]), chat_id,
+                              from_user_id=main.Config.ROULETTE_BOT_ID)
+        update = update_for(message)
+        update.edited_message = message
+
+        await main.roulette_message_handler(update, self.context)
+
+        self.assertEqual(len(chm.get_history(chat_id)), 0)
+
+    async def test_new_disallowed_chat_is_rejected_and_left(self):
+        chat_id = -42
+        self.assertNotIn(chat_id, main.Config.ALLOWED_CHAT_IDS)
+        message = FakeMessage(None, chat_id)
+        message.new_chat_members = [types.SimpleNamespace(id=self.bot.id)]
+
+        main.outbox.start()
+        try:
+            await main.handle_new_chat(update_for(message), self.context)
+        finally:
+            await main.outbox.stop()
+
+        self.assertEqual(len(self.bot.sent), 1)
+        self.assertEqual(self.bot.sent[0][0], chat_id)
+        self.assertEqual(self.bot.left, [chat_id])
+
+
+if __name__ == "__main__":
+    unittest.main()
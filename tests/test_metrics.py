@@ -0,0 +1,36 @@
+"""
+Метрики в текстовом формате Prometheus.
+
+Запуск из корня репозитория: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+
+
+class LabelsTest(unittest.TestCase):
+
+    def test_non_string_label_values_share_one_series(self):
+        counter = metrics.Counter('test_labels_total', 'Проверка меток', ['worker'])
+
+        self.assertIs(counter.labels(0), counter.labels(0))
+        self.assertIs(counter.labels(0), counter.labels('0'))
+        counter.labels(0).inc()
+        counter.labels('0').inc()
+
+        rows = [line for line in metrics.render().splitlines() if line.startswith('test_labels_total{')]
+        self.assertEqual(rows, ['test_labels_total{worker="0"} 2'])
+
+    def test_wrong_label_count(self):
+        histogram = metrics.Histogram('test_labels_seconds', 'Проверка меток', ['handler'])
+        with self.assertRaises(ValueError):
+            histogram.labels('a', 'b')
+
+
+if __name__ == "__main__":
+    unittest.main()
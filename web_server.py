@@ -0,0 +1,94 @@
+"""
+web_server.py
+
+HTTP-сервер бота на aiohttp. Работает в том же event loop, что и бот (без отдельного потока):
+  - POST webhook_path — обновления от Telegram (режим webhook); обновление кладётся в очередь
+    приложения, ответ Telegram отправляется сразу, не дожидаясь обработки
+  - GET /       — "Telegram Bot is running!"
+  - GET /ping   — "pong" (проверка живости для хостинга)
+  - GET /metrics — метрики в текстовом формате Prometheus (metrics.render)
+
+  - create_web_app(application, webhook_path=None, secret_token=None)  # -> aiohttp.web.Application
+  - start_web_server(app, host, port)  # -> web.AppRunner (остановка: await runner.cleanup())
+"""
+
+import json
+import logging
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+APPLICATION_KEY = web.AppKey("application", object)  # telegram.ext.Application
+SECRET_KEY = web.AppKey("secret_token", object)
+
+
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="Telegram Bot is running!")
+
+
+async def ping(request: web.Request) -> web.Response:
+    return web.Response(text="pong")
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """Принимает обновление от Telegram и ставит его в очередь приложения"""
+    secret_token = request.app[SECRET_KEY]
+    if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+        logger.warning("Запрос на webhook с неверным секретом отклонён")
+        return web.Response(status=403)
+
+    try:
+        data = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return web.Response(status=400, text="Invalid JSON")
+
+    application = request.app[APPLICATION_KEY]
+    try:
+        update = Update.de_json(data, application.bot)
+    except Exception as e:
+        logger.error(f"Не удалось разобрать обновление: {e}")
+        return web.Response(status=400, text="Invalid update")
+
+    await application.update_queue.put(update)
+    return web.Response()
+
+
+def create_web_app(application, webhook_path: Optional[str] = None,
+                   secret_token: Optional[str] = None) -> web.Application:
+    """
+    Args:
+        application: telegram.ext.Application, в очередь которого идут обновления
+        webhook_path: Путь для обновлений Telegram; None — без webhook (режим polling)
+        secret_token: Секрет, который Telegram присылает в заголовке SECRET_HEADER
+
+    Returns:
+        web.Application: приложение aiohttp
+    """
+    app = web.Application()
+    app[APPLICATION_KEY] = application
+    app[SECRET_KEY] = secret_token
+    app.router.add_get("/", home)
+    app.router.add_get("/ping", ping)
+    app.router.add_get("/metrics", metrics_endpoint)
+    if webhook_path:
+        app.router.add_post(webhook_path, telegram_webhook)
+    return app
+
+
+async def start_web_server(app: web.Application, host: str, port: int) -> web.AppRunner:
+    """Запускает сервер в текущем event loop"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"HTTP-сервер слушает {host}:{port}")
+    return runner